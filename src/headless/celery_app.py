@@ -1,14 +1,28 @@
 # coding=utf-8
+import hashlib
 import importlib
 import json
 import os
+import time
 
+from billiard.process import current_process
 from celery import Celery
+from celery.signals import (
+    worker_process_init, worker_process_shutdown, worker_ready)
 from headless import settings as headless_settings
+from headless.geonode_session import geonode_sessions
+from headless.spatial_index import spatial_indexes
 from raven import Client
 from raven.contrib.celery import register_signal, register_logger_signal
 
-from headless.utils import set_logger, get_headless_logger
+from headless.utils import (
+    set_logger,
+    get_headless_logger,
+    setup_process_display,
+    stop_private_display,
+    phase_timer,
+    metadata_cache,
+    ingest_cache)
 from safe.gui.tools.minimum_needs.needs_profile import NeedsProfile
 from safe.utilities.settings import import_setting
 
@@ -20,6 +34,68 @@ __revision__ = '$Format:%H$'
 
 LOGGER = get_headless_logger()
 
+# State of the last InaSAFE initialization in this worker process.
+# The fingerprint describes everything start_inasafe depends on, so that
+# subsequent calls with the same fingerprint can skip the expensive reloads.
+INIT_STATE = {
+    'fingerprint': None,
+    'mode': None,
+    'elapsed': None,
+}
+
+INIT_MODE_COLD = 'cold'
+INIT_MODE_WARM = 'warm'
+
+
+def file_fingerprint(file_path):
+    """Compute a fingerprint of a file based on its mtime and content hash.
+
+    :param file_path: Path to the file.
+    :type file_path: basestring
+
+    :return: Tuple of path, mtime and md5 hash of the content. None values
+        are used if the file does not exist.
+    :rtype: tuple
+    """
+    if not file_path or not os.path.exists(file_path):
+        return file_path, None, None
+
+    mtime = os.path.getmtime(file_path)
+    with open(file_path, 'rb') as f:
+        content_hash = hashlib.md5(f.read()).hexdigest()
+    return file_path, mtime, content_hash
+
+
+def inasafe_fingerprint(locale='en_US'):
+    """Compute fingerprint of the state InaSAFE initialization depends on.
+
+    :param locale: Locale to be used for the analysis.
+    :type locale: str
+
+    :return: The fingerprint.
+    :rtype: tuple
+    """
+    return (
+        locale,
+        file_fingerprint(headless_settings.INASAFE_SETTINGS_PATH),
+        file_fingerprint(headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH),
+        file_fingerprint(minimum_needs_path(locale)),
+        headless_settings.OUTPUT_DIRECTORY,
+    )
+
+
+def init_info():
+    """Get timing information of the last InaSAFE initialization.
+
+    :return: Dictionary with init mode (warm or cold) and elapsed time in
+        seconds.
+    :rtype: dict
+    """
+    return {
+        'mode': INIT_STATE['mode'],
+        'elapsed': INIT_STATE['elapsed'],
+    }
+
 
 def load_inasafe_settings():
     """Load InaSAFE settings.
@@ -39,33 +115,52 @@ def load_inasafe_settings():
         import_setting(headless_settings.INASAFE_SETTINGS_PATH)
 
 
-def load_minimum_needs(locale='en_US'):
-    """Load Minimum Needs profile.
+def minimum_needs_path(locale='en_US'):
+    """Get the path of the minimum needs profile of a locale.
 
-    Profile to load is given from environment variable.
+    Profiles are given by the locale mapping file of environment variable
+    MINIMUM_NEEDS_LOCALE_MAPPING_PATH.
+
+    :param locale: Locale of the minimum needs profile.
+    :type locale: str
+
+    :return: Path to the profile, or None if there is none for the locale.
+    :rtype: basestring
     """
-    minimum_needs_path = None
+    if not headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH:
+        return None
+    with open(headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH) as f:
+        locale_mapping = json.load(f)
+    if locale not in locale_mapping:
+        return None
+
+    profile_path = locale_mapping.get(locale, '')
+    # Check if it is a relative path
+    if not profile_path.startswith('/'):
+        # The file specified in mapping file should be relative to
+        # this mapping file itself
+        mapping_dir_path = os.path.dirname(
+            headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH)
+        profile_path = os.path.join(mapping_dir_path, profile_path)
+    return profile_path
 
-    if headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH:
-        with open(headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH) as f:
-            locale_mapping = json.load(f)
 
-        if locale in locale_mapping:
-            minimum_needs_path = locale_mapping.get(locale, '')
+def load_minimum_needs(locale='en_US'):
+    """Load Minimum Needs profile.
+
+    Profile to load is given from environment variable.
 
-            # Check if it is a relative path
-            if not minimum_needs_path.startswith('/'):
-                # The file specified in mapping file should be relative to
-                # this mapping file itself
-                mapping_dir_path = os.path.dirname(
-                    headless_settings.MINIMUM_NEEDS_LOCALE_MAPPING_PATH)
-                minimum_needs_path = os.path.join(
-                    mapping_dir_path, minimum_needs_path)
+    :param locale: Locale of the minimum needs profile.
+    :type locale: str
 
+    :return: The loaded minimum needs.
+    :rtype: dict
+    """
+    profile_path = minimum_needs_path(locale)
     profile = NeedsProfile()
-    if minimum_needs_path:
+    if profile_path:
         try:
-            profile.read_from_file(minimum_needs_path)
+            profile.read_from_file(profile_path)
         except BaseException as e:
             LOGGER.debug(e)
             profile.minimum_needs = profile._defaults()
@@ -74,33 +169,38 @@ def load_minimum_needs(locale='en_US'):
         profile.minimum_needs = profile._defaults()
 
     profile.save()
-
-
-def reload_definitions():
-    """Brute force reload all related InaSAFE definitions to apply
-    current locale."""
-    package_list = [
-        # Reload minimum needs
-        'safe.definitions.minimum_needs',
-        # Reload everything that depends on minimum_needs
-        'safe.definitions.fields',
-        'safe.definitions',
-
-        # Reload min needs postprocessors
-        'safe.processors.minimum_needs_post_processors',
-        # Reload everything that depends on postprocessors
-        'safe.processors',
-        'safe.impact_function.postprocessors',
-        'safe.impact_function',
-
-        # Reload everything that depends on reporting
-        'safe.report.extractors.aggregate_postprocessors',
-        'safe.report.extractors.minimum_needs',
-        'safe.report'
-    ]
-    for p in package_list:
-        reload(importlib.import_module(p))
-
+    return profile.minimum_needs
+
+
+# InaSAFE packages that depend on locale through minimum needs definitions.
+# Order matters, dependencies are listed before their dependents.
+DEFINITIONS_PACKAGES = [
+    # Reload minimum needs
+    'safe.definitions.minimum_needs',
+    # Reload everything that depends on minimum_needs
+    'safe.definitions.fields',
+    'safe.definitions',
+
+    # Reload min needs postprocessors
+    'safe.processors.minimum_needs_post_processors',
+    # Reload everything that depends on postprocessors
+    'safe.processors',
+    'safe.impact_function.postprocessors',
+    'safe.impact_function',
+
+    # Reload everything that depends on reporting
+    'safe.report.extractors.aggregate_postprocessors',
+    'safe.report.extractors.minimum_needs',
+    'safe.report'
+]
+
+# Cache of module namespaces of DEFINITIONS_PACKAGES, built once per locale
+# and minimum needs profile.
+DEFINITIONS_SNAPSHOTS = {}
+
+
+def log_definitions():
+    """Log current minimum needs definitions."""
     from safe.definitions import minimum_needs
     from safe import processors
     LOGGER.debug('Minimum Needs list:')
@@ -112,15 +212,115 @@ def reload_definitions():
         LOGGER.debug(m)
 
 
-def start_inasafe(locale='en_US'):
+def reload_definitions():
+    """Brute force reload all related InaSAFE definitions to apply
+    current locale."""
+    for p in DEFINITIONS_PACKAGES:
+        reload(importlib.import_module(p))
+
+    log_definitions()
+
+
+def definitions_snapshot_key(locale, minimum_needs):
+    """Get the key of the definitions snapshot of a locale.
+
+    :param locale: Locale of the definitions.
+    :type locale: str
+
+    :param minimum_needs: Minimum needs loaded for the locale.
+    :type minimum_needs: dict
+
+    :return: Tuple of the locale and a digest of the minimum needs.
+    :rtype: tuple
+    """
+    minimum_needs_hash = hashlib.md5(
+        json.dumps(minimum_needs, sort_keys=True, default=str)).hexdigest()
+    return locale, minimum_needs_hash
+
+
+def load_definitions(snapshot_key):
+    """Load InaSAFE definitions for current locale from the snapshot cache.
+
+    The first time a snapshot key is seen, definitions are reloaded and the
+    resulting namespaces of DEFINITIONS_PACKAGES are stored. Next time, the
+    stored namespaces are swapped back in place without reloading modules.
+
+    :param snapshot_key: Key identifying the locale and minimum needs
+        profile the definitions are built with.
+    :type snapshot_key: tuple
+
+    :return: True if the definitions were loaded from the snapshot cache.
+    :rtype: bool
+    """
+    snapshot = DEFINITIONS_SNAPSHOTS.get(snapshot_key)
+    if snapshot is None:
+        reload_definitions()
+        DEFINITIONS_SNAPSHOTS[snapshot_key] = dict(
+            (p, dict(importlib.import_module(p).__dict__))
+            for p in DEFINITIONS_PACKAGES)
+        return False
+
+    # Same semantic as reload(), the module namespace is updated in place
+    for p in DEFINITIONS_PACKAGES:
+        importlib.import_module(p).__dict__.update(snapshot[p])
+
+    log_definitions()
+    return True
+
+
+def start_inasafe(locale='en_US', force=False):
     """Initialize QGIS application and prepare InaSAFE settings.
 
+    The full initialization is skipped if the locale, the settings files and
+    the output directory are unchanged since the last initialization.
+
     :param locale: Locale to be used for the analysis.
     :type locale: str
 
+    :param force: Force a full initialization even if the state is unchanged.
+    :type force: bool
+
     :return: Tuple of QGIS application object and IFACE.
     :rtype: tuple
     """
+    with phase_timer.phase('init'):
+        return _start_inasafe(locale, force)
+
+
+def apply_inasafe_settings(locale):
+    """Set InaSAFE settings, the minimum needs and the output directory.
+
+    It is cheap and also done on warm initializations, as a previous task
+    may have changed these settings.
+
+    :param locale: Locale to be used for the analysis.
+    :type locale: str
+
+    :return: The loaded minimum needs.
+    :rtype: dict
+    """
+    from safe.utilities.settings import set_setting
+
+    load_inasafe_settings()
+    minimum_needs = load_minimum_needs(locale)
+
+    if headless_settings.OUTPUT_DIRECTORY:
+        try:
+            os.makedirs(headless_settings.OUTPUT_DIRECTORY)
+        except OSError:
+            if not os.path.isdir(headless_settings.OUTPUT_DIRECTORY):
+                raise
+        set_setting(
+            'defaultUserDirectory', headless_settings.OUTPUT_DIRECTORY)
+    return minimum_needs
+
+
+def _start_inasafe(locale, force):
+    """Initialize QGIS application and prepare InaSAFE settings.
+
+    See start_inasafe.
+    """
+    start_time = time.time()
     set_logger()
 
     # Initialize qgis_app
@@ -129,39 +329,97 @@ def start_inasafe(locale='en_US'):
 
     set_canvas_crs(4326, True)
 
-    # Setting
-    from safe.utilities.settings import set_setting
+    # Headless settings are read from environment variables
+    reload(headless_settings)
+
+    fingerprint = inasafe_fingerprint(locale)
+    if not force and fingerprint == INIT_STATE['fingerprint']:
+        # Definitions are up to date, only reset the settings
+        apply_inasafe_settings(locale)
+        INIT_STATE['mode'] = INIT_MODE_WARM
+        INIT_STATE['elapsed'] = time.time() - start_time
+        LOGGER.debug(
+            'InaSAFE warm init in %.3f s' % INIT_STATE['elapsed'])
+        return QGIS_APP, IFACE
 
     # Reload default settings first
     from safe.definitions import default_settings
     from safe.utilities import settings
     reload(default_settings)
     reload(settings)
-    reload(headless_settings)
 
-    load_inasafe_settings()
-    load_minimum_needs(locale)
+    minimum_needs = apply_inasafe_settings(locale)
 
-    # reload minimum needs definitions
+    # load minimum needs definitions for this locale
     # redeclarations are needed for report
-    reload_definitions()
+    load_definitions(definitions_snapshot_key(locale, minimum_needs))
 
     # Load QGIS Expression
     # noinspection PyUnresolvedReferences
     from safe.utilities.expressions import qgis_expressions  # noqa
 
-    if headless_settings.OUTPUT_DIRECTORY:
-        try:
-            os.makedirs(headless_settings.OUTPUT_DIRECTORY)
-        except OSError:
-            if not os.path.isdir(headless_settings.OUTPUT_DIRECTORY):
-                raise
-        set_setting(
-            'defaultUserDirectory', headless_settings.OUTPUT_DIRECTORY)
+    INIT_STATE['fingerprint'] = fingerprint
+    INIT_STATE['mode'] = INIT_MODE_COLD
+    INIT_STATE['elapsed'] = time.time() - start_time
+    LOGGER.debug('InaSAFE cold init in %.3f s' % INIT_STATE['elapsed'])
 
     return QGIS_APP, IFACE
 
 
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Set up the display of a prefork child process.
+
+    Each child process creates its own QGIS application on the first task,
+    so it needs its own display to be able to run in parallel with the
+    other child processes.
+    """
+    process_index = getattr(current_process(), 'index', None) or 0
+    mode = setup_process_display(process_index)
+    if mode:
+        LOGGER.info(
+            'Worker process %s uses display mode %s' % (process_index, mode))
+
+
+@worker_ready.connect
+def init_worker(**kwargs):
+    """Start the background eviction of output directories, if enabled.
+
+    It runs in the main process of the worker, once the pool is started,
+    so each worker runs it once whatever its pool and concurrency.
+    """
+    # Imported here, tasks modules import this module
+    from headless.tasks.output_retention import start_retention_thread
+    if start_retention_thread():
+        LOGGER.info('Worker runs output retention')
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Close GeoNode sessions and the private display of a child process.
+
+    New metadata cache entries are persisted.
+    """
+    metadata_cache.save()
+    geonode_sessions.close()
+    stop_private_display()
+
+
+def headless_stats():
+    """Get statistics of InaSAFE Headless caches in this process.
+
+    :return: Dictionary of cache statistics.
+    :rtype: dict
+    """
+    return {
+        'init': init_info(),
+        'metadata_cache': metadata_cache.stats(),
+        'ingest_cache': ingest_cache.stats(),
+        'geonode_sessions': geonode_sessions.stats(),
+        'spatial_indexes': spatial_indexes.stats(),
+    }
+
+
 class SentryCelery(Celery):
 
     def on_configure(self):
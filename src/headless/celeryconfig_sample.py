@@ -26,12 +26,30 @@ task_routes = {
     'inasafe.headless.tasks.run_analysis': {
         'queue': 'inasafe-headless-analysis'
     },
+    'inasafe.headless.tasks.merge_partitioned_analysis': {
+        'queue': 'inasafe-headless-analysis'
+    },
+    'inasafe.headless.tasks.run_analysis_batch': {
+        'queue': 'inasafe-headless-analysis'
+    },
     'inasafe.headless.tasks.run_multi_exposure_analysis': {
         'queue': 'inasafe-headless-analysis'
     },
+    'inasafe.headless.tasks.run_exposure_analysis': {
+        'queue': 'inasafe-headless-analysis'
+    },
+    'inasafe.headless.tasks.merge_multi_exposure_analysis': {
+        'queue': 'inasafe-headless-analysis'
+    },
     'inasafe.headless.tasks.generate_report': {
         'queue': 'inasafe-headless-reporting'
     },
+    'inasafe.headless.tasks.render_report_components': {
+        'queue': 'inasafe-headless-reporting'
+    },
+    'inasafe.headless.tasks.merge_report': {
+        'queue': 'inasafe-headless-reporting'
+    },
     'inasafe.headless.tasks.get_generated_report': {
         'queue': 'inasafe-headless'
     },
@@ -41,8 +59,14 @@ task_routes = {
     'inasafe.headless.tasks.check_broker_connection': {
         'queue': 'inasafe-headless'
     },
+    'inasafe.headless.tasks.get_worker_stats': {
+        'queue': 'inasafe-headless'
+    },
     'inasafe.headless.tasks.push_to_geonode': {
         'queue': 'inasafe-headless-geonode'
+    },
+    'inasafe.headless.tasks.run_event_pipeline': {
+        'queue': 'inasafe-headless'
     }
 }
 
@@ -61,13 +85,28 @@ task_routes = {
 # **NIGHTMARE** to your celery worker. Read about this particular settings
 # here:
 # http://docs.celeryproject.org/en/latest/configuration.html#celeryd-concurrency
-worker_concurrency = 1
+#
+# The only exception is when each child process has its own display, by
+# setting HEADLESS_WORKER_DISPLAY_MODE to 'xvfb' (a private Xvfb server per
+# child process). Then every child process has its own QGIS
+# application and display, and HEADLESS_WORKER_CONCURRENCY can be set to the
+# number of analysis that can run in parallel.
+if os.environ.get('HEADLESS_WORKER_DISPLAY_MODE'):
+    worker_concurrency = int(
+        os.environ.get('HEADLESS_WORKER_CONCURRENCY', 1))
+else:
+    worker_concurrency = 1
 worker_prefetch_multiplier = 1
 
 # Celery config
-task_serializer = 'pickle'
-accept_content = {'pickle'}
-result_serializer = 'pickle'
+# Pickle is kept as default for compatibility with existing clients.
+# Set HEADLESS_SERIALIZER to 'json' or 'msgpack' (needs msgpack-python) for
+# compact payloads without QGIS classes. See headless/serialization.py for
+# the payload schema, e.g. CRS is sent as 'EPSG:4326' or WKT.
+task_serializer = os.environ.get('HEADLESS_SERIALIZER', 'pickle')
+result_serializer = task_serializer
+# Pickle payloads are only accepted when pickle is the serializer.
+accept_content = {task_serializer, 'json'}
 
 
 # Late ACK settings
@@ -0,0 +1,151 @@
+# coding=utf-8
+"""Pooled GeoNode sessions."""
+import hashlib
+import threading
+import time
+from urlparse import urljoin
+
+from headless import settings as headless_settings
+from headless.utils import get_headless_logger
+from safe.utilities.geonode.upload_layer_requests import login_user
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Page used to check a session is still logged in. GeoNode redirects to the
+# login page if it is not.
+GEONODE_UPLOAD_PATH = 'layers/upload'
+
+# Timeout in seconds of the session check request.
+SESSION_CHECK_TIMEOUT = 30
+
+
+class GeoNodeSessionPool(object):
+    """Authenticated GeoNode sessions of a worker process.
+
+    A session is a requests session, which also keeps its HTTP connections
+    alive. Sessions are kept by GeoNode url and credentials, and login again
+    once they are older than the maximum age.
+    """
+
+    def __init__(self, max_age=None):
+        """Constructor.
+
+        :param max_age: Maximum age of a session in seconds, 0 for no limit.
+            If None, HEADLESS_GEONODE_SESSION_MAX_AGE is used.
+        :type max_age: int
+        """
+        self.max_age = max_age
+        self.logins = 0
+        self.reuses = 0
+        self.expirations = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, user, password):
+        """Compute the pool key of a GeoNode account.
+
+        :param url: GeoNode url.
+        :type url: basestring
+
+        :param user: GeoNode user.
+        :type user: basestring
+
+        :param password: GeoNode password.
+        :type password: basestring
+
+        :return: Tuple of url, user and digest of the password.
+        :rtype: tuple
+        """
+        return url, user, hashlib.sha1(password.encode('utf-8')).hexdigest()
+
+    def get(self, url, user, password, renew=False):
+        """Get a logged in session.
+
+        :param url: GeoNode url.
+        :type url: basestring
+
+        :param user: GeoNode user.
+        :type user: basestring
+
+        :param password: GeoNode password.
+        :type password: basestring
+
+        :param renew: Login again even if there is a session, for instance
+            when GeoNode rejected it.
+        :type renew: bool
+
+        :return: The session.
+        :rtype: requests.Session
+        """
+        max_age = self.max_age
+        if max_age is None:
+            max_age = headless_settings.GEONODE_SESSION_MAX_AGE
+        key = self.key(url, user, password)
+        with self._lock:
+            session, login_time = self._sessions.get(key, (None, None))
+            if session is not None:
+                if not renew and (
+                        not max_age or time.time() - login_time < max_age):
+                    self.reuses += 1
+                    return session
+                self.expirations += 1
+                del self._sessions[key]
+                session.close()
+
+            LOGGER.debug('Login to GeoNode %s as %s' % (url, user))
+            session = login_user(url, user, password)
+            self.logins += 1
+            self._sessions[key] = (session, time.time())
+            return session
+
+    @staticmethod
+    def is_logged_in(url, session):
+        """Check a session is still logged in to GeoNode.
+
+        :param url: GeoNode url.
+        :type url: basestring
+
+        :param session: The session.
+        :type session: requests.Session
+
+        :return: True if GeoNode accepts the session.
+        :rtype: bool
+        """
+        try:
+            response = session.get(
+                urljoin(url, GEONODE_UPLOAD_PATH),
+                allow_redirects=False,
+                timeout=SESSION_CHECK_TIMEOUT)
+        except Exception as e:
+            LOGGER.debug('GeoNode session check failed: %s' % e)
+            return False
+        return response.status_code == 200
+
+    def close(self):
+        """Close all sessions."""
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def stats(self):
+        """Get pool statistics.
+
+        :return: Dictionary of size, logins, reuses and expirations.
+        :rtype: dict
+        """
+        return {
+            'size': len(self._sessions),
+            'logins': self.logins,
+            'reuses': self.reuses,
+            'expirations': self.expirations,
+        }
+
+
+geonode_sessions = GeoNodeSessionPool()
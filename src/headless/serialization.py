@@ -0,0 +1,103 @@
+# coding=utf-8
+"""Task payload serialization helpers.
+
+With the pickle serializer, clients can send QGIS objects and receive
+Python objects. With the json or msgpack serializers, task payloads must
+follow this schema:
+
+- Layer uris are strings.
+- A CRS is an authority id string such as 'EPSG:4326', an EPSG code as an
+  integer, or a WKT string. It is rebuilt as QgsCoordinateReferenceSystem
+  on the worker.
+- Results are dictionaries of strings, numbers, booleans, None, lists and
+  dictionaries. Dates are ISO 8601 strings and urls are strings.
+"""
+from datetime import date, datetime, time
+
+from PyQt4.QtCore import QUrl
+from qgis.core import QgsCoordinateReferenceSystem
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+PICKLE_SERIALIZER = 'pickle'
+
+
+def crs_to_string(crs):
+    """Convert a CRS to its authority id, or WKT if it has none.
+
+    :param crs: The CRS.
+    :type crs: QgsCoordinateReferenceSystem
+
+    :return: Authority id such as 'EPSG:4326' or WKT string.
+    :rtype: str
+    """
+    return crs.authid() or crs.toWkt()
+
+
+def parse_crs(crs):
+    """Rebuild a CRS from a task argument.
+
+    :param crs: The CRS as QgsCoordinateReferenceSystem, EPSG code, authority
+        id string or WKT string. None is kept as None.
+    :type crs: QgsCoordinateReferenceSystem, int, basestring
+
+    :return: The CRS.
+    :rtype: QgsCoordinateReferenceSystem
+
+    :raises: ValueError if the CRS is not valid.
+    """
+    if crs is None or isinstance(crs, QgsCoordinateReferenceSystem):
+        return crs
+    if isinstance(crs, (int, long)):
+        crs = 'EPSG:%d' % crs
+
+    result = QgsCoordinateReferenceSystem()
+    if ':' in crs and '[' not in crs:
+        result.createFromString(crs)
+    else:
+        result.createFromWkt(crs)
+    if not result.isValid():
+        raise ValueError('Invalid CRS: %s' % crs)
+    return result
+
+
+def to_plain(value):
+    """Convert a task result to plain types supported by all serializers.
+
+    :param value: The value to convert.
+
+    :return: The value with only plain types.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (to_plain(key), to_plain(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return [to_plain(item) for item in value]
+    if isinstance(value, QgsCoordinateReferenceSystem):
+        return crs_to_string(value)
+    if isinstance(value, QUrl):
+        return value.toString()
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return value
+
+
+def serializable_result(result, serializer):
+    """Prepare a task result for the configured result serializer.
+
+    Pickle results are returned as is, to keep compatibility with existing
+    clients.
+
+    :param result: The task result.
+
+    :param serializer: Name of the result serializer.
+    :type serializer: str
+
+    :return: The result, with plain types if not using pickle.
+    """
+    if serializer == PICKLE_SERIALIZER:
+        return result
+    return to_plain(result)
@@ -32,6 +32,98 @@ INASAFE_LOG_LEVEL = int(INASAFE_LOG_LEVEL)
 HEADLESS_LOG_LEVEL = os.environ.get('HEADLESS_LOG_LEVEL', str(logging.INFO))
 HEADLESS_LOG_LEVEL = int(HEADLESS_LOG_LEVEL)
 
+# Display used by each worker child process.
+# Empty means all child processes share the display given by DISPLAY.
+# 'xvfb' starts a private Xvfb server for each child process.
+WORKER_DISPLAY_MODE = os.environ.get('HEADLESS_WORKER_DISPLAY_MODE', '')
+# First display number used for private Xvfb servers. The child process with
+# index N will use display WORKER_DISPLAY_BASE + N.
+WORKER_DISPLAY_BASE = int(os.environ.get('HEADLESS_WORKER_DISPLAY_BASE', 100))
+
+# Maximum number of layer metadata kept in the metadata cache.
+METADATA_CACHE_SIZE = int(os.environ.get('HEADLESS_METADATA_CACHE_SIZE', 512))
+# File to persist the metadata cache across worker restarts.
+# Empty means the cache is only kept in memory.
+METADATA_CACHE_PATH = os.environ.get('HEADLESS_METADATA_CACHE_PATH', '')
+
+# Convert GeoJSON and shapefile input layers to a GeoPackage copy the first
+# time a version of the layer is loaded, and load the copy afterwards.
+INGEST_CACHE_ENABLED = strtobool(
+    os.environ.get('HEADLESS_INGEST_CACHE_ENABLED', 'False'))
+# Directory of the GeoPackage copies. Empty uses ingest_cache in the
+# InaSAFE output directory.
+INGEST_CACHE_DIRECTORY = os.environ.get('HEADLESS_INGEST_CACHE_DIRECTORY', '')
+
+# Build a spatial index file of vector exposure layers the first time a
+# version of the layer is clipped, and reuse it in later analysis. Only the
+# exposure clip uses it, so it has no effect unless
+# HEADLESS_EXPOSURE_CLIP_ENABLED is also True.
+SPATIAL_INDEX_ENABLED = strtobool(
+    os.environ.get('HEADLESS_SPATIAL_INDEX_ENABLED', 'False'))
+# Directory of the spatial index files. Empty uses spatial_index in the
+# InaSAFE output directory.
+SPATIAL_INDEX_DIRECTORY = os.environ.get(
+    'HEADLESS_SPATIAL_INDEX_DIRECTORY', '')
+
+# Reduce vector exposure layers to the hazard extent, or the hazard and
+# aggregation extent, before the impact function prepares them.
+EXPOSURE_CLIP_ENABLED = strtobool(
+    os.environ.get('HEADLESS_EXPOSURE_CLIP_ENABLED', 'False'))
+
+# Default of the output_geopackage option of analysis tasks: store all
+# output layers of an analysis in a single GeoPackage.
+OUTPUT_GEOPACKAGE_ENABLED = strtobool(
+    os.environ.get('HEADLESS_OUTPUT_GEOPACKAGE_ENABLED', 'False'))
+
+# Disk budget in bytes of the output directories, such as analysis and
+# contour directories. Least recently used ones are deleted above it. 0 for
+# no limit.
+OUTPUT_RETENTION_MAX_SIZE = int(
+    os.environ.get('HEADLESS_OUTPUT_RETENTION_MAX_SIZE', 0))
+# Seconds since the last access of an output directory before it is
+# deleted. 0 for no limit.
+OUTPUT_RETENTION_MAX_AGE = int(
+    os.environ.get('HEADLESS_OUTPUT_RETENTION_MAX_AGE', 0))
+# Seconds between eviction steps of output directories.
+OUTPUT_RETENTION_INTERVAL = int(
+    os.environ.get('HEADLESS_OUTPUT_RETENTION_INTERVAL', 300))
+# Maximum number of output directories scanned, and deleted, in a step.
+OUTPUT_RETENTION_BATCH_SIZE = int(
+    os.environ.get('HEADLESS_OUTPUT_RETENTION_BATCH_SIZE', 100))
+
+# Reuse outputs of previous analysis with identical inputs and settings.
+RESULT_CACHE_ENABLED = strtobool(
+    os.environ.get('HEADLESS_RESULT_CACHE_ENABLED', 'False'))
+# Maximum number of analysis kept in the result cache index.
+RESULT_CACHE_MAX_ENTRIES = int(
+    os.environ.get('HEADLESS_RESULT_CACHE_MAX_ENTRIES', 1000))
+# Maximum age in seconds of a result cache entry. 0 means no limit.
+RESULT_CACHE_MAX_AGE = int(
+    os.environ.get('HEADLESS_RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+
+# Reuse contours of identical shakemaps, keyed by raster content.
+CONTOUR_CACHE_ENABLED = strtobool(
+    os.environ.get('HEADLESS_CONTOUR_CACHE_ENABLED', 'False'))
+# Maximum number of contours kept. Evicted contour directories are deleted,
+# unless a task uses them.
+CONTOUR_CACHE_MAX_ENTRIES = int(
+    os.environ.get('HEADLESS_CONTOUR_CACHE_MAX_ENTRIES', 100))
+# Maximum age in seconds of a contour directory stored by the cache. 0 means
+# no limit.
+CONTOUR_CACHE_MAX_AGE = int(
+    os.environ.get('HEADLESS_CONTOUR_CACHE_MAX_AGE', 7 * 24 * 3600))
+
+# Contour shakemaps by tiles of this many pixels wide and high, to bound
+# memory on large rasters. 0 contours the whole raster at once.
+CONTOUR_TILE_SIZE = int(os.environ.get('HEADLESS_CONTOUR_TILE_SIZE', 0))
+# Number of tiles contoured at the same time. 0 means one per core.
+CONTOUR_TILE_WORKERS = int(
+    os.environ.get('HEADLESS_CONTOUR_TILE_WORKERS', 0))
+
+# Add timing and memory metrics to task results.
+TASK_METRICS_ENABLED = strtobool(
+    os.environ.get('HEADLESS_TASK_METRICS_ENABLED', 'True'))
+
 ENABLE_SENTRY = strtobool(os.environ.get('ENABLE_SENTRY', 'False'))
 
 # GeoNode Settings to push to GeoNode
@@ -40,3 +132,7 @@ PUSH_TO_REALTIME_GEONODE = ast.literal_eval(
 REALTIME_GEONODE_USER = os.environ.get('REALTIME_GEONODE_USER')
 REALTIME_GEONODE_PASSWORD = os.environ.get('REALTIME_GEONODE_PASSWORD')
 REALTIME_GEONODE_URL = os.environ.get('REALTIME_GEONODE_URL')
+# Seconds a GeoNode login session is reused by a worker process before
+# login again. 0 means until GeoNode rejects it.
+GEONODE_SESSION_MAX_AGE = int(
+    os.environ.get('HEADLESS_GEONODE_SESSION_MAX_AGE', 1800))
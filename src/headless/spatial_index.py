@@ -0,0 +1,252 @@
+# coding=utf-8
+"""Persistent spatial indexes of vector layers."""
+import hashlib
+import json
+import os
+import threading
+
+import numpy
+from osgeo import ogr
+
+from headless import settings as headless_settings
+from headless.utils import file_version, get_headless_logger, layer_files
+from safe.utilities.settings import setting
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Bump it when indexes are written differently.
+SPATIAL_INDEX_VERSION = 1
+
+# Sidecar files which do not change the features of a layer.
+STYLE_EXTENSIONS = ['.xml', '.qml']
+
+# Bounding box of each feature, sorted by xmin.
+SPATIAL_INDEX_DTYPE = numpy.dtype([
+    ('fid', '<i8'),
+    ('xmin', '<f8'),
+    ('ymin', '<f8'),
+    ('xmax', '<f8'),
+    ('ymax', '<f8'),
+])
+
+
+class SpatialIndex(object):
+    """Bounding boxes of the features of a layer, memory-mapped from disk.
+
+    Only the pages touched by queries are read, and they are shared by all
+    worker processes using the same index.
+    """
+
+    def __init__(self, path):
+        """Constructor.
+
+        :param path: Path to the index file.
+        :type path: basestring
+        """
+        self.path = path
+        self.boxes = numpy.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def extent(self):
+        """Get the extent of the indexed features.
+
+        :return: Tuple of xmin, ymin, xmax, ymax or None if it is empty.
+        :rtype: tuple
+        """
+        if not len(self.boxes):
+            return None
+        return (
+            float(self.boxes['xmin'][0]),
+            float(self.boxes['ymin'].min()),
+            float(self.boxes['xmax'].max()),
+            float(self.boxes['ymax'].max()))
+
+    def intersects(self, xmin, ymin, xmax, ymax):
+        """Find the features whose bounding box intersects a rectangle.
+
+        :return: Sorted array of feature ids.
+        :rtype: numpy.ndarray
+        """
+        end = numpy.searchsorted(self.boxes['xmin'], xmax, side='right')
+        candidates = self.boxes[:end]
+        mask = (
+            (candidates['xmax'] >= xmin)
+            & (candidates['ymin'] <= ymax)
+            & (candidates['ymax'] >= ymin))
+        return numpy.sort(candidates['fid'][mask])
+
+
+def build_spatial_index(layer_uri, index_path):
+    """Read the bounding boxes of the features of a layer into an index file.
+
+    The file is written then renamed, so readers never see a partial index.
+
+    :param layer_uri: Uri to the vector layer.
+    :type layer_uri: basestring
+
+    :param index_path: Path to the index file.
+    :type index_path: basestring
+
+    :raises: ValueError if it is not a vector layer.
+    """
+    data_source = ogr.Open(layer_uri)
+    if data_source is None:
+        raise ValueError('%s is not a vector layer.' % layer_uri)
+    layer = data_source.GetLayer()
+    boxes = numpy.empty(
+        max(layer.GetFeatureCount(), 0), dtype=SPATIAL_INDEX_DTYPE)
+    count = 0
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None or geometry.IsEmpty():
+            continue
+        if count == len(boxes):
+            boxes = numpy.resize(boxes, max(16, 2 * count))
+        x_min, x_max, y_min, y_max = geometry.GetEnvelope()
+        boxes[count] = (feature.GetFID(), x_min, y_min, x_max, y_max)
+        count += 1
+    data_source = None
+    boxes = boxes[:count]
+    boxes = boxes[numpy.argsort(boxes['xmin'], kind='mergesort')]
+
+    temp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        numpy.save(f, boxes)
+    os.rename(temp_path, index_path)
+
+
+class SpatialIndexCache(object):
+    """Spatial indexes of vector layers, kept by layer version.
+
+    An index is built the first time a version of a layer is seen, by any
+    worker process, and later analysis map the same file.
+    """
+
+    def __init__(self, directory):
+        """Constructor.
+
+        :param directory: Directory of the index files.
+        :type directory: basestring
+        """
+        self.directory = directory
+        self.hits = 0
+        self.builds = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index_path(self, layer_uri):
+        """Get the path of the index of the current version of a layer.
+
+        :param layer_uri: Uri to the vector layer.
+        :type layer_uri: basestring
+
+        :return: Path to the index file, or None if the layer is not a file.
+        :rtype: basestring
+        """
+        if file_version(layer_uri) is None:
+            return None
+        layer_key = hashlib.sha1(layer_uri.encode('utf-8')).hexdigest()[:16]
+        version = json.dumps([
+            SPATIAL_INDEX_VERSION,
+            [file_version(path) for path in layer_files(layer_uri)
+             if os.path.splitext(path)[1].lower() not in STYLE_EXTENSIONS]])
+        version_key = hashlib.sha1(version).hexdigest()[:16]
+        return os.path.join(
+            self.directory, '%s_%s.npy' % (layer_key, version_key))
+
+    def get(self, layer_uri):
+        """Get the spatial index of a layer, build it if needed.
+
+        :param layer_uri: Uri to the vector layer.
+        :type layer_uri: basestring
+
+        :return: The spatial index, or None if the layer can not be indexed.
+        :rtype: SpatialIndex
+        """
+        index_path = self.index_path(layer_uri)
+        if index_path is None:
+            return None
+        with self._lock:
+            index = self._indexes.get(layer_uri)
+            if index is not None and index.path == index_path:
+                self.hits += 1
+                return index
+
+            if os.path.exists(index_path):
+                self.hits += 1
+            else:
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not os.path.isdir(self.directory):
+                        raise
+                LOGGER.debug('Build spatial index of %s' % layer_uri)
+                try:
+                    build_spatial_index(layer_uri, index_path)
+                except ValueError as e:
+                    LOGGER.debug(e)
+                    return None
+                self.builds += 1
+                self._remove_old_versions(index_path)
+
+            index = SpatialIndex(index_path)
+            self._indexes[layer_uri] = index
+            return index
+
+    @staticmethod
+    def _remove_old_versions(index_path):
+        """Delete indexes of older versions of the same layer.
+
+        :param index_path: Path to the index of the current version.
+        :type index_path: basestring
+        """
+        directory, file_name = os.path.split(index_path)
+        layer_key = file_name.split('_')[0]
+        for name in os.listdir(directory):
+            if (name.startswith(layer_key + '_') and name.endswith('.npy')
+                    and name != file_name):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """Get cache statistics.
+
+        :return: Dictionary of size, hits and builds.
+        :rtype: dict
+        """
+        return {
+            'size': len(self._indexes),
+            'hits': self.hits,
+            'builds': self.builds,
+        }
+
+
+spatial_indexes = SpatialIndexCache(
+    headless_settings.SPATIAL_INDEX_DIRECTORY or None)
+
+
+def get_spatial_index(layer_uri):
+    """Get the persistent spatial index of a vector layer.
+
+    :param layer_uri: Uri to the vector layer.
+    :type layer_uri: basestring
+
+    :return: The spatial index, or None if indexes are disabled or the layer
+        can not be indexed.
+    :rtype: SpatialIndex
+    """
+    if not headless_settings.SPATIAL_INDEX_ENABLED:
+        return None
+    if not spatial_indexes.directory:
+        spatial_indexes.directory = os.path.join(
+            setting('defaultUserDirectory'), 'spatial_index')
+    return spatial_indexes.get(layer_uri)
@@ -0,0 +1,7 @@
+# coding=utf-8
+"""InaSAFE Headless benchmark package."""
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
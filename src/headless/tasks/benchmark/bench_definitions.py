@@ -0,0 +1,94 @@
+# coding=utf-8
+"""Benchmark of locale switching: module reload versus definitions snapshot.
+
+Each switch loads the minimum needs profile of the locale, as start_inasafe
+does, then reloads the definitions or restores their snapshot. If
+MINIMUM_NEEDS_LOCALE_MAPPING_PATH is not set, the profiles of the test
+data are used, so each locale has its own minimum needs.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.bench_definitions
+"""
+import json
+import os
+import time
+from argparse import ArgumentParser
+
+from headless.celery_app import (
+    start_inasafe,
+    reload_definitions,
+    load_definitions,
+    load_minimum_needs,
+    definitions_snapshot_key,
+    DEFINITIONS_SNAPSHOTS)
+from headless.tasks.benchmark.fixtures import minimum_needs_mapping_path
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def benchmark_definitions(locales, repeat=10):
+    """Time locale switching using reload and using snapshots.
+
+    :param locales: List of locales to cycle through.
+    :type locales: list
+
+    :param repeat: Number of cycles through the locales.
+    :type repeat: int
+
+    :return: Dictionary of total and mean time in seconds per approach, and
+        the number of distinct definitions snapshots.
+    :rtype: dict
+    """
+    if not os.environ.get('MINIMUM_NEEDS_LOCALE_MAPPING_PATH'):
+        # start_inasafe reads the settings from the environment
+        os.environ['MINIMUM_NEEDS_LOCALE_MAPPING_PATH'] = (
+            minimum_needs_mapping_path)
+    start_inasafe(locales[0], force=True)
+
+    switches = repeat * len(locales)
+
+    start_time = time.time()
+    for i in range(repeat):
+        for locale in locales:
+            load_minimum_needs(locale)
+            reload_definitions()
+    reload_time = time.time() - start_time
+
+    # Build snapshots first, the same way start_inasafe does on cold init
+    DEFINITIONS_SNAPSHOTS.clear()
+    for locale in locales:
+        load_definitions(
+            definitions_snapshot_key(locale, load_minimum_needs(locale)))
+
+    start_time = time.time()
+    for i in range(repeat):
+        for locale in locales:
+            load_definitions(
+                definitions_snapshot_key(locale, load_minimum_needs(locale)))
+    snapshot_time = time.time() - start_time
+
+    return {
+        'switches': switches,
+        'snapshots': len(DEFINITIONS_SNAPSHOTS),
+        'reload': {
+            'total': reload_time,
+            'mean': reload_time / switches,
+        },
+        'snapshot': {
+            'total': snapshot_time,
+            'mean': snapshot_time / switches,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--locales', nargs='+', default=['en', 'id'])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(
+        benchmark_definitions(args.locales, args.repeat), indent=4))
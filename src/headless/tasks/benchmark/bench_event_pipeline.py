@@ -0,0 +1,198 @@
+# coding=utf-8
+"""Benchmark of event latency with separate tasks and the event pipeline.
+
+An earthquake event is processed by a chain of generate_contour,
+run_analysis, generate_report and push_to_geonode tasks, then by one
+run_event_pipeline task, and the end to end latency of both is compared.
+GeoNode uploads are only done if HEADLESS_PUSH_TO_REALTIME_GEONODE is set.
+
+By default the tasks run locally (eager mode). With --remote, they are sent
+to the running workers, so the latency includes the queues, and the time
+each stage of the pipeline reaches the result backend is measured too.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.bench_event_pipeline -n 5
+    python -m headless.tasks.benchmark.bench_event_pipeline -n 5 --remote \
+        -o event_pipeline.json
+"""
+import json
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from headless.settings import PUSH_TO_REALTIME_GEONODE
+from headless.tasks.benchmark.fixtures import (
+    aggregation_layer_uri, place_layer_uri, shakemap_layer_uri)
+from headless.tasks.benchmark.run_benchmark import summarize
+from headless.tasks.inasafe_wrapper import (
+    generate_contour,
+    generate_report,
+    push_to_geonode,
+    run_analysis,
+    run_event_pipeline)
+from safe.definitions.layer_purposes import layer_purpose_exposure_summary
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+# Seconds between two polls of the state of a remote pipeline task.
+POLL_INTERVAL = 0.05
+
+# Stages of the event, in order.
+STAGES = ['contour', 'analysis', 'report', 'pack', 'push']
+
+
+def call_task(task, remote, *args, **kwargs):
+    """Run a task and wait for its result.
+
+    :param task: The celery task.
+    :type task: celery.Task
+
+    :param remote: Send the task to the workers instead of running it
+        locally.
+    :type remote: bool
+
+    :return: The task result.
+    """
+    if remote:
+        return task.apply_async(args, kwargs).get()
+    return task.apply(args, kwargs).get()
+
+
+def run_separate_tasks(remote, push_layer_keys):
+    """Process the event with one task per stage.
+
+    :param remote: Send the tasks to the workers.
+    :type remote: bool
+
+    :param push_layer_keys: Keys of the analysis layers to upload.
+    :type push_layer_keys: list
+
+    :return: Dictionary of the time from the start of the event until the
+        result of each stage is available, and the total.
+    :rtype: dict
+    """
+    latency = OrderedDict()
+    start_time = time.time()
+    contour_uri = call_task(generate_contour, remote, shakemap_layer_uri)
+    latency['contour'] = time.time() - start_time
+
+    result = call_task(
+        run_analysis, remote,
+        shakemap_layer_uri, place_layer_uri, aggregation_layer_uri)
+    latency['analysis'] = time.time() - start_time
+
+    output = result['output']
+    call_task(
+        generate_report, remote,
+        output[layer_purpose_exposure_summary['key']])
+    latency['report'] = time.time() - start_time
+
+    if push_layer_keys:
+        for layer_uri in [contour_uri] + [
+                output[key] for key in push_layer_keys]:
+            call_task(push_to_geonode, remote, layer_uri)
+        latency['push'] = time.time() - start_time
+    latency['total'] = time.time() - start_time
+    return latency
+
+
+def run_pipeline(remote, push_layer_keys):
+    """Process the event with the event pipeline task.
+
+    Remote stage results are available when they reach the result backend,
+    local ones when the pipeline ends their stage.
+
+    :param remote: Send the task to the workers.
+    :type remote: bool
+
+    :param push_layer_keys: Keys of the analysis layers to upload.
+    :type push_layer_keys: list
+
+    :return: Dictionary of the time from the start of the event until the
+        result of each stage is available, and the total.
+    :rtype: dict
+    """
+    args = (shakemap_layer_uri, place_layer_uri, aggregation_layer_uri)
+    kwargs = {'push_layer_keys': push_layer_keys}
+    start_time = time.time()
+    if not remote:
+        result = run_event_pipeline.apply(args, kwargs).get()
+        latency = OrderedDict()
+        elapsed = 0
+        for stage in STAGES:
+            if stage in result['latency']:
+                elapsed += result['latency'][stage]
+                latency[stage] = elapsed
+        latency['total'] = time.time() - start_time
+        return latency
+
+    async_result = run_event_pipeline.apply_async(args, kwargs)
+    latency = OrderedDict()
+    while not async_result.ready():
+        info = async_result.info
+        if async_result.state == 'PROGRESS' and isinstance(info, dict):
+            for stage in info['output']:
+                latency.setdefault(stage, time.time() - start_time)
+        time.sleep(POLL_INTERVAL)
+    result = async_result.get()
+    elapsed = time.time() - start_time
+    # Stages which ended after the last poll
+    for stage in result['output']:
+        latency.setdefault(stage, elapsed)
+    latency['total'] = elapsed
+    return latency
+
+
+def benchmark_event_pipeline(repeat=5, remote=False):
+    """Compare event latency of separate tasks and of the event pipeline.
+
+    The first run of each mode is a warm up run and is not measured.
+
+    :param repeat: Number of measured runs per mode.
+    :type repeat: int
+
+    :param remote: Send the tasks to the workers.
+    :type remote: bool
+
+    :return: Dictionary of latency summaries per mode and stage, and the
+        median total speedup of the pipeline.
+    :rtype: dict
+    """
+    push_layer_keys = []
+    if PUSH_TO_REALTIME_GEONODE:
+        push_layer_keys = [layer_purpose_exposure_summary['key']]
+    results = OrderedDict()
+    for name, run in (
+            ('separate_tasks', run_separate_tasks),
+            ('event_pipeline', run_pipeline)):
+        run(remote, push_layer_keys)
+        timings = OrderedDict()
+        for i in range(repeat):
+            for stage, elapsed in run(remote, push_layer_keys).items():
+                timings.setdefault(stage, []).append(elapsed)
+        results[name] = OrderedDict(
+            (stage, summarize(values)) for stage, values in timings.items())
+    results['speedup'] = (
+        results['separate_tasks']['total']['median']
+        / results['event_pipeline']['total']['median'])
+    results['remote'] = remote
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='JSON result file.')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--remote', action='store_true')
+    args = parser.parse_args()
+    content = json.dumps(
+        benchmark_event_pipeline(args.repeat, args.remote), indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        print(content)
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Benchmark of input layer load time with and without the ingest cache.
+
+It writes a synthetic GeoJSON exposure, then measures loading it and
+reading its features, and a bounding box request, from the GeoJSON file and
+from its GeoPackage copy.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.bench_ingest_cache -n 100000
+"""
+import json
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+from headless.tasks.benchmark.bench_spatial_index import (
+    create_buildings, timed)
+from headless.utils import IngestCache, load_layer
+from safe.test.utilities import get_qgis_app
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+
+def read_layer(layer_uri, rectangle=None):
+    """Load a layer and read its features.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :param rectangle: Only read features in this xmin, ymin, xmax, ymax
+        rectangle.
+    :type rectangle: tuple
+
+    :return: Number of features read.
+    :rtype: int
+    """
+    from qgis.core import QgsFeatureRequest, QgsRectangle
+    layer = load_layer(layer_uri, provider='ogr')[0]
+    request = QgsFeatureRequest()
+    if rectangle:
+        request.setFilterRect(QgsRectangle(*rectangle))
+    return len(list(layer.getFeatures(request)))
+
+
+def benchmark_ingest_cache(count=100000, query_fraction=0.1, repeat=3):
+    """Compare load times of a GeoJSON layer and its GeoPackage copy.
+
+    :param count: Number of features.
+    :type count: int
+
+    :param query_fraction: Width and height of the query rectangle, as a
+        fraction of the layer extent.
+    :type query_fraction: float
+
+    :param repeat: Number of loads, the best time is kept.
+    :type repeat: int
+
+    :return: Dictionary of timings in seconds.
+    :rtype: dict
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        layer_uri = os.path.join(temp_dir, 'buildings.geojson')
+        x_min, y_min, x_max, y_max = create_buildings(layer_uri, count)
+        rectangle = (
+            x_min,
+            y_min,
+            x_min + (x_max - x_min) * query_fraction,
+            y_min + (y_max - y_min) * query_fraction)
+
+        cache = IngestCache(os.path.join(temp_dir, 'ingest'))
+        cached_path, convert_time = timed(cache.get, layer_uri)
+
+        results = {
+            'features': count,
+            'geojson_size': os.path.getsize(layer_uri),
+            'geopackage_size': os.path.getsize(cached_path),
+            'convert': convert_time,
+        }
+        for name, path in (
+                ('geojson', layer_uri), ('geopackage', cached_path)):
+            results[name + '_load'] = min(
+                timed(read_layer, path)[1] for _ in range(repeat))
+            results[name + '_query'] = min(
+                timed(read_layer, path, rectangle)[1] for _ in range(repeat))
+        return results
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    parser.add_argument('--query-fraction', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(
+        benchmark_ingest_cache(args.count, args.query_fraction, args.repeat),
+        indent=4, sort_keys=True))
@@ -0,0 +1,127 @@
+# coding=utf-8
+"""Benchmark of task payload size and serialize time per serializer.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.bench_serialization
+"""
+import json
+import time
+from argparse import ArgumentParser
+
+from kombu.serialization import dumps, loads
+
+from headless.serialization import to_plain
+from headless.tasks.benchmark.fixtures import (
+    earthquake_layer_uri,
+    place_layer_uri,
+    aggregation_layer_uri,
+    buildings_layer_uri)
+from headless.tasks.inasafe_analysis import get_keywords
+from safe.test.utilities import get_qgis_app
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+
+def sample_payloads():
+    """Build representative task payloads.
+
+    :return: Dictionary of payload name and tuple of (pickle payload, plain
+        payload).
+    :rtype: dict
+    """
+    from qgis.core import QgsCoordinateReferenceSystem
+    crs = QgsCoordinateReferenceSystem('EPSG:4326')
+    analysis_args = (
+        [earthquake_layer_uri, place_layer_uri, None, crs], {})
+    keywords = dict(
+        (uri, get_keywords(uri))
+        for uri in [earthquake_layer_uri, place_layer_uri,
+                    aggregation_layer_uri, buildings_layer_uri])
+    report = {
+        'status': 0,
+        'message': '',
+        'output': dict(
+            ('%s_product_tag' % product, dict(
+                ('component-%d' % i, u'/home/headless/output/%s/%d.%s' % (
+                    product, i, product))
+                for i in range(10)))
+            for product in ['html', 'pdf', 'qpt']),
+    }
+    multi_exposure = {
+        'status': 0,
+        'message': '',
+        'output': dict(
+            ('exposure_%d' % i, dict(
+                ('layer_key_%d' % j, u'/home/headless/output/%d/%d.geojson' % (
+                    i, j))
+                for j in range(10)))
+            for i in range(5)),
+    }
+    payloads = {
+        'analysis_arguments': analysis_args,
+        'keywords_result': keywords,
+        'report_result': report,
+        'multi_exposure_result': multi_exposure,
+    }
+    return dict(
+        (name, (payload, to_plain(payload)))
+        for name, payload in payloads.items())
+
+
+def benchmark_serialization(
+        serializers=('pickle', 'json', 'msgpack'), repeat=1000):
+    """Measure payload size and serialize time of each serializer.
+
+    :param serializers: Names of kombu serializers.
+    :type serializers: list
+
+    :param repeat: Number of serialization per payload.
+    :type repeat: int
+
+    :return: Dictionary of results per payload and serializer.
+    :rtype: dict
+    """
+    results = {}
+    for name, (payload, plain_payload) in sample_payloads().items():
+        results[name] = {}
+        for serializer in serializers:
+            # Only pickle can carry QGIS and Python objects
+            data = payload if serializer == 'pickle' else plain_payload
+            try:
+                content_type, encoding, body = dumps(data, serializer)
+            except Exception as e:
+                results[name][serializer] = {'error': '%s' % e}
+                continue
+
+            start_time = time.time()
+            for i in range(repeat):
+                dumps(data, serializer)
+            dumps_time = (time.time() - start_time) / repeat
+
+            start_time = time.time()
+            for i in range(repeat):
+                loads(body, content_type, encoding,
+                      accept=[content_type])
+            loads_time = (time.time() - start_time) / repeat
+
+            results[name][serializer] = {
+                'size': len(body),
+                'dumps': dumps_time,
+                'loads': loads_time,
+            }
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+    print(json.dumps(
+        benchmark_serialization(repeat=args.repeat), indent=4,
+        sort_keys=True))
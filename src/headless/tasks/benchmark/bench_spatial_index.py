@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Benchmark of persistent spatial indexes on a large building exposure.
+
+It writes a synthetic exposure of square buildings on a regular grid, then
+compares a bounding box query through OGR with a query of the spatial
+index, after building it and when a later analysis maps it again.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.bench_spatial_index -n 1000000
+"""
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from osgeo import ogr, osr
+
+from headless.spatial_index import SpatialIndexCache
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+# Size of a building in degrees, about 10 meters.
+BUILDING_SIZE = 0.0001
+
+
+def create_buildings(path, count, driver_name='GeoJSON'):
+    """Write a layer of square buildings on a regular grid.
+
+    :param path: Path to the layer.
+    :type path: basestring
+
+    :param count: Number of buildings.
+    :type count: int
+
+    :param driver_name: OGR driver of the layer.
+    :type driver_name: str
+
+    :return: Extent of the buildings, xmin, ymin, xmax, ymax.
+    :rtype: tuple
+    """
+    side = int(math.ceil(math.sqrt(count)))
+    step = BUILDING_SIZE * 2
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(4326)
+    data_source = ogr.GetDriverByName(driver_name).CreateDataSource(path)
+    layer = data_source.CreateLayer(
+        'buildings', spatial_reference, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('type', ogr.OFTString))
+    definition = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for i in range(count):
+        x = 106.0 + (i % side) * step
+        y = -6.0 + (i // side) * step
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for dx, dy in ((0, 0), (1, 0), (1, 1), (0, 1), (0, 0)):
+            ring.AddPoint_2D(x + dx * BUILDING_SIZE, y + dy * BUILDING_SIZE)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(definition)
+        feature.SetField('type', 'residential')
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    data_source = None
+    return 106.0, -6.0, 106.0 + side * step, -6.0 + side * step
+
+
+def timed(function, *args):
+    """Call a function and measure its wall time.
+
+    :return: Tuple of the result and the time in seconds.
+    :rtype: tuple
+    """
+    start_time = time.time()
+    result = function(*args)
+    return result, time.time() - start_time
+
+
+def ogr_query(layer_uri, rectangle):
+    """Find the features intersecting a rectangle with OGR.
+
+    :return: List of feature ids.
+    :rtype: list
+    """
+    data_source = ogr.Open(layer_uri)
+    layer = data_source.GetLayer()
+    layer.SetSpatialFilterRect(*rectangle)
+    feature_ids = [feature.GetFID() for feature in layer]
+    data_source = None
+    return feature_ids
+
+
+def benchmark_spatial_index(count=1000000, query_fraction=0.1):
+    """Compare OGR and spatial index queries on a large exposure.
+
+    :param count: Number of buildings.
+    :type count: int
+
+    :param query_fraction: Width and height of the query rectangle, as a
+        fraction of the exposure extent.
+    :type query_fraction: float
+
+    :return: Dictionary of timings in seconds and feature counts.
+    :rtype: dict
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        layer_uri = os.path.join(temp_dir, 'buildings.geojson')
+        (x_min, y_min, x_max, y_max), create_time = timed(
+            create_buildings, layer_uri, count)
+        rectangle = (
+            x_min,
+            y_min,
+            x_min + (x_max - x_min) * query_fraction,
+            y_min + (y_max - y_min) * query_fraction)
+
+        ogr_ids, ogr_time = timed(ogr_query, layer_uri, rectangle)
+
+        index_directory = os.path.join(temp_dir, 'index')
+        index, build_time = timed(
+            SpatialIndexCache(index_directory).get, layer_uri)
+        # A later analysis, in another process, maps the existing index
+        index, open_time = timed(
+            SpatialIndexCache(index_directory).get, layer_uri)
+        index_ids, query_time = timed(index.intersects, *rectangle)
+
+        return {
+            'features': count,
+            'file_size': os.path.getsize(layer_uri),
+            'index_size': os.path.getsize(index.path),
+            'create': create_time,
+            'ogr_query': ogr_time,
+            'index_build': build_time,
+            'index_open': open_time,
+            'index_query': query_time,
+            'matches': len(index_ids),
+            'same_matches': sorted(ogr_ids) == list(index_ids),
+        }
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=1000000)
+    parser.add_argument('--query-fraction', type=float, default=0.1)
+    args = parser.parse_args()
+    print(json.dumps(
+        benchmark_spatial_index(args.count, args.query_fraction), indent=4,
+        sort_keys=True))
@@ -0,0 +1,102 @@
+# coding=utf-8
+"""Benchmark of analysis throughput with N processes, one display each.
+
+Run it inside the worker environment, with HEADLESS_WORKER_DISPLAY_MODE set:
+
+    HEADLESS_WORKER_DISPLAY_MODE=xvfb \
+        python -m headless.tasks.benchmark.bench_throughput -n 1 2 4
+"""
+import json
+import multiprocessing
+import time
+from multiprocessing.util import Finalize
+from argparse import ArgumentParser
+
+from headless.tasks.benchmark.fixtures import (
+    earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+from headless.utils import setup_process_display, stop_private_display
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def _init_process(counter):
+    """Pool initializer, give each process its own display.
+
+    :param counter: Shared counter used to compute the process index.
+    :type counter: multiprocessing.Value
+    """
+    with counter.get_lock():
+        process_index = counter.value
+        counter.value += 1
+    setup_process_display(process_index)
+    # Pool processes do not run atexit handlers
+    Finalize(None, stop_private_display, exitpriority=10)
+
+
+def _run_job(job):
+    """Run one analysis in the current process.
+
+    :param job: Tuple of hazard, exposure and aggregation uri.
+    :type job: tuple
+
+    :return: Status of the analysis.
+    :rtype: int
+    """
+    # Import here so QGIS is created after the display is set up
+    from headless.celery_app import start_inasafe
+    from headless.tasks import inasafe_analysis
+    start_inasafe()
+    result = inasafe_analysis.inasafe_analysis(*job)
+    return result['status']
+
+
+def benchmark_throughput(concurrency_list, jobs_count=8):
+    """Time analysis jobs with increasing number of processes.
+
+    :param concurrency_list: List of number of processes to benchmark.
+    :type concurrency_list: list
+
+    :param jobs_count: Number of analysis jobs per benchmark.
+    :type jobs_count: int
+
+    :return: Dictionary of elapsed time and throughput per concurrency.
+    :rtype: dict
+    """
+    jobs = [
+        (earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+    ] * jobs_count
+    results = {}
+    for concurrency in concurrency_list:
+        counter = multiprocessing.Value('i', 0)
+        pool = multiprocessing.Pool(
+            concurrency, initializer=_init_process, initargs=(counter,))
+        # Warm up every process, so QGIS init is not part of the timing
+        pool.map(_run_job, jobs[:1] * concurrency, chunksize=1)
+
+        start_time = time.time()
+        statuses = pool.map(_run_job, jobs, chunksize=1)
+        elapsed = time.time() - start_time
+
+        pool.close()
+        pool.join()
+        results[concurrency] = {
+            'jobs': jobs_count,
+            'failed': len([s for s in statuses if s != 0]),
+            'elapsed': elapsed,
+            'jobs_per_minute': jobs_count * 60.0 / elapsed,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--concurrency', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--jobs', type=int, default=8)
+    args = parser.parse_args()
+    print(json.dumps(
+        benchmark_throughput(args.concurrency, args.jobs),
+        indent=4, sort_keys=True))
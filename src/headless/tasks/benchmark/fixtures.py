@@ -0,0 +1,33 @@
+# coding=utf-8
+"""Input layers and settings of the benchmarks.
+
+They are the layers bundled with the test suite, read from their directory
+without importing the test helpers, which need the test environment.
+"""
+import os
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+TEST_DATA_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'test', 'data')
+INPUT_LAYERS_DIRECTORY = os.path.join(TEST_DATA_DIRECTORY, 'input_layers')
+
+earthquake_layer_uri = os.path.join(INPUT_LAYERS_DIRECTORY, 'earthquake.asc')
+shakemap_layer_uri = os.path.join(
+    INPUT_LAYERS_DIRECTORY, 'grid-use_ascii.tif')
+place_layer_uri = os.path.join(INPUT_LAYERS_DIRECTORY, 'places.geojson')
+aggregation_layer_uri = os.path.join(
+    INPUT_LAYERS_DIRECTORY, 'small_grid.geojson')
+population_multi_fields_layer_uri = os.path.join(
+    INPUT_LAYERS_DIRECTORY, 'population_multi_fields.geojson')
+buildings_layer_uri = os.path.join(
+    INPUT_LAYERS_DIRECTORY, 'buildings.geojson')
+
+# Minimum needs profiles of the en and id locales.
+minimum_needs_mapping_path = os.path.join(
+    TEST_DATA_DIRECTORY, 'settings',
+    'custom_locale_minimum_needs_mapping.json')
@@ -0,0 +1,251 @@
+# coding=utf-8
+"""Phase level benchmark of InaSAFE Headless tasks.
+
+It runs the real tasks locally (eager mode) over the bundled test layers and
+times every phase: init, load, prepare, run, report, contour and GeoNode
+upload. Results are written as JSON, so they can be compared between
+commits.
+
+Run it inside the worker environment:
+
+    python -m headless.tasks.benchmark.run_benchmark -o current.json
+    python -m headless.tasks.benchmark.run_benchmark \
+        -o current.json --compare baseline.json --threshold 0.2
+"""
+import json
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from headless.settings import PUSH_TO_REALTIME_GEONODE
+from headless.tasks.benchmark.fixtures import (
+    earthquake_layer_uri,
+    shakemap_layer_uri,
+    place_layer_uri,
+    buildings_layer_uri,
+    aggregation_layer_uri,
+    population_multi_fields_layer_uri)
+from headless.tasks.inasafe_wrapper import (
+    run_analysis,
+    run_multi_exposure_analysis,
+    generate_report,
+    generate_contour,
+    push_to_geonode)
+from headless.utils import phase_timer
+from safe.definitions.layer_purposes import layer_purpose_exposure_summary
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def run_task(task, *args):
+    """Run a task locally and measure its phases.
+
+    :param task: The celery task.
+    :type task: celery.Task
+
+    :param args: Arguments of the task.
+
+    :return: Tuple of the task result and dictionary of phase wall times,
+        including the 'total' time of the task.
+    :rtype: tuple
+    """
+    phase_timer.reset()
+    start_time = time.time()
+    result = task.apply(args).get()
+    phases = phase_timer.wall_times()
+    phases['total'] = time.time() - start_time
+    return result, phases
+
+
+def scenarios():
+    """List the benchmark scenarios.
+
+    Each scenario is a function returning the phase timings of one run.
+
+    :return: Ordered dictionary of scenario name and function.
+    :rtype: OrderedDict
+    """
+    def analysis():
+        return run_task(
+            run_analysis,
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)[1]
+
+    def multi_exposure_analysis():
+        return run_task(
+            run_multi_exposure_analysis,
+            earthquake_layer_uri,
+            [place_layer_uri, buildings_layer_uri,
+             population_multi_fields_layer_uri],
+            aggregation_layer_uri)[1]
+
+    def report():
+        result = run_task(
+            run_analysis,
+            earthquake_layer_uri, buildings_layer_uri,
+            aggregation_layer_uri)[0]
+        impact_layer_uri = result['output'][
+            layer_purpose_exposure_summary['key']]
+        return run_task(generate_report, impact_layer_uri)[1]
+
+    def contour():
+        return run_task(generate_contour, shakemap_layer_uri)[1]
+
+    def geonode_upload():
+        return run_task(push_to_geonode, place_layer_uri)[1]
+
+    result = OrderedDict([
+        ('analysis', analysis),
+        ('multi_exposure_analysis', multi_exposure_analysis),
+        ('report', report),
+        ('contour', contour),
+    ])
+    if PUSH_TO_REALTIME_GEONODE:
+        result['geonode_upload'] = geonode_upload
+    return result
+
+
+def summarize(values):
+    """Summarize a list of timings.
+
+    :param values: List of timings in seconds.
+    :type values: list
+
+    :return: Dictionary of min, median, mean and max.
+    :rtype: dict
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        median = values[middle]
+    else:
+        median = (values[middle - 1] + values[middle]) / 2.0
+    return {
+        'min': values[0],
+        'median': median,
+        'mean': sum(values) / len(values),
+        'max': values[-1],
+        'runs': len(values),
+    }
+
+
+def git_revision():
+    """Get the current git commit, if available.
+
+    :return: The commit hash or None.
+    :rtype: str
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(repeat=5, names=None):
+    """Run the benchmark scenarios.
+
+    The first run of each scenario is a warm up run and is not measured.
+
+    :param repeat: Number of measured runs per scenario.
+    :type repeat: int
+
+    :param names: Names of scenarios to run. All if None.
+    :type names: list
+
+    :return: Benchmark result.
+    :rtype: dict
+    """
+    results = OrderedDict()
+    for name, scenario in scenarios().items():
+        if names and name not in names:
+            continue
+        scenario()
+        timings = {}
+        for i in range(repeat):
+            for phase, elapsed in scenario().items():
+                timings.setdefault(phase, []).append(elapsed)
+        results[name] = OrderedDict(
+            (phase, summarize(values))
+            for phase, values in sorted(timings.items()))
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+        'scenarios': results,
+    }
+
+
+def compare(current, baseline, threshold=0.1):
+    """Compare benchmark results and list regressions.
+
+    A phase regressed if its median time is more than threshold slower than
+    the baseline median.
+
+    :param current: Current benchmark result.
+    :type current: dict
+
+    :param baseline: Baseline benchmark result.
+    :type baseline: dict
+
+    :param threshold: Allowed slowdown ratio, 0.1 means 10% slower.
+    :type threshold: float
+
+    :return: List of regressions as dictionaries.
+    :rtype: list
+    """
+    regressions = []
+    for name, phases in current['scenarios'].items():
+        baseline_phases = baseline['scenarios'].get(name, {})
+        for phase, summary in phases.items():
+            if phase not in baseline_phases:
+                continue
+            baseline_median = baseline_phases[phase]['median']
+            if summary['median'] > baseline_median * (1 + threshold):
+                regressions.append({
+                    'scenario': name,
+                    'phase': phase,
+                    'baseline': baseline_median,
+                    'current': summary['median'],
+                })
+    return regressions
+
+
+def main():
+    """Command line entry point."""
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='JSON result file.')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--scenario', nargs='+', dest='names')
+    parser.add_argument('--compare', help='Baseline JSON result file.')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    result = run_benchmark(args.repeat, args.names)
+    content = json.dumps(result, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        print(content)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        for regression in regressions:
+            print(
+                'Regression in %(scenario)s/%(phase)s: '
+                '%(baseline).3f s -> %(current).3f s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# coding=utf-8
+"""Content addressed cache of shakemap contours."""
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+from headless import settings as headless_settings
+from headless.tasks.output_retention import exclusive_output_lock
+from headless.tasks.result_cache import ResultCache
+from headless.utils import get_headless_logger, layer_digest
+from safe.utilities.settings import setting
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Increase it if the cache key or entry format changes.
+CONTOUR_CACHE_VERSION = 1
+
+CONTOUR_CACHE_INDEX_NAME = 'contour_cache.json'
+
+# Contour directories are named contour_[input_file_name]_[datetime]
+CONTOUR_DIRECTORY_PATTERN = 'contour_*'
+
+# Marker file written in the contour directories stored in the cache, only
+# these directories are deleted by the garbage collection.
+CONTOUR_CACHE_MARKER_NAME = '.contour_cache'
+
+# Contour directories stored by the cache but missing from its index are
+# deleted once their marker is older than this, in seconds. It covers
+# directories being stored.
+CONTOUR_CACHE_GRACE_PERIOD = 3600
+
+
+def contour_key(layer_uri, parameters):
+    """Compute the cache key of a contour.
+
+    :param layer_uri: The shakemap raster layer uri.
+    :type layer_uri: basestring
+
+    :param parameters: Parameters of the contour generation.
+    :type parameters: dict
+
+    :return: Hex digest identifying the contour.
+    :rtype: str
+    """
+    content = {
+        'version': CONTOUR_CACHE_VERSION,
+        'raster': layer_digest(layer_uri),
+        'parameters': parameters,
+    }
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+
+class ContourCache(ResultCache):
+    """Cache of contours, indexed in a JSON file.
+
+    Unlike the result cache, evicting an entry deletes its contour
+    directory. Contour directories used by a task, see outputs_in_use, are
+    kept with their entry until a later eviction.
+    """
+
+    index_name = CONTOUR_CACHE_INDEX_NAME
+
+    def __init__(self, directory, max_entries=100, max_age=0):
+        """Constructor.
+
+        :param directory: Directory of the contour directories.
+        :type directory: basestring
+
+        :param max_entries: Maximum number of contours.
+        :type max_entries: int
+
+        :param max_age: Maximum age of a contour in seconds, 0 for no limit.
+        :type max_age: int
+        """
+        super(ContourCache, self).__init__(directory, max_entries, max_age)
+        self.directory = directory
+
+    def _lock_path(self, key):
+        """Get the path of the lock file of a contour being generated.
+
+        :param key: The contour key.
+        :type key: str
+
+        :return: Path to the lock file.
+        :rtype: basestring
+        """
+        return '%s.%s.lock' % (self.index_path, key)
+
+    def _remove_directory(self, path):
+        """Delete a contour directory if no task uses it.
+
+        :param path: Path to the contour directory.
+        :type path: basestring
+
+        :return: True if it is deleted, False if a task uses it.
+        :rtype: bool
+        """
+        with exclusive_output_lock(
+                self.directory, os.path.basename(path)) as locked:
+            if not locked:
+                return False
+            shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def _evict(self, index):
+        """Evict expired contours and the least recently used ones.
+
+        :param index: The cache index.
+        :type index: dict
+
+        :return: List of deleted contour directories.
+        :rtype: list
+        """
+        deleted = []
+        for key in self._evicted_keys(index):
+            path = os.path.dirname(index[key]['output'])
+            if not self._remove_directory(path):
+                LOGGER.debug('Contour %s is in use, not evicted' % path)
+                continue
+            LOGGER.debug('Evict contour %s' % path)
+            del index[key]
+            deleted.append(path)
+            try:
+                os.remove(self._lock_path(key))
+            except OSError:
+                pass
+        return deleted
+
+    def get(self, key):
+        """Get a cached contour.
+
+        :param key: The contour key.
+        :type key: str
+
+        :return: The contour layer uri, or None if there is no valid entry
+            for the key.
+        :rtype: basestring
+        """
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry['output']):
+                LOGGER.debug('Cached contour %s is gone' % key)
+                del index[key]
+                return None
+            entry['accessed'] = time.time()
+            return entry['output']
+
+    def put(self, key, contour_uri):
+        """Store a contour.
+
+        :param key: The contour key.
+        :type key: str
+
+        :param contour_uri: The contour layer uri.
+        :type contour_uri: basestring
+        """
+        now = time.time()
+        marker_path = os.path.join(
+            os.path.dirname(contour_uri), CONTOUR_CACHE_MARKER_NAME)
+        with open(marker_path, 'w') as marker_file:
+            marker_file.write(key)
+        with self._index() as index:
+            index[key] = {
+                'created': now,
+                'accessed': now,
+                'output': contour_uri,
+            }
+
+    @contextmanager
+    def generating(self, key):
+        """Context manager held while a contour is generated.
+
+        Only one process at a time can hold it for a key, so identical
+        requests in flight wait for the first one and then find its contour
+        in the cache.
+
+        :param key: The contour key.
+        :type key: str
+        """
+        with open(self._lock_path(key), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def collect_garbage(self):
+        """Delete expired contours and contour directories left by the cache.
+
+        Expired entries and the least recently used ones are evicted, then
+        contour directories stored by the cache but no longer in its index,
+        such as the ones of a lost index, are deleted. Contour directories
+        created without the cache and the ones used by a task are left
+        untouched.
+
+        :return: List of deleted directories.
+        :rtype: list
+        """
+        with self._index() as index:
+            deleted = self._evict(index)
+            cached_directories = set(
+                os.path.dirname(entry['output']) for entry in index.values())
+            now = time.time()
+            for path in glob.glob(
+                    os.path.join(self.directory, CONTOUR_DIRECTORY_PATTERN)):
+                if path in cached_directories:
+                    continue
+                try:
+                    age = now - os.path.getmtime(
+                        os.path.join(path, CONTOUR_CACHE_MARKER_NAME))
+                except OSError:
+                    continue
+                if (age > CONTOUR_CACHE_GRACE_PERIOD
+                        and self._remove_directory(path)):
+                    deleted.append(path)
+        for path in deleted:
+            LOGGER.debug('Deleted contour directory %s' % path)
+        return deleted
+
+
+def get_contour_cache():
+    """Get the contour cache, following current settings.
+
+    :return: The contour cache, or None if it is disabled.
+    :rtype: ContourCache
+    """
+    if not headless_settings.CONTOUR_CACHE_ENABLED:
+        return None
+    return ContourCache(
+        setting('defaultUserDirectory'),
+        headless_settings.CONTOUR_CACHE_MAX_ENTRIES,
+        headless_settings.CONTOUR_CACHE_MAX_AGE)
@@ -0,0 +1,215 @@
+# coding=utf-8
+"""Reduce vector exposure layers to the area of an analysis."""
+import os
+import shutil
+from copy import deepcopy
+from datetime import datetime
+
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsFeatureRequest,
+    QgsMapLayer,
+    QgsRectangle,
+    QgsVectorFileWriter)
+
+from safe.utilities.metadata import write_iso19115_metadata
+from safe.utilities.settings import setting
+
+from headless.spatial_index import get_spatial_index
+from headless.utils import (
+    INDEXED_EXTENSIONS,
+    get_headless_logger,
+    load_layer,
+    provider_file_path)
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Margin around the clip extent, as a fraction of its size, so features
+# touching the extent are kept after reprojection.
+CLIP_EXTENT_MARGIN = 0.01
+
+# Only clip if it removes more than this fraction of the features.
+MINIMUM_CLIP_GAIN = 0.1
+
+# Sidecar files of the exposure layer copied with the clipped layer.
+CLIP_SIDECAR_EXTENSIONS = ['.qml']
+
+
+def layer_extent(layer, crs):
+    """Get the extent of a layer in another CRS.
+
+    :param layer: The layer.
+    :type layer: QgsMapLayer
+
+    :param crs: CRS of the extent.
+    :type crs: QgsCoordinateReferenceSystem
+
+    :return: The extent.
+    :rtype: QgsRectangle
+    """
+    extent = layer.extent()
+    if layer.crs() != crs:
+        transform = QgsCoordinateTransform(layer.crs(), crs)
+        extent = transform.transformBoundingBox(extent)
+    return extent
+
+
+def clip_extent(exposure_layer, hazard_layer, aggregation_layer=None):
+    """Compute the extent an analysis can use from an exposure layer.
+
+    It is the hazard extent, intersected with the aggregation extent if
+    there is an aggregation layer, in the exposure CRS.
+
+    :param exposure_layer: Exposure layer.
+    :type exposure_layer: QgsVectorLayer
+
+    :param hazard_layer: Hazard layer.
+    :type hazard_layer: QgsMapLayer
+
+    :param aggregation_layer: Aggregation layer.
+    :type aggregation_layer: QgsVectorLayer
+
+    :return: The extent, empty if the layers do not overlap.
+    :rtype: QgsRectangle
+    """
+    crs = exposure_layer.crs()
+    extent = layer_extent(hazard_layer, crs)
+    if aggregation_layer:
+        extent = extent.intersect(layer_extent(aggregation_layer, crs))
+    if extent.isEmpty():
+        return extent
+    margin = CLIP_EXTENT_MARGIN * max(extent.width(), extent.height())
+    return QgsRectangle(
+        extent.xMinimum() - margin,
+        extent.yMinimum() - margin,
+        extent.xMaximum() + margin,
+        extent.yMaximum() + margin)
+
+
+def write_clipped_layer(exposure_layer, features, output_directory=None):
+    """Write features of an exposure layer to a GeoPackage.
+
+    The GeoPackage gets the keywords and the style of the exposure layer,
+    so it can be loaded again from the analysis provenance.
+
+    :param exposure_layer: Exposure layer.
+    :type exposure_layer: QgsVectorLayer
+
+    :param features: Features to write.
+    :type features: list
+
+    :param output_directory: Directory of the clipped layer directory,
+        default to the InaSAFE user directory.
+    :type output_directory: basestring
+
+    :return: Path to the GeoPackage.
+    :rtype: basestring
+
+    :raises: ValueError if the layer can not be written.
+    """
+    output_directory = output_directory or setting('defaultUserDirectory')
+    # Make it same format as analysis directory
+    current_datetime = datetime.now().strftime('%d%B%Y_%Hh%M-%S.%f')
+    clip_directory = os.path.join(
+        output_directory, 'exposure_clip_%s' % current_datetime)
+    if not os.path.exists(clip_directory):
+        os.makedirs(clip_directory)
+    output_path = os.path.join(
+        clip_directory, '%s.gpkg' % exposure_layer.name())
+
+    writer = QgsVectorFileWriter(
+        output_path,
+        'utf-8',
+        exposure_layer.fields(),
+        exposure_layer.wkbType(),
+        exposure_layer.crs(),
+        'GPKG')
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise ValueError('Can not write %s: %s' % (
+            output_path, writer.errorMessage()))
+    for feature in features:
+        writer.addFeature(feature)
+    del writer
+
+    write_iso19115_metadata(output_path, deepcopy(exposure_layer.keywords))
+    data_path = provider_file_path(exposure_layer)
+    for extension in CLIP_SIDECAR_EXTENSIONS:
+        sidecar_path = os.path.splitext(data_path)[0] + extension
+        if os.path.isfile(sidecar_path):
+            shutil.copyfile(
+                sidecar_path, os.path.splitext(output_path)[0] + extension)
+    return output_path
+
+
+def clip_exposure_layer(
+        exposure_layer, hazard_layer, aggregation_layer=None):
+    """Reduce a vector exposure layer to the features an analysis can use.
+
+    Features whose bounding box intersects the clip_extent are written to a
+    GeoPackage in an exposure_clip directory of the output directory, see
+    write_clipped_layer. File layers are read through the persistent
+    spatial index of their file for formats without one, other layers
+    through their own spatial index. The clipped layer keeps the keywords
+    and extent of the exposure layer, so the impact function gives the same
+    results as with the whole layer. The analysis provenance points to the
+    GeoPackage.
+
+    :param exposure_layer: Exposure layer.
+    :type exposure_layer: QgsMapLayer
+
+    :param hazard_layer: Hazard layer.
+    :type hazard_layer: QgsMapLayer
+
+    :param aggregation_layer: Aggregation layer.
+    :type aggregation_layer: QgsVectorLayer
+
+    :return: The reduced exposure layer, or the exposure layer itself if it
+        is not a vector layer or clipping would not remove enough features.
+    :rtype: QgsMapLayer
+    """
+    if exposure_layer.type() != QgsMapLayer.VectorLayer:
+        return exposure_layer
+    extent = clip_extent(exposure_layer, hazard_layer, aggregation_layer)
+    if extent.isEmpty():
+        # Let the impact function report layers which do not overlap
+        return exposure_layer
+
+    request = QgsFeatureRequest()
+    spatial_index = None
+    data_path = provider_file_path(exposure_layer)
+    if (os.path.isfile(data_path) and os.path.splitext(data_path)[1].lower()
+            not in INDEXED_EXTENSIONS):
+        spatial_index = get_spatial_index(data_path)
+    if spatial_index is not None:
+        feature_ids = [int(fid) for fid in spatial_index.intersects(
+            extent.xMinimum(),
+            extent.yMinimum(),
+            extent.xMaximum(),
+            extent.yMaximum())]
+        count = len(feature_ids)
+        request.setFilterFids(feature_ids)
+    else:
+        request.setFilterRect(extent)
+        count = None
+
+    feature_count = exposure_layer.featureCount()
+    if count is not None and count > (1 - MINIMUM_CLIP_GAIN) * feature_count:
+        return exposure_layer
+    features = list(exposure_layer.getFeatures(request))
+    if len(features) > (1 - MINIMUM_CLIP_GAIN) * feature_count:
+        return exposure_layer
+
+    output_path = write_clipped_layer(exposure_layer, features)
+    layer = load_layer(
+        output_path, name=exposure_layer.name(), provider='ogr')[0]
+    # Keep the original extent, it is used for the analysis extent
+    layer.setExtent(exposure_layer.extent())
+    layer.keywords = deepcopy(exposure_layer.keywords)
+    LOGGER.debug('Clipped exposure %s from %d to %d features in %s' % (
+        exposure_layer.source(), feature_count, len(features), output_path))
+    return layer
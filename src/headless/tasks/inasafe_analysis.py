@@ -1,7 +1,12 @@
 # coding=utf-8
 """InaSAFE analysis utilities."""
+import fcntl
+import hashlib
 import json
 import os
+import shutil
+import tempfile
+import time
 
 from copy import deepcopy
 from datetime import datetime
@@ -11,8 +16,15 @@ from qgis.core import (
     QgsCoordinateReferenceSystem, QgsMapLayerRegistry, QgsProject)
 
 from safe.definitions.constants import (
-    PREPARE_SUCCESS, ANALYSIS_SUCCESS, MULTI_EXPOSURE_ANALYSIS_FLAG)
+    PREPARE_SUCCESS,
+    PREPARE_FAILED_BAD_LAYER,
+    ANALYSIS_SUCCESS,
+    ANALYSIS_FAILED_BAD_CODE,
+    MULTI_EXPOSURE_ANALYSIS_FLAG,
+    NUMPY_SMOOTHING)
 from safe.definitions.extra_keywords import extra_keyword_analysis_type
+from safe.definitions.layer_purposes import (
+    layer_purpose_exposure_summary, layer_purpose_hazard)
 from safe.definitions.reports.components import (
     all_default_report_components, map_report)
 from safe.definitions.utilities import override_component_template
@@ -23,12 +35,31 @@ from safe.impact_function.impact_function import ImpactFunction
 from safe.impact_function.impact_function_utilities import report_urls
 from safe.impact_function.multi_exposure_wrapper import (
     MultiExposureImpactFunction)
+from safe.report.impact_report import ImpactReport
 from safe.utilities.metadata import read_iso19115_metadata
 from safe.utilities.settings import setting
-from safe.utilities.geonode.upload_layer_requests import login_user, upload
-
-from headless.utils import load_layer, get_headless_logger
+from safe.utilities.geonode.upload_layer_requests import upload
+
+from headless.geonode_session import geonode_sessions
+from headless.serialization import parse_crs
+from headless.tasks.contour_cache import contour_key, get_contour_cache
+from headless.tasks.exposure_clip import clip_exposure_layer
+from headless.tasks.output_container import (
+    export_layer, load_container_metadata, pack_analysis_outputs)
+from headless.tasks.partitioned_analysis import split_layer_uri
+from headless.tasks.tiled_contour import create_tiled_contour
+from headless.utils import (
+    phase_timer,
+    load_layer,
+    load_analysis_layer,
+    file_version,
+    output_sizes,
+    get_headless_logger,
+    read_metadata)
 from headless.settings import (
+    CONTOUR_TILE_SIZE,
+    CONTOUR_TILE_WORKERS,
+    EXPOSURE_CLIP_ENABLED,
     REALTIME_GEONODE_PASSWORD,
     REALTIME_GEONODE_URL,
     REALTIME_GEONODE_USER
@@ -48,6 +79,13 @@ REPORT_METADATA_NOT_EXIST = 1
 GEONODE_UPLOAD_SUCCESS = 0
 GEONODE_UPLOAD_FAILED = 1
 
+BATCH_ANALYSIS_SUCCESS = 0
+BATCH_ANALYSIS_PARTIAL_FAILURE = 1
+BATCH_ANALYSIS_FAILED = 2
+
+EVENT_PIPELINE_SUCCESS = 0
+EVENT_PIPELINE_FAILED = 1
+
 
 def clean_metadata(metadata):
     """Clean metadata's content from QUrl.
@@ -75,8 +113,8 @@ def get_keywords(layer_uri, keyword=None):
     :returns: Dictionary of keywords or value of key as string.
     :rtype: dict, basestring
     """
-    metadata = read_iso19115_metadata(layer_uri)
-    clean_metadata(metadata)
+    # The cleaned metadata is cached, we get a copy of it
+    metadata = read_metadata(layer_uri, clean_metadata)
     if keyword:
         return metadata[keyword]
     return metadata
@@ -86,7 +124,9 @@ def inasafe_analysis(
         hazard_layer_uri,
         exposure_layer_uri,
         aggregation_layer_uri=None,
-        crs=None
+        crs=None,
+        output_geopackage=False,
+        use_exposure_view_only=True
 ):
     """Run analysis.
 
@@ -102,6 +142,17 @@ def inasafe_analysis(
     :param crs: CRS for the analysis (if the aggregation is not set).
     :param crs: QgsCoordinateReferenceSystem
 
+    :param output_geopackage: Store the output layers in a single
+        GeoPackage. Their uris then point into it, such as
+        path.gpkg|layername=name.
+    :type output_geopackage: bool
+
+    :param use_exposure_view_only: Only analyse the part of the exposure in
+        the analysis extent if the aggregation is not set. The impact
+        functions of a MultiExposureImpactFunction do not, see
+        execute_impact_function.
+    :type use_exposure_view_only: bool
+
     :returns: A dictionary of output's layer key and Uri with status and
         message.
     :rtype: dict
@@ -121,21 +172,111 @@ def inasafe_analysis(
     layer_registry = QgsMapLayerRegistry.instance()
     layer_registry.removeAllMapLayers()
 
+    with phase_timer.phase('load'):
+        hazard_layer = load_analysis_layer(hazard_layer_uri)[0]
+        exposure_layer = load_analysis_layer(exposure_layer_uri)[0]
+        aggregation_layer = None
+        if aggregation_layer_uri:
+            aggregation_layer = load_analysis_layer(aggregation_layer_uri)[0]
+    retval = run_impact_function(
+        hazard_layer, exposure_layer, aggregation_layer, crs,
+        use_exposure_view_only)
+
+    # Clean up layer registry after using
+    layer_registry.removeAllMapLayers()
+    if output_geopackage and retval['status'] == ANALYSIS_SUCCESS:
+        with phase_timer.phase('pack'):
+            retval['output'] = pack_analysis_outputs(retval['output'])
+    return retval
+
+
+def run_impact_function(
+        hazard_layer,
+        exposure_layer,
+        aggregation_layer=None,
+        crs=None,
+        use_exposure_view_only=True):
+    """Prepare and run an impact function on loaded layers.
+
+    :param hazard_layer: Hazard layer.
+    :type hazard_layer: QgsMapLayer
+
+    :param exposure_layer: Exposure layer.
+    :type exposure_layer: QgsMapLayer
+
+    :param aggregation_layer: Aggregation layer.
+    :type aggregation_layer: QgsVectorLayer
+
+    :param crs: CRS for the analysis (if the aggregation is not set).
+    :param crs: QgsCoordinateReferenceSystem
+
+    :param use_exposure_view_only: See execute_impact_function.
+    :type use_exposure_view_only: bool
+
+    :returns: A dictionary of output's layer key and Uri with status and
+        message, same as inasafe_analysis.
+    :rtype: dict
+    """
+    return execute_impact_function(
+        hazard_layer, exposure_layer, aggregation_layer, crs,
+        use_exposure_view_only)[0]
+
+
+def execute_impact_function(
+        hazard_layer,
+        exposure_layer,
+        aggregation_layer=None,
+        crs=None,
+        use_exposure_view_only=True):
+    """Prepare and run an impact function, keeping it for next steps.
+
+    The event pipeline generates reports from the returned impact function,
+    instead of loading it again from the output metadata.
+
+    :param hazard_layer: Hazard layer.
+    :type hazard_layer: QgsMapLayer
+
+    :param exposure_layer: Exposure layer.
+    :type exposure_layer: QgsMapLayer
+
+    :param aggregation_layer: Aggregation layer.
+    :type aggregation_layer: QgsVectorLayer
+
+    :param crs: CRS for the analysis (if the aggregation is not set).
+    :param crs: QgsCoordinateReferenceSystem
+
+    :param use_exposure_view_only: Only analyse the part of the exposure in
+        the analysis extent if the aggregation is not set and crs is given.
+        MultiExposureImpactFunction does not set it on the impact function
+        of each exposure, so exposures analysed for a multi exposure
+        analysis must not either.
+    :type use_exposure_view_only: bool
+
+    :returns: Tuple of the result, same as run_impact_function, and the
+        impact function.
+    :rtype: (dict, ImpactFunction)
+    """
+    if EXPOSURE_CLIP_ENABLED:
+        with phase_timer.phase('clip'):
+            exposure_layer = clip_exposure_layer(
+                exposure_layer, hazard_layer, aggregation_layer)
     impact_function = ImpactFunction()
-    impact_function.hazard = load_layer(hazard_layer_uri)[0]
-    impact_function.exposure = load_layer(exposure_layer_uri)[0]
-    if aggregation_layer_uri:
-        impact_function.aggregation = load_layer(aggregation_layer_uri)[0]
+    impact_function.hazard = hazard_layer
+    impact_function.exposure = exposure_layer
+    if aggregation_layer:
+        impact_function.aggregation = aggregation_layer
     elif crs:
-        impact_function.use_exposure_view_only = True
+        impact_function.use_exposure_view_only = use_exposure_view_only
         impact_function.crs = crs
     else:
         impact_function.crs = QgsCoordinateReferenceSystem(4326)
-    prepare_status, prepare_message = impact_function.prepare()
+    with phase_timer.phase('prepare'):
+        prepare_status, prepare_message = impact_function.prepare()
     retval = {}
     if prepare_status == PREPARE_SUCCESS:
         LOGGER.debug('Impact function is ready')
-        status, message = impact_function.run()
+        with phase_timer.phase('run'):
+            status, message = impact_function.run()
         if status == ANALYSIS_SUCCESS:
             outputs = impact_function.outputs
             output_dict = {}
@@ -161,20 +302,197 @@ def inasafe_analysis(
             'message': prepare_message.to_text(),
             'output': {}
         }
+    return retval, impact_function
+
+
+def inasafe_batch_analysis(hazard_layer_uri, jobs):
+    """Run analysis of one hazard against many exposure and aggregation.
+
+    The hazard layer is loaded and validated once for all jobs. A failing job
+    doesn't stop the other jobs.
+
+    :param hazard_layer_uri: Uri to hazard layer.
+    :type hazard_layer_uri: basestring
+
+    :param jobs: List of (exposure_layer_uri, aggregation_layer_uri, crs).
+        aggregation_layer_uri and crs are optional and can be None. crs can
+        be a QgsCoordinateReferenceSystem, an EPSG code, an authority id or
+        WKT.
+    :type jobs: list
+
+    :returns: A dictionary with status, message and the list of job results,
+        in the same order as the jobs. Each job result has the same format
+        as inasafe_analysis.
+    :rtype: dict
+
+    The output format will be:
+    output = {
+        'status': 0,
+        'message': '',
+        'output': [
+            {
+                'status': 0,
+                'message': '',
+                'output': {
+                    'output_layer_key_1': 'output_layer_path_1',
+                    'output_layer_key_2': 'output_layer_path_2',
+                }
+            },
+        ]
+    }
+    """
+    # Clean up layer registry before using
+    # In case previous task exited prematurely before cleanup
+    layer_registry = QgsMapLayerRegistry.instance()
+    layer_registry.removeAllMapLayers()
+
+    with phase_timer.phase('load'):
+        hazard_layer, layer_purpose = load_analysis_layer(hazard_layer_uri)
+    if (not hazard_layer or not hazard_layer.isValid()
+            or layer_purpose != layer_purpose_hazard['key']):
+        message = 'Hazard layer %s is not valid.' % hazard_layer_uri
+        LOGGER.debug(message)
+        job_retval = {
+            'status': PREPARE_FAILED_BAD_LAYER,
+            'message': message,
+            'output': {}
+        }
+        return {
+            'status': BATCH_ANALYSIS_FAILED,
+            'message': message,
+            'output': [deepcopy(job_retval) for job in jobs]
+        }
+    hazard_keywords = deepcopy(hazard_layer.keywords)
+
+    results = []
+    for job in jobs:
+        exposure_layer_uri, aggregation_layer_uri, crs = (
+            list(job) + [None, None])[:3]
+        try:
+            crs = parse_crs(crs)
+            # Each impact function gets pristine hazard keywords
+            hazard_layer.keywords = deepcopy(hazard_keywords)
+            with phase_timer.phase('load'):
+                exposure_layer = load_analysis_layer(exposure_layer_uri)[0]
+                aggregation_layer = None
+                if aggregation_layer_uri:
+                    aggregation_layer = load_analysis_layer(
+                        aggregation_layer_uri)[0]
+            retval = run_impact_function(
+                hazard_layer, exposure_layer, aggregation_layer, crs)
+        except Exception as e:
+            LOGGER.exception(e)
+            retval = {
+                'status': ANALYSIS_FAILED_BAD_CODE,
+                'message': '%s' % e,
+                'output': {}
+            }
+        results.append(retval)
+        # Clean up layers of this job, but keep the hazard for next jobs
+        layer_registry.removeMapLayers([
+            layer_id for layer_id in layer_registry.mapLayers()
+            if layer_id != hazard_layer.id()])
 
     # Clean up layer registry after using
     layer_registry.removeAllMapLayers()
-    return retval
+
+    failed_count = len(
+        [r for r in results if r['status'] != ANALYSIS_SUCCESS])
+    if not failed_count:
+        status = BATCH_ANALYSIS_SUCCESS
+        message = ''
+    elif failed_count < len(results):
+        status = BATCH_ANALYSIS_PARTIAL_FAILURE
+        message = '%d of %d analysis failed.' % (failed_count, len(results))
+    else:
+        status = BATCH_ANALYSIS_FAILED
+        message = 'All analysis failed.'
+
+    return {
+        'status': status,
+        'message': message,
+        'output': results
+    }
+
+
+class PrecomputedImpactFunction(object):
+    """Impact function of an exposure analysed by another task.
+
+    It is loaded from the outputs of the analysis and stands for the impact
+    function of the exposure in a MultiExposureImpactFunction, see
+    use_precomputed_impact_functions. Attributes are those of the loaded
+    impact function, and running it does nothing.
+    """
+
+    def __init__(self, impact_layer_uri):
+        """Constructor.
+
+        :param impact_layer_uri: Uri of an output layer of the analysis.
+        :type impact_layer_uri: basestring
+        """
+        LOGGER.debug('Load exposure analysis %s' % impact_layer_uri)
+        load_container_metadata(impact_layer_uri)
+        impact_function = ImpactFunction.load_from_output_metadata(
+            read_iso19115_metadata(impact_layer_uri))
+        object.__setattr__(self, 'impact_function', impact_function)
+
+    def __getattr__(self, name):
+        if name == 'impact_function':
+            # Not loaded yet, such as in a copy
+            raise AttributeError(name)
+        return getattr(self.impact_function, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.impact_function, name, value)
+
+    def run(self):
+        """The analysis already ran in another task.
+
+        :return: Tuple of the analysis status and message.
+        :rtype: (int, m.Message)
+        """
+        return ANALYSIS_SUCCESS, None
+
+
+def use_precomputed_impact_functions(multi_exposure_if, impact_layer_uris):
+    """Reuse the analysis of some exposures in a multi exposure analysis.
+
+    The impact functions of the prepared multi exposure analysis are
+    replaced by the precomputed ones of the same exposure key.
+
+    :param multi_exposure_if: The prepared multi exposure impact function.
+    :type multi_exposure_if: MultiExposureImpactFunction
+
+    :param impact_layer_uris: Uri of an output layer of the single exposure
+        analysis of some exposures.
+    :type impact_layer_uris: list
+    """
+    precomputed = {}
+    for impact_layer_uri in impact_layer_uris:
+        impact_function = PrecomputedImpactFunction(impact_layer_uri)
+        precomputed[impact_function.exposure.keywords['exposure']] = (
+            impact_function)
+
+    impact_functions = multi_exposure_if.impact_functions
+    for index, impact_function in enumerate(impact_functions):
+        exposure_key = impact_function.exposure.keywords['exposure']
+        if exposure_key in precomputed:
+            impact_functions[index] = precomputed[exposure_key]
 
 
 def inasafe_multi_exposure_analysis(
         hazard_layer_uri,
         exposure_layer_uris,
         aggregation_layer_uri=None,
-        crs=None
+        crs=None,
+        impact_layer_uris=None,
+        output_geopackage=False
 ):
     """Run analysis for multi exposure.
 
+    The analysis of each exposure can be run beforehand, in parallel by
+    other processes. The multi exposure analysis then only merges them.
+
     :param hazard_layer_uri: Uri to hazard layer.
     :type hazard_layer_uri: basestring
 
@@ -187,6 +505,16 @@ def inasafe_multi_exposure_analysis(
     :param crs: CRS for the analysis (if the aggregation is not set).
     :param crs: QgsCoordinateReferenceSystem
 
+    :param impact_layer_uris: Uri of an output layer of the single exposure
+        analysis of some exposures, with the same hazard, aggregation and
+        CRS, and without use_exposure_view_only. These exposures are not
+        analysed again.
+    :type impact_layer_uris: list
+
+    :param output_geopackage: Store the output layers, including those of
+        each exposure, in a single GeoPackage.
+    :type output_geopackage: bool
+
     :returns: A dictionary of output's layer key and Uri with status and
         message.
     :rtype: dict
@@ -217,21 +545,40 @@ def inasafe_multi_exposure_analysis(
     layer_registry.removeAllMapLayers()
 
     multi_exposure_if = MultiExposureImpactFunction()
-    multi_exposure_if.hazard = load_layer(hazard_layer_uri)[0]
-    exposures = [load_layer(layer_uri)[0] for layer_uri in exposure_layer_uris]
+    with phase_timer.phase('load'):
+        multi_exposure_if.hazard = load_analysis_layer(hazard_layer_uri)[0]
+        exposures = [
+            load_analysis_layer(layer_uri)[0]
+            for layer_uri in exposure_layer_uris]
+        aggregation_layer = None
+        if aggregation_layer_uri:
+            aggregation_layer = load_analysis_layer(aggregation_layer_uri)[0]
+            multi_exposure_if.aggregation = aggregation_layer
+    if EXPOSURE_CLIP_ENABLED:
+        with phase_timer.phase('clip'):
+            exposures = [
+                clip_exposure_layer(
+                    exposure, multi_exposure_if.hazard, aggregation_layer)
+                for exposure in exposures]
     multi_exposure_if.exposures = exposures
-    if aggregation_layer_uri:
-        multi_exposure_if.aggregation = load_layer(aggregation_layer_uri)[0]
-    elif crs:
-        multi_exposure_if.crs = crs
-    else:
-        multi_exposure_if.crs = QgsCoordinateReferenceSystem(4326)
-    prepare_status, prepare_message = multi_exposure_if.prepare()
+    if not aggregation_layer_uri:
+        if crs:
+            multi_exposure_if.crs = crs
+        else:
+            multi_exposure_if.crs = QgsCoordinateReferenceSystem(4326)
+    with phase_timer.phase('prepare'):
+        prepare_status, prepare_message = multi_exposure_if.prepare()
+        if prepare_status == PREPARE_SUCCESS and impact_layer_uris:
+            use_precomputed_impact_functions(
+                multi_exposure_if, impact_layer_uris)
 
-    retval = {}
     if prepare_status == PREPARE_SUCCESS:
         LOGGER.debug('Multi exposure function is ready')
-        status, message, exposure = multi_exposure_if.run()
+        with phase_timer.phase('run'):
+            status, message, exposure = multi_exposure_if.run()
+
+    retval = {}
+    if prepare_status == PREPARE_SUCCESS:
         if status == ANALYSIS_SUCCESS:
             outputs = multi_exposure_if.outputs
             output_dict = {}
@@ -272,6 +619,9 @@ def inasafe_multi_exposure_analysis(
 
     # Clean up layer registry after using
     layer_registry.removeAllMapLayers()
+    if output_geopackage and retval['status'] == ANALYSIS_SUCCESS:
+        with phase_timer.phase('pack'):
+            retval['output'] = pack_analysis_outputs(retval['output'])
     return retval
 
 
@@ -281,7 +631,12 @@ def generate_report(
         custom_layer_order=None,
         custom_legend_layer=None,
         use_template_extent=False,
-        IFACE=None):
+        IFACE=None,
+        report_keys=None,
+        locale=None,
+        incremental=True,
+        components=None,
+        impact_function=None):
     """Generate report based on impact layer uri.
 
     :param impact_layer_uri: The uri to impact layer (one of them).
@@ -293,6 +648,28 @@ def generate_report(
     :param custom_layer_order: List of layers uri for map report layers order.
     :type custom_layer_order: list
 
+    :param report_keys: Keys of the reports to generate, from
+        default_report_keys(). If None, all reports are generated.
+    :type report_keys: list
+
+    :param locale: Locale of the reports, only used to know if existing
+        reports are up to date.
+    :type locale: str
+
+    :param incremental: Only render reports which are missing or out of
+        date, and return the existing products for the others.
+    :type incremental: bool
+
+    :param components: Keys of the report components to render, such as
+        impact-report-pdf. Components they depend on are rendered too. If
+        None, all components are rendered.
+    :type components: list
+
+    :param impact_function: The impact function which made impact_layer_uri,
+        if it was just run in this process. Its layers and provenance are
+        used instead of loading them again from the output metadata.
+    :type impact_function: ImpactFunction
+
     :returns: A dictionary of output's report key and Uri with status and
         message.
     :rtype: dict
@@ -322,53 +699,100 @@ def generate_report(
     }
 
     """
+    reports = list(all_default_report_components)
+
+    if custom_report_template_uri:
+        reports.remove(map_report)
+        reports.append(
+            override_component_template(
+                map_report, custom_report_template_uri))
+
+    if report_keys is not None:
+        reports = [c for c in reports if c['key'] in report_keys]
+
+    generated_components = select_report_components(reports, components)
+    if not generated_components:
+        return {
+            'status': ImpactReport.REPORT_GENERATION_FAILED,
+            'message': 'No report component matches %s' % ', '.join(
+                components or []),
+            'output': {}
+        }
+
+    # Skip reports which are already up to date
+    render_parameters = [
+        custom_report_template_uri,
+        custom_layer_order,
+        custom_legend_layer,
+        use_template_extent,
+        locale]
+    cached_output = {}
+    if incremental:
+        generated_components, cached_output = stale_reports(
+            impact_layer_uri, generated_components, render_parameters)
+        if not generated_components:
+            LOGGER.debug('All reports are up to date')
+            return {
+                'status': ImpactReport.REPORT_GENERATION_SUCCESS,
+                'message': '',
+                'output': cached_output
+            }
+
     # Clean up layer registry before using
     # In case previous task exited prematurely before cleanup
     layer_registry = QgsMapLayerRegistry.instance()
     layer_registry.removeAllMapLayers()
 
-    output_metadata = read_iso19115_metadata(impact_layer_uri)
-    provenances = output_metadata.get('provenance_data', {})
-    extra_keywords = output_metadata.get('extra_keywords', {})
-    is_multi_exposure = (
-        extra_keywords.get(extra_keyword_analysis_type['key']) == (
-            MULTI_EXPOSURE_ANALYSIS_FLAG))
-
-    if provenances and is_multi_exposure:
-        impact_function = (
-            MultiExposureImpactFunction.load_from_output_metadata(
-                output_metadata))
-
-        # We need to create the multi exposure group because we need
-        # the map reports to be generated.
-        root = QgsProject.instance().layerTreeRoot()
-
-        group_analysis = root.insertGroup(0, impact_function.name)
-        group_analysis.setVisible(True)
-        group_analysis.setCustomProperty(
-            MULTI_EXPOSURE_ANALYSIS_FLAG, True)
-
-        for layer in impact_function.outputs:
-            QgsMapLayerRegistry.instance().addMapLayer(layer, False)
-            layer_node = group_analysis.addLayer(layer)
-            layer_node.setVisible(False)
-
-            # set layer title if any
-            try:
-                title = layer.keywords['title']
-                layer.setName(title)
-            except KeyError:
-                pass
-
-        for analysis in impact_function.impact_functions:
-            detailed_group = group_analysis.insertGroup(0, analysis.name)
-            detailed_group.setVisible(True)
-            add_impact_layers_to_canvas(analysis, group=detailed_group)
-    else:
-        impact_function = (
-            ImpactFunction.load_from_output_metadata(output_metadata))
-        # Add single impact layers to canvas.
-        add_impact_layers_to_canvas(impact_function)
+    with phase_timer.phase('load'):
+        if impact_function:
+            # The impact function was just run, its layers are in memory
+            provenances = impact_function.provenance
+            add_impact_layers_to_canvas(impact_function)
+        else:
+            load_container_metadata(impact_layer_uri)
+            output_metadata = read_iso19115_metadata(impact_layer_uri)
+            provenances = output_metadata.get('provenance_data', {})
+            extra_keywords = output_metadata.get('extra_keywords', {})
+            is_multi_exposure = (
+                extra_keywords.get(extra_keyword_analysis_type['key']) == (
+                    MULTI_EXPOSURE_ANALYSIS_FLAG))
+
+            if provenances and is_multi_exposure:
+                impact_function = (
+                    MultiExposureImpactFunction.load_from_output_metadata(
+                        output_metadata))
+
+                # We need to create the multi exposure group because we need
+                # the map reports to be generated.
+                root = QgsProject.instance().layerTreeRoot()
+
+                group_analysis = root.insertGroup(0, impact_function.name)
+                group_analysis.setVisible(True)
+                group_analysis.setCustomProperty(
+                    MULTI_EXPOSURE_ANALYSIS_FLAG, True)
+
+                for layer in impact_function.outputs:
+                    QgsMapLayerRegistry.instance().addMapLayer(layer, False)
+                    layer_node = group_analysis.addLayer(layer)
+                    layer_node.setVisible(False)
+
+                    # set layer title if any
+                    try:
+                        title = layer.keywords['title']
+                        layer.setName(title)
+                    except KeyError:
+                        pass
+
+                for analysis in impact_function.impact_functions:
+                    detailed_group = group_analysis.insertGroup(
+                        0, analysis.name)
+                    detailed_group.setVisible(True)
+                    add_impact_layers_to_canvas(analysis, group=detailed_group)
+            else:
+                impact_function = (
+                    ImpactFunction.load_from_output_metadata(output_metadata))
+                # Add single impact layers to canvas.
+                add_impact_layers_to_canvas(impact_function)
 
     IFACE.setActiveLayer(impact_function.analysis_impacted)
     IFACE.zoomToActiveLayer()
@@ -376,14 +800,6 @@ def generate_report(
     if provenances:
         set_provenance_to_project_variables(provenances)
 
-    generated_components = deepcopy(all_default_report_components)
-
-    if custom_report_template_uri:
-        generated_components.remove(map_report)
-        generated_components.append(
-            override_component_template(
-                map_report, custom_report_template_uri))
-
     def _preprocess_callback(impact_report=None):
         """Set additional customization for generating report.
 
@@ -393,22 +809,417 @@ def generate_report(
         impact_report.qgis_composition_context.save_as_raster = False
         return impact_report
 
-    error_code, message = (
-        impact_function.generate_report(
-            generated_components,
-            iface=IFACE,
-            ordered_layers_uri=custom_layer_order,
-            legend_layers_uri=custom_legend_layer,
-            use_template_extent=use_template_extent,
-            pre_process_callback=_preprocess_callback))
+    # InaSAFE rewrites the report metadata with the rendered components only
+    previous_output = read_json(report_metadata_path(impact_layer_uri))
+
+    with phase_timer.phase('report'):
+        error_code, message = (
+            impact_function.generate_report(
+                generated_components,
+                iface=IFACE,
+                ordered_layers_uri=custom_layer_order,
+                legend_layers_uri=custom_legend_layer,
+                use_template_extent=use_template_extent,
+                pre_process_callback=_preprocess_callback))
 
     # Clean up layer registry after using
     layer_registry.removeAllMapLayers()
-    return {
+    retval = {
         'status': error_code,
         'message': message.to_text(),
         'output': report_urls(impact_function)
     }
+    if error_code == ImpactReport.REPORT_GENERATION_SUCCESS:
+        save_report_state(
+            impact_layer_uri, generated_components, render_parameters,
+            retval['output'])
+    if cached_output:
+        retval = merge_report_results(
+            [{
+                'status': ImpactReport.REPORT_GENERATION_SUCCESS,
+                'message': '',
+                'output': cached_output
+            }, retval],
+            impact_layer_uri,
+            previous_output)
+    else:
+        write_report_metadata(
+            impact_layer_uri, retval['output'], previous_output)
+    return retval
+
+
+def provenance_layer_uris(impact_layer_uri):
+    """List the input layers in the provenance of an impact layer.
+
+    Reports load them with the impact layer, such as the clipped exposure
+    layer written by the analysis.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :return: Uris of the hazard, exposure and aggregation layers, empty if
+        the impact layer has no keywords.
+    :rtype: list
+    """
+    try:
+        provenance = read_metadata(impact_layer_uri).get(
+            'provenance_data', {})
+    except Exception as e:
+        LOGGER.debug(e)
+        return []
+    layer_uris = []
+    for key, value in provenance.items():
+        if not key.endswith(('_layer', '_layers')):
+            continue
+        for layer_uri in value if isinstance(value, list) else [value]:
+            if isinstance(layer_uri, basestring):
+                layer_uris.append(layer_uri)
+    return layer_uris
+
+
+def report_state_path(impact_layer_uri):
+    """Get the path of the report state file of an impact layer.
+
+    The report state records how each report was rendered, to know if its
+    products are up to date.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :return: Path to report_state.json.
+    :rtype: basestring
+    """
+    return os.path.join(
+        os.path.dirname(report_metadata_path(impact_layer_uri)),
+        'report_state.json')
+
+
+def component_digest(impact_layer_uri, component, render_parameters):
+    """Compute a digest of everything a rendered component depends on.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :param component: The report component definition.
+    :type component: dict
+
+    :param render_parameters: Parameters used to render the report.
+    :type render_parameters: list
+
+    :return: Hex digest of the impact layer version, the template version
+        and the render parameters.
+    :rtype: str
+    """
+    template = component.get('template')
+    if isinstance(template, basestring) and os.path.exists(template):
+        template_version = file_version(template)
+    else:
+        template_version = None
+    content = {
+        'impact_layer': file_version(split_layer_uri(impact_layer_uri)[0]),
+        'template': [template, template_version],
+        'parameters': render_parameters,
+    }
+    return hashlib.md5(
+        json.dumps(content, sort_keys=True, default=str)).hexdigest()
+
+
+def read_json(file_path):
+    """Read a JSON file, returns an empty dictionary if it can't be read.
+
+    :param file_path: Path to the JSON file.
+    :type file_path: basestring
+
+    :return: The content.
+    :rtype: dict
+    """
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def component_dependencies(component, report):
+    """List keys of the components of a report a component depends on.
+
+    A component refers to another one by its key in its extra arguments,
+    for instance a pdf rendered from an html report.
+
+    :param component: The report component definition.
+    :type component: dict
+
+    :param report: The report definition the component belongs to.
+    :type report: dict
+
+    :return: Set of component keys.
+    :rtype: set
+    """
+    report_component_keys = set(
+        c['key'] for c in report.get('components', []))
+    dependencies = set()
+    values = [component.get('extra_args')]
+    while values:
+        value = values.pop()
+        if isinstance(value, dict):
+            values.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            values.extend(value)
+        elif isinstance(value, basestring) and (
+                value in report_component_keys and value != component['key']):
+            dependencies.add(value)
+    return dependencies
+
+
+def select_report_components(reports, component_keys=None):
+    """Select the components to render from report definitions.
+
+    Only the selected definitions are copied, with the components they
+    depend on, so the full definition set is never deep copied.
+
+    :param reports: The report definitions.
+    :type reports: list
+
+    :param component_keys: Keys of the components to render. If None, all
+        components are rendered.
+    :type component_keys: list
+
+    :return: Copy of the report definitions with the selected components,
+        reports without any of them are left out.
+    :rtype: list
+    """
+    if component_keys is None:
+        return deepcopy(reports)
+
+    selected_reports = []
+    for report in reports:
+        components = report.get('components', [])
+        selected_keys = set(
+            c['key'] for c in components if c['key'] in component_keys)
+        # Add the components the selected ones depend on
+        pending = list(selected_keys)
+        while pending:
+            component = next(
+                c for c in components if c['key'] == pending.pop())
+            for key in component_dependencies(component, report):
+                if key not in selected_keys:
+                    selected_keys.add(key)
+                    pending.append(key)
+        if not selected_keys:
+            continue
+        selected_report = dict(report)
+        selected_report['components'] = deepcopy(
+            [c for c in components if c['key'] in selected_keys])
+        selected_reports.append(selected_report)
+    return selected_reports
+
+
+def stale_reports(impact_layer_uri, reports, render_parameters):
+    """Find which report components need to be rendered.
+
+    A component is up to date if it was rendered from the same impact layer
+    version, template and parameters, and its products still exist.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :param reports: The report definitions.
+    :type reports: list
+
+    :param render_parameters: Parameters used to render the reports.
+    :type render_parameters: list
+
+    :return: Tuple of the report definitions with the components to render
+        and the report output of the up to date components.
+    :rtype: (list, dict)
+    """
+    report_metadata = read_json(report_metadata_path(impact_layer_uri))
+    report_state = read_json(report_state_path(impact_layer_uri))
+
+    product_paths = {}
+    for product_tag, products in report_metadata.items():
+        for product_key, product_path in products.items():
+            product_paths.setdefault(product_key, []).append(
+                (product_tag, product_path))
+
+    stale_keys = []
+    cached_output = {}
+    for report in reports:
+        for component in report.get('components', []):
+            key = component['key']
+            state = report_state.get(key, {})
+            paths = product_paths.get(key, [])
+            up_to_date = (
+                state.get('digest') == component_digest(
+                    impact_layer_uri, component, render_parameters)
+                and (not state.get('output') or paths)
+                and all(os.path.exists(path) for _, path in paths))
+            if not up_to_date:
+                stale_keys.append(key)
+                continue
+            for product_tag, path in paths:
+                cached_output.setdefault(product_tag, {})[key] = path
+    return select_report_components(reports, stale_keys), cached_output
+
+
+def save_report_state(impact_layer_uri, reports, render_parameters, output):
+    """Record how report components were rendered.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :param reports: The rendered report definitions.
+    :type reports: list
+
+    :param render_parameters: Parameters used to render the reports.
+    :type render_parameters: list
+
+    :param output: Report output, as given by report_urls.
+    :type output: dict
+    """
+    state_path = report_state_path(impact_layer_uri)
+    if not os.path.isdir(os.path.dirname(state_path)):
+        return
+    rendered_keys = set()
+    for products in output.values():
+        rendered_keys.update(products)
+
+    # Partial reports may be rendered concurrently by several workers
+    with open(state_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            report_state = read_json(state_path)
+            for report in reports:
+                for component in report.get('components', []):
+                    report_state[component['key']] = {
+                        'digest': component_digest(
+                            impact_layer_uri, component, render_parameters),
+                        'output': component['key'] in rendered_keys,
+                    }
+            temp_path = '%s.%d.tmp' % (state_path, os.getpid())
+            with open(temp_path, 'w') as f:
+                json.dump(report_state, f)
+            os.rename(temp_path, state_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def default_report_keys(component_keys=None):
+    """List keys of the reports generated by default.
+
+    Each report groups components which are rendered together, such as an
+    html report and its pdf.
+
+    :param component_keys: Only list the reports with one of these
+        components. If None, all reports are listed.
+    :type component_keys: list
+
+    :return: List of report keys.
+    :rtype: list
+    """
+    return [
+        report['key'] for report in all_default_report_components
+        if component_keys is None or any(
+            component['key'] in component_keys
+            for component in report.get('components', []))]
+
+
+def report_metadata_path(impact_layer_uri):
+    """Get the path of the report metadata file of an impact layer.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :return: Path to report_metadata.json.
+    :rtype: basestring
+    """
+    impact_layer_directory = os.path.split(impact_layer_uri)[0]
+    return os.path.join(
+        impact_layer_directory, 'output', 'report_metadata.json')
+
+
+def write_report_metadata(impact_layer_uri, output, previous_output=None):
+    """Write report urls to the report metadata file.
+
+    Products of the components which are not in output, rendered before by
+    another generate_report, are kept in the file if they still exist, so
+    get_generated_report lists all of them after a partial render.
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :param output: Report output, as given by report_urls.
+    :type output: dict
+
+    :param previous_output: Report output listed before the reports were
+        rendered. If None, the current report metadata file is used.
+    :type previous_output: dict
+    """
+    metadata_path = report_metadata_path(impact_layer_uri)
+    if previous_output is None:
+        previous_output = read_json(metadata_path)
+    output_keys = set()
+    for products in output.values():
+        output_keys.update(products)
+
+    metadata = {}
+    for product_tag, products in previous_output.items():
+        for product_key, product_path in products.items():
+            if (product_key not in output_keys
+                    and os.path.exists(product_path)):
+                metadata.setdefault(product_tag, {})[product_key] = (
+                    product_path)
+    for product_tag, products in output.items():
+        metadata.setdefault(product_tag, {}).update(products)
+
+    try:
+        os.makedirs(os.path.dirname(metadata_path))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(metadata_path)):
+            raise
+    temp_path = '%s.%d.tmp' % (metadata_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f)
+    os.rename(temp_path, metadata_path)
+
+
+def merge_report_results(results, impact_layer_uri, previous_output=None):
+    """Merge results of partial report generation.
+
+    The merged report urls are written to the report metadata file, with
+    the products of the other components, see write_report_metadata.
+
+    :param results: List of generate_report results.
+    :type results: list
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :param previous_output: Report output listed before the reports were
+        rendered. If None, the current report metadata file is used.
+    :type previous_output: dict
+
+    :returns: A dictionary of output's report key and Uri with status and
+        message, same as generate_report.
+    :rtype: dict
+    """
+    status = ImpactReport.REPORT_GENERATION_SUCCESS
+    messages = []
+    output = {}
+    for result in results:
+        if status == ImpactReport.REPORT_GENERATION_SUCCESS:
+            status = result['status']
+        if result['message']:
+            messages.append(result['message'])
+        for product_tag, products in result['output'].items():
+            output.setdefault(product_tag, {}).update(products)
+    write_report_metadata(impact_layer_uri, output, previous_output)
+
+    return {
+        'status': status,
+        'message': '\n'.join(messages),
+        'output': output
+    }
 
 
 def get_generated_report(impact_layer_uri):
@@ -446,11 +1257,9 @@ def get_generated_report(impact_layer_uri):
     }
 
     """
-    impact_layer_directory = os.path.split(impact_layer_uri)[0]
-    report_metadata_path = os.path.join(
-        impact_layer_directory, 'output', 'report_metadata.json')
     try:
-        report_metadata = json.load(open(report_metadata_path))
+        report_metadata = json.load(
+            open(report_metadata_path(impact_layer_uri)))
     except IOError:
         return {
             'status': REPORT_METADATA_NOT_EXIST,
@@ -465,12 +1274,31 @@ def get_generated_report(impact_layer_uri):
     }
 
 
-def generate_contour(layer_uri):
+def generate_contour(
+        layer_uri,
+        smoothing_method=NUMPY_SMOOTHING,
+        smoothing_factor=0.5,
+        tile_size=None):
     """Create contour from raster layer_uri to output_uri
 
+    If the contour cache is enabled, the contour of a raster with the same
+    content and parameters is reused. If the same contour is being generated
+    by another worker, it waits for it instead of generating it again.
+
     :param layer_uri: The shakemap raster layer uri.
     :type layer_uri: basestring
 
+    :param smoothing_method: Smoothing method applied to the raster.
+    :type smoothing_method: str
+
+    :param smoothing_factor: Smoothing factor.
+    :type smoothing_factor: float
+
+    :param tile_size: Contour the raster by tiles of this many pixels, with
+        bounded memory. 0 contours the whole raster at once. If None,
+        HEADLESS_CONTOUR_TILE_SIZE is used.
+    :type tile_size: int
+
     :returns: The output layer uri if success
     :rtype: basestring
 
@@ -479,6 +1307,51 @@ def generate_contour(layer_uri):
 
     current_datetime format: 25January2018_09h25-17.597909
     """
+    contour_parameters = {
+        'smoothing_method': smoothing_method,
+        'smoothing_factor': smoothing_factor,
+    }
+    if tile_size is None:
+        tile_size = CONTOUR_TILE_SIZE
+    contour_cache = get_contour_cache()
+    if not contour_cache:
+        return create_contour(layer_uri, contour_parameters, tile_size)
+
+    key = contour_key(
+        layer_uri, dict(contour_parameters, tiled=bool(tile_size)))
+    contour_uri = contour_cache.get(key)
+    if not contour_uri:
+        with contour_cache.generating(key):
+            # It may have been generated while we were waiting
+            contour_uri = contour_cache.get(key)
+            if not contour_uri:
+                contour_uri = create_contour(
+                    layer_uri, contour_parameters, tile_size)
+                if contour_uri:
+                    contour_cache.put(key, contour_uri)
+                contour_cache.collect_garbage()
+                return contour_uri
+    LOGGER.debug('Contour cache hit %s' % key)
+    return contour_uri
+
+
+def create_contour(layer_uri, contour_parameters, tile_size=0):
+    """Create contour from raster layer_uri in a new directory.
+
+    :param layer_uri: The shakemap raster layer uri.
+    :type layer_uri: basestring
+
+    :param contour_parameters: Smoothing parameters of
+        create_smooth_contour.
+    :type contour_parameters: dict
+
+    :param tile_size: Contour the raster by tiles of this many pixels. 0
+        contours the whole raster with create_smooth_contour.
+    :type tile_size: int
+
+    :returns: The output layer uri if success
+    :rtype: basestring
+    """
     # Always create directory
     input_file_name = os.path.basename(layer_uri)
     input_base_name = os.path.splitext(input_file_name)[0]
@@ -496,24 +1369,69 @@ def generate_contour(layer_uri):
             raise
     output_uri = os.path.join(output_directory_path, output_file_name)
 
-    shakemap_raster = load_layer(layer_uri)[0]
-    contour_uri = create_smooth_contour(
-        shakemap_raster, output_file_path=output_uri)
+    with phase_timer.phase('load'):
+        shakemap_raster = load_layer(layer_uri)[0]
+    phase_timer.record_input(layer_uri, shakemap_raster)
+    with phase_timer.phase('contour'):
+        if tile_size:
+            contour_uri = create_tiled_contour(
+                shakemap_raster.source(),
+                output_uri,
+                tile_size=tile_size,
+                workers=CONTOUR_TILE_WORKERS or None,
+                **contour_parameters)
+        else:
+            contour_uri = create_smooth_contour(
+                shakemap_raster,
+                output_file_path=output_uri,
+                **contour_parameters)
     if os.path.exists(contour_uri):
         return contour_uri
     else:
         return None
 
 
-def push_to_geonode(layer_uri):
-    """Only returns true if broker is connected
+def push_to_geonode(
+        layer_uri,
+        geonode_url=None,
+        geonode_user=None,
+        geonode_password=None):
+    """Upload layer to geonode instance.
+
+    The GeoNode session is reused from previous uploads of the worker. If
+    GeoNode does not accept it anymore, it logs in again and retries.
 
-    :return: True
+    Layers of a GeoPackage, such as analysis outputs stored in a single
+    GeoPackage, are exported to a shapefile with their keywords and style
+    before the upload.
+
+    :param layer_uri: The uri to the layer.
+    :type layer_uri: basestring
+
+    :param geonode_url: GeoNode url, default to REALTIME_GEONODE_URL.
+    :type geonode_url: basestring
+
+    :param geonode_user: GeoNode user, default to REALTIME_GEONODE_USER if
+        the url is REALTIME_GEONODE_URL. Required for other urls.
+    :type geonode_user: basestring
+
+    :param geonode_password: GeoNode password, default to
+        REALTIME_GEONODE_PASSWORD if the url is REALTIME_GEONODE_URL.
+        Required for other urls.
+    :type geonode_password: basestring
+
+    :returns: A dictionary of the url of the successfully uploaded layer,
+        with the upload throughput.
+    :rtype: dict
     """
+    if not geonode_url or geonode_url == REALTIME_GEONODE_URL:
+        geonode_url = REALTIME_GEONODE_URL
+        geonode_user = geonode_user or REALTIME_GEONODE_USER
+        geonode_password = geonode_password or REALTIME_GEONODE_PASSWORD
     requirements = {
-        'url': REALTIME_GEONODE_URL,
-        'username': REALTIME_GEONODE_USER,
-        'password': REALTIME_GEONODE_PASSWORD
+        'url': geonode_url,
+        'username': geonode_user,
+        'password': geonode_password
     }
     for key, value in requirements.items():
         if not value:
@@ -524,11 +1442,54 @@ def push_to_geonode(layer_uri):
                 'message': message,
                 'output': None
             }
+    export_directory = None
+    if split_layer_uri(layer_uri)[1]:
+        # GeoNode takes a file per layer
+        export_directory = tempfile.mkdtemp(prefix='export_')
+        try:
+            with phase_timer.phase('export'):
+                layer_uri = export_layer(layer_uri, export_directory)
+        except Exception as e:
+            shutil.rmtree(export_directory)
+            return {
+                'status': GEONODE_UPLOAD_FAILED,
+                'message': e.message,
+                'output': None
+            }
     try:
-        geonode_session = login_user(
-            REALTIME_GEONODE_URL,
-            REALTIME_GEONODE_USER,
-            REALTIME_GEONODE_PASSWORD)
+        return upload_layer_to_geonode(
+            layer_uri, geonode_url, geonode_user, geonode_password)
+    finally:
+        if export_directory:
+            shutil.rmtree(export_directory)
+
+
+def upload_layer_to_geonode(
+        layer_uri, geonode_url, geonode_user, geonode_password):
+    """Upload a file based layer to geonode, see push_to_geonode.
+
+    :param layer_uri: The uri to the layer.
+    :type layer_uri: basestring
+
+    :param geonode_url: GeoNode url.
+    :type geonode_url: basestring
+
+    :param geonode_user: GeoNode user.
+    :type geonode_user: basestring
+
+    :param geonode_password: GeoNode password.
+    :type geonode_password: basestring
+
+    :returns: A dictionary of the url of the successfully uploaded layer,
+        with the upload throughput.
+    :rtype: dict
+    """
+    upload_size = output_sizes(layer_uri) or 0
+    phase_timer.inputs[layer_uri] = {'bytes': upload_size}
+    try:
+        with phase_timer.phase('login'):
+            geonode_session = geonode_sessions.get(
+                geonode_url, geonode_user, geonode_password)
     except Exception as e:
         return {
             'status': GEONODE_UPLOAD_FAILED,
@@ -536,11 +1497,28 @@ def push_to_geonode(layer_uri):
             'output': None
         }
     try:
-        result = upload(REALTIME_GEONODE_URL, geonode_session, layer_uri)
+        start_time = time.time()
+        with phase_timer.phase('upload'):
+            try:
+                result = upload(geonode_url, geonode_session, layer_uri)
+            except Exception:
+                if geonode_sessions.is_logged_in(
+                        geonode_url, geonode_session):
+                    raise
+                LOGGER.info('GeoNode session expired, login again')
+                geonode_session = geonode_sessions.get(
+                    geonode_url, geonode_user, geonode_password, renew=True)
+                result = upload(geonode_url, geonode_session, layer_uri)
+        elapsed = time.time() - start_time
         return {
             'status': GEONODE_UPLOAD_SUCCESS,
             'message': 'Success',
-            'output': result
+            'output': result,
+            'throughput': {
+                'bytes': upload_size,
+                'seconds': elapsed,
+                'bytes_per_second': upload_size / elapsed if elapsed else 0,
+            }
         }
     except Exception as e:
         return {
@@ -548,3 +1526,229 @@ def push_to_geonode(layer_uri):
             'message': e.message,
             'output': None
         }
+
+
+def inasafe_event_pipeline(
+        hazard_layer_uri,
+        exposure_layer_uri,
+        aggregation_layer_uri=None,
+        crs=None,
+        IFACE=None,
+        locale=None,
+        smoothing_method=NUMPY_SMOOTHING,
+        smoothing_factor=0.5,
+        tile_size=None,
+        custom_report_template_uri=None,
+        custom_layer_order=None,
+        custom_legend_layer=None,
+        use_template_extent=False,
+        report_keys=None,
+        push_layer_keys=None,
+        output_geopackage=False,
+        stage_callback=None):
+    """Process a hazard event: contour, analysis, report and GeoNode push.
+
+    It does the work of generate_contour, inasafe_analysis, generate_report
+    and push_to_geonode in this process. The report is generated from the
+    impact function of the analysis, so its layers and metadata are not
+    read again from disk. It stops at the first failing stage.
+
+    Stages are 'contour', 'analysis', 'report', 'pack' if output_geopackage
+    is True, and 'push' if push_layer_keys is not empty. With
+    output_geopackage, the output layers are packed after the report, which
+    uses their files, and the 'pack' stage gives the GeoPackage uris.
+
+    :param hazard_layer_uri: Uri to the shakemap raster hazard layer.
+    :type hazard_layer_uri: basestring
+
+    :param exposure_layer_uri: Uri to exposure layer.
+    :type exposure_layer_uri: basestring
+
+    :param aggregation_layer_uri: Uri to aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param crs: CRS for the analysis (if the aggregation is not set).
+    :param crs: QgsCoordinateReferenceSystem
+
+    :param locale: Locale of the reports.
+    :type locale: str
+
+    :param smoothing_method: Smoothing method of the contour.
+    :type smoothing_method: str
+
+    :param smoothing_factor: Smoothing factor of the contour.
+    :type smoothing_factor: float
+
+    :param tile_size: Tile size of the contour, see generate_contour.
+    :type tile_size: int
+
+    :param custom_report_template_uri: The uri to report template.
+    :type custom_report_template_uri: basestring
+
+    :param custom_layer_order: List of layers uri for map report layers order.
+    :type custom_layer_order: list
+
+    :param report_keys: Keys of the reports to generate, from
+        default_report_keys(). If None, all reports are generated.
+    :type report_keys: list
+
+    :param push_layer_keys: Keys of the analysis output layers to upload to
+        REALTIME_GEONODE_URL, with the contour layer, such as
+        ['exposure_summary']. If empty, nothing is uploaded.
+    :type push_layer_keys: list
+
+    :param output_geopackage: Store the output layers in a single
+        GeoPackage.
+    :type output_geopackage: bool
+
+    :param stage_callback: Function called with the stage name and the
+        pipeline result so far, after each stage.
+    :type stage_callback: function
+
+    :returns: A dictionary of the result of each stage, in the format of
+        the task doing it, with status, message and the latency of each
+        stage and of the whole pipeline in seconds.
+    :rtype: dict
+
+    The output format will be:
+    output = {
+        'status': 0,
+        'message': '',
+        'output': {
+            'contour': 'contour_layer_path',
+            'analysis': {'status': 0, 'message': '', 'output': {}},
+            'report': {'status': 0, 'message': '', 'output': {}},
+            'push': {
+                'contour': {'status': 0, 'message': '', 'output': {}},
+                'exposure_summary': {
+                    'status': 0, 'message': '', 'output': {}},
+            },
+        },
+        'latency': {
+            'contour': 1.2,
+            'analysis': 10.5,
+            'report': 20.1,
+            'push': 3.2,
+            'total': 35.0,
+        }
+    }
+    """
+    start_time = time.time()
+    retval = {
+        'status': EVENT_PIPELINE_SUCCESS,
+        'message': '',
+        'output': {},
+        'latency': {}
+    }
+
+    def stage_failed(stage, result, stage_start, error=None):
+        """Record the result of a stage and report it.
+
+        :return: True if the stage failed.
+        """
+        retval['output'][stage] = result
+        retval['latency'][stage] = time.time() - stage_start
+        retval['latency']['total'] = time.time() - start_time
+        if error:
+            LOGGER.debug('Event pipeline %s failed: %s' % (stage, error))
+            retval['status'] = EVENT_PIPELINE_FAILED
+            retval['message'] = error
+        if stage_callback:
+            stage_callback(stage, retval)
+        return bool(error)
+
+    stage_start = time.time()
+    contour_uri = generate_contour(
+        hazard_layer_uri, smoothing_method, smoothing_factor, tile_size)
+    error = None
+    if not contour_uri:
+        error = 'Can not create contour of %s.' % hazard_layer_uri
+    if stage_failed('contour', contour_uri, stage_start, error):
+        return retval
+
+    # Clean up layer registry before using
+    # In case previous task exited prematurely before cleanup
+    layer_registry = QgsMapLayerRegistry.instance()
+    layer_registry.removeAllMapLayers()
+
+    stage_start = time.time()
+    with phase_timer.phase('load'):
+        hazard_layer = load_analysis_layer(hazard_layer_uri)[0]
+        exposure_layer = load_analysis_layer(exposure_layer_uri)[0]
+        aggregation_layer = None
+        if aggregation_layer_uri:
+            aggregation_layer = load_analysis_layer(aggregation_layer_uri)[0]
+    analysis_result, impact_function = execute_impact_function(
+        hazard_layer, exposure_layer, aggregation_layer, crs)
+    error = None
+    if analysis_result['status'] != ANALYSIS_SUCCESS:
+        error = analysis_result['message']
+        layer_registry.removeAllMapLayers()
+    if stage_failed('analysis', analysis_result, stage_start, error):
+        return retval
+
+    stage_start = time.time()
+    output = analysis_result['output']
+    impact_layer_uri = output.get(layer_purpose_exposure_summary['key'])
+    if impact_layer_uri:
+        report_result = generate_report(
+            impact_layer_uri,
+            custom_report_template_uri,
+            custom_layer_order,
+            custom_legend_layer,
+            use_template_extent,
+            IFACE,
+            report_keys=report_keys,
+            locale=locale,
+            incremental=False,
+            impact_function=impact_function)
+    else:
+        layer_registry.removeAllMapLayers()
+        report_result = {
+            'status': ImpactReport.REPORT_GENERATION_FAILED,
+            'message': 'The report stage needs the %s layer, the analysis '
+                       'has none.' % layer_purpose_exposure_summary['key'],
+            'output': {}
+        }
+    # The report cleaned up the layer registry, impact layers are deleted
+    impact_function = None
+    error = None
+    if report_result['status'] != ImpactReport.REPORT_GENERATION_SUCCESS:
+        error = report_result['message']
+    if stage_failed('report', report_result, stage_start, error):
+        return retval
+
+    if output_geopackage:
+        stage_start = time.time()
+        error = None
+        try:
+            with phase_timer.phase('pack'):
+                output = pack_analysis_outputs(output)
+        except Exception as e:
+            error = e.message
+        if stage_failed('pack', output, stage_start, error):
+            return retval
+
+    if push_layer_keys:
+        stage_start = time.time()
+        push_results = {}
+        error = None
+        layer_uris = [('contour', contour_uri)] + [
+            (key, output.get(key)) for key in push_layer_keys]
+        for key, layer_uri in layer_uris:
+            if layer_uri:
+                push_results[key] = push_to_geonode(layer_uri)
+            else:
+                push_results[key] = {
+                    'status': GEONODE_UPLOAD_FAILED,
+                    'message': 'The analysis has no %s layer.' % key,
+                    'output': None
+                }
+            if push_results[key]['status'] != GEONODE_UPLOAD_SUCCESS:
+                error = push_results[key]['message']
+                break
+        stage_failed('push', push_results, stage_start, error)
+
+    LOGGER.debug('Event pipeline done in %.2f s' % (
+        time.time() - start_time))
+    return retval
@@ -1,9 +1,29 @@
 # coding=utf-8
 """Task for InaSAFE Headless."""
 
-from headless.celery_app import app, start_inasafe
-from headless.tasks import inasafe_analysis
-from headless.utils import get_headless_logger
+from celery import chord
+
+from headless.celery_app import (
+    app, start_inasafe, init_info, headless_stats)
+from headless.tasks import (
+    inasafe_analysis, output_container, partitioned_analysis)
+from headless.tasks.output_retention import (
+    get_output_retention, outputs_in_use)
+from headless.tasks.result_cache import (
+    analysis_key,
+    get_result_cache,
+    output_paths,
+    RESULT_CACHE_HIT,
+    RESULT_CACHE_MISS)
+from headless import settings as headless_settings
+from headless.serialization import parse_crs, serializable_result
+from headless.utils import get_headless_logger, phase_timer
+from safe.definitions.constants import (
+    ANALYSIS_SUCCESS,
+    ANALYSIS_FAILED_BAD_CODE,
+    ANALYSIS_FAILED_BAD_INPUT,
+    NUMPY_SMOOTHING)
+from safe.definitions.layer_purposes import layer_purpose_analysis_impacted
 
 __copyright__ = "Copyright 2018, The InaSAFE Project"
 __license__ = "GPL version 3"
@@ -13,6 +33,134 @@ __revision__ = '$Format:%H$'
 LOGGER = get_headless_logger()
 
 
+def add_metrics(retval):
+    """Add timing and memory metrics of the current task to its result.
+
+    Metrics are always logged. They are added to the result under the
+    'metrics' key if the result is a dictionary.
+
+    :param retval: The task result.
+    :type retval: dict, basestring
+
+    :returns: The same task result.
+    :rtype: dict, basestring
+
+    The metrics format will be:
+    metrics = {
+        'phases': {
+            'init': {'wall': 0.1, 'cpu': 0.1},
+            'load': {'wall': 0.5, 'cpu': 0.4},
+            'prepare': {'wall': 1.2, 'cpu': 1.1},
+            'run': {'wall': 10.2, 'cpu': 9.8},
+        },
+        'peak_rss': 512000,
+        'inputs': {
+            'input_layer_path_1': {'features': 1000},
+            'input_layer_path_2': {'pixels': 250000},
+        },
+        'outputs': {
+            'output_layer_key_1': 1048576,
+        }
+    }
+    """
+    if not headless_settings.TASK_METRICS_ENABLED:
+        return retval
+    if isinstance(retval, dict):
+        metrics = phase_timer.metrics(retval.get('output'))
+        retval['metrics'] = metrics
+    else:
+        metrics = phase_timer.metrics(retval)
+    LOGGER.info('Task metrics: %s' % metrics)
+    return retval
+
+
+def task_result(retval):
+    """Finalize a task result before it is sent to the result backend.
+
+    It adds init info and metrics, and converts the result to plain types
+    if the result serializer is not pickle.
+
+    :param retval: The task result.
+    :type retval: dict, basestring
+
+    :returns: The finalized task result.
+    :rtype: dict, basestring
+    """
+    retval = add_metrics(add_init_info(retval))
+    return serializable_result(retval, app.conf.result_serializer)
+
+
+def run_cached_analysis(analysis, cache_key_args, *args):
+    """Run an analysis function through the result cache, if enabled.
+
+    :param analysis: The analysis function to call on cache miss.
+    :type analysis: function
+
+    :param cache_key_args: Arguments of analysis_key for this analysis.
+    :type cache_key_args: tuple
+
+    :param args: Arguments of the analysis function.
+
+    :returns: The analysis result. If the cache is enabled, the 'cache' key
+        tells if it is a cache hit or miss.
+    :rtype: dict
+    """
+    result_cache = get_result_cache()
+    if not result_cache:
+        return analysis(*args)
+
+    key = analysis_key(*cache_key_args)
+    retval = result_cache.get(key)
+    if retval:
+        LOGGER.debug('Analysis result cache hit %s' % key)
+        retval['cache'] = RESULT_CACHE_HIT
+        return retval
+
+    retval = analysis(*args)
+    if retval['status'] == ANALYSIS_SUCCESS:
+        result_cache.put(key, retval)
+    retval['cache'] = RESULT_CACHE_MISS
+    return retval
+
+
+def invalid_crs_result(error, status=ANALYSIS_FAILED_BAD_INPUT):
+    """Build the result of a task given an invalid CRS.
+
+    Tasks are retried on exceptions, so an invalid CRS gives a failed result
+    instead of raising.
+
+    :param error: The error raised by parse_crs.
+    :type error: ValueError
+
+    :param status: Status of the result.
+    :type status: int
+
+    :returns: The task result.
+    :rtype: dict
+    """
+    LOGGER.debug(error.message)
+    return {
+        'status': status,
+        'message': error.message,
+        'output': {}
+    }
+
+
+def add_init_info(retval):
+    """Add InaSAFE initialization timing to a task result.
+
+    :param retval: The task result with status, message and output.
+    :type retval: dict
+
+    :returns: The same task result with an additional 'init' key containing
+        the init mode (warm or cold) and its elapsed time.
+    :rtype: dict
+    """
+    if isinstance(retval, dict):
+        retval['init'] = init_info()
+    return retval
+
+
 @app.task(name='inasafe.headless.tasks.get_keywords', queue='inasafe-headless')
 def get_keywords(layer_uri, keyword=None):
     """Get keywords from a layer.
@@ -32,21 +180,32 @@ def get_keywords(layer_uri, keyword=None):
 
     reload(inasafe_analysis)
     metadata = inasafe_analysis.get_keywords(layer_uri, keyword)
-    return metadata
+    return serializable_result(metadata, app.conf.result_serializer)
 
 
 @app.task(
     name='inasafe.headless.tasks.run_analysis', queue='inasafe-headless',
-    autoretry_for=(Exception,))
+    autoretry_for=(Exception,), bind=True)
 def run_analysis(
+        self,
         hazard_layer_uri,
         exposure_layer_uri,
         aggregation_layer_uri=None,
         crs=None,
-        locale='en_US'
+        locale='en_US',
+        partitions=0,
+        partition_field=None,
+        output_geopackage=None
 ):
     """Run analysis.
 
+    If partitions is more than 1, the aggregation layer is split into
+    spatial partitions and each partition is analysed by a separate
+    run_analysis subtask, so several analysis workers can run them at the
+    same time. This task is then replaced by the subtasks and a
+    merge_partitioned_analysis task, which merges the outputs into the same
+    layers as a single analysis.
+
     :param hazard_layer_uri: Uri to hazard layer.
     :type hazard_layer_uri: basestring
 
@@ -56,8 +215,24 @@ def run_analysis(
     :param aggregation_layer_uri: Uri to aggregation layer.
     :type aggregation_layer_uri: basestring
 
-    :param crs: CRS for the analysis (if the aggregation is not set).
-    :param crs: QgsCoordinateReferenceSystem
+    :param crs: CRS for the analysis (if the aggregation is not set). It can
+        also be an EPSG code, an authority id such as 'EPSG:4326' or WKT.
+    :param crs: QgsCoordinateReferenceSystem, int, basestring
+
+    :param partitions: Number of partitions of the aggregation layer
+        analysed in parallel. 0 or 1 analyses it at once.
+    :type partitions: int
+
+    :param partition_field: Field of the aggregation layer grouping the
+        areas in partitions, such as a province code. If None, areas are
+        grouped by grid cells.
+    :type partition_field: basestring
+
+    :param output_geopackage: Store all output layers in a single
+        GeoPackage, the output uris then point into it, such as
+        path.gpkg|layername=name. Default to
+        HEADLESS_OUTPUT_GEOPACKAGE_ENABLED.
+    :type output_geopackage: bool
 
     :returns: A dictionary of output's layer key and Uri with status and
         message.
@@ -74,28 +249,235 @@ def run_analysis(
     }
     """
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    start_inasafe(locale)
+
+    try:
+        analysis_crs = parse_crs(crs)
+    except ValueError as e:
+        return task_result(invalid_crs_result(e))
+
+    if output_geopackage is None:
+        output_geopackage = headless_settings.OUTPUT_GEOPACKAGE_ENABLED
+    if partitions > 1 and aggregation_layer_uri:
+        partition_uris = partitioned_analysis.partition_aggregation(
+            aggregation_layer_uri, partitions, partition_field)
+        if len(partition_uris) > 1:
+            workflow = chord(
+                (run_analysis.s(
+                    hazard_layer_uri,
+                    exposure_layer_uri,
+                    partition_uri,
+                    crs,
+                    locale,
+                    output_geopackage=False)
+                 for partition_uri in partition_uris),
+                merge_partitioned_analysis.s(
+                    aggregation_layer_uri,
+                    partition_uris,
+                    locale,
+                    output_geopackage))
+            if self.request.is_eager:
+                return workflow.apply().get()
+            return self.replace(workflow)
+
+    crs = analysis_crs
+    reload(inasafe_analysis)
+    with outputs_in_use(
+            [hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri]):
+        retval = run_cached_analysis(
+            inasafe_analysis.inasafe_analysis,
+            (hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri,
+             crs, locale, output_geopackage),
+            hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri, crs,
+            output_geopackage)
+
+    return task_result(retval)
+
+
+@app.task(
+    name='inasafe.headless.tasks.run_exposure_analysis',
+    queue='inasafe-headless', autoretry_for=(Exception,))
+def run_exposure_analysis(
+        hazard_layer_uri,
+        exposure_layer_uri,
+        aggregation_layer_uri=None,
+        crs=None,
+        locale='en_US'):
+    """Analyse one exposure of a multi exposure analysis.
+
+    It is a subtask of run_multi_exposure_analysis in parallel mode. The
+    impact function has the same settings as the one of the exposure in
+    MultiExposureImpactFunction, so merge_multi_exposure_analysis can use
+    its outputs instead.
+
+    The parameters and the output format are the same as run_analysis.
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     start_inasafe(locale)
 
+    try:
+        crs = parse_crs(crs)
+    except ValueError as e:
+        return task_result(invalid_crs_result(e))
     reload(inasafe_analysis)
-    retval = inasafe_analysis.inasafe_analysis(
-        hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri, crs)
+    with outputs_in_use(
+            [hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri]):
+        retval = run_cached_analysis(
+            inasafe_analysis.inasafe_analysis,
+            (hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri,
+             crs, locale, False, False),
+            hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri, crs,
+            False, False)
+
+    return task_result(retval)
+
+
+@app.task(
+    name='inasafe.headless.tasks.merge_partitioned_analysis',
+    queue='inasafe-headless')
+def merge_partitioned_analysis(
+        results,
+        aggregation_layer_uri,
+        partition_uris,
+        locale='en_US',
+        output_geopackage=False):
+    """Merge the outputs of the partitions of an analysis.
+
+    It is the final step of run_analysis with partitions.
+
+    :param results: List of run_analysis results, in the same order as the
+        partitions.
+    :type results: list
+
+    :param aggregation_layer_uri: Uri to the full aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param partition_uris: Uris of the partition aggregation layers.
+    :type partition_uris: list
+
+    :param output_geopackage: Store the merged layers in a single
+        GeoPackage.
+    :type output_geopackage: bool
+
+    :returns: The same output as run_analysis.
+    :rtype: dict
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    start_inasafe(locale)
 
+    failed = [result for result in results
+              if result['status'] != ANALYSIS_SUCCESS]
+    if failed:
+        retval = {
+            'status': failed[0]['status'],
+            'message': '%d of %d partitions failed: %s' % (
+                len(failed), len(results), failed[0]['message']),
+            'output': {}
+        }
+    else:
+        layer_uris = sum(
+            (output_paths(result['output']) for result in results),
+            [aggregation_layer_uri] + partition_uris)
+        try:
+            with outputs_in_use(layer_uris):
+                with phase_timer.phase('merge'):
+                    output = partitioned_analysis.merge_partition_outputs(
+                        results, aggregation_layer_uri, partition_uris)
+                if output_geopackage:
+                    with phase_timer.phase('pack'):
+                        output = output_container.pack_analysis_outputs(
+                            output)
+            retval = {
+                'status': ANALYSIS_SUCCESS,
+                'message': '',
+                'output': output
+            }
+        except Exception as e:
+            LOGGER.exception(e)
+            retval = {
+                'status': ANALYSIS_FAILED_BAD_CODE,
+                'message': '%s' % e,
+                'output': {}
+            }
+
+    retval = task_result(retval)
+    if 'metrics' in retval:
+        retval['metrics']['subtasks'] = [
+            result.get('metrics') for result in results]
     return retval
 
 
 @app.task(
-    name='inasafe.headless.tasks.run_multi_exposure_analysis',
+    name='inasafe.headless.tasks.run_analysis_batch',
     queue='inasafe-headless',
     autoretry_for=(Exception,))
+def run_analysis_batch(hazard_layer_uri, jobs, locale='en_US'):
+    """Run analysis of one hazard against many exposure and aggregation.
+
+    InaSAFE is initialized and the hazard is loaded once for all jobs. A
+    failing job doesn't stop the other jobs.
+
+    :param hazard_layer_uri: Uri to hazard layer.
+    :type hazard_layer_uri: basestring
+
+    :param jobs: List of (exposure_layer_uri, aggregation_layer_uri, crs).
+        aggregation_layer_uri and crs are optional and can be None.
+    :type jobs: list
+
+    :returns: A dictionary with status, message and the list of job results,
+        in the same order as the jobs.
+    :rtype: dict
+
+    The output format will be:
+    output = {
+        'status': 0,
+        'message': '',
+        'output': [
+            {
+                'status': 0,
+                'message': '',
+                'output': {
+                    'output_layer_key_1': 'output_layer_path_1',
+                    'output_layer_key_2': 'output_layer_path_2',
+                }
+            },
+        ]
+    }
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    start_inasafe(locale)
+
+    reload(inasafe_analysis)
+    retval = inasafe_analysis.inasafe_batch_analysis(hazard_layer_uri, jobs)
+
+    return task_result(retval)
+
+
+@app.task(
+    name='inasafe.headless.tasks.run_multi_exposure_analysis',
+    queue='inasafe-headless',
+    autoretry_for=(Exception,), bind=True)
 def run_multi_exposure_analysis(
+        self,
         hazard_layer_uri,
         exposure_layer_uris,
         aggregation_layer_uri=None,
         crs=None,
-        locale='en_US'
+        locale='en_US',
+        parallel=False,
+        output_geopackage=None
 ):
     """Run analysis for multi exposure.
 
+    If parallel is True, each exposure is analysed by a separate
+    run_exposure_analysis subtask, so several analysis workers can run them
+    at the same time. This task is then replaced by the subtasks and a
+    merge_multi_exposure_analysis task, which gives the same output.
+
     :param hazard_layer_uri: Uri to hazard layer.
     :type hazard_layer_uri: basestring
 
@@ -105,8 +487,17 @@ def run_multi_exposure_analysis(
     :param aggregation_layer_uri: Uri to aggregation layer.
     :type aggregation_layer_uri: basestring
 
-    :param crs: CRS for the analysis (if the aggregation is not set).
-    :param crs: QgsCoordinateReferenceSystem
+    :param crs: CRS for the analysis (if the aggregation is not set). It can
+        also be an EPSG code, an authority id such as 'EPSG:4326' or WKT.
+    :param crs: QgsCoordinateReferenceSystem, int, basestring
+
+    :param parallel: Analyse each exposure in a parallel subtask.
+    :type parallel: bool
+
+    :param output_geopackage: Store all output layers, including those of
+        each exposure, in a single GeoPackage. Default to
+        HEADLESS_OUTPUT_GEOPACKAGE_ENABLED.
+    :type output_geopackage: bool
 
     :returns: A dictionary of output's layer key and Uri with status and
         message.
@@ -132,28 +523,131 @@ def run_multi_exposure_analysis(
         }
     }
     """
+    if output_geopackage is None:
+        output_geopackage = headless_settings.OUTPUT_GEOPACKAGE_ENABLED
+    if parallel:
+        try:
+            parse_crs(crs)
+        except ValueError as e:
+            return task_result(invalid_crs_result(e))
+        workflow = chord(
+            (run_exposure_analysis.s(
+                hazard_layer_uri,
+                exposure_layer_uri,
+                aggregation_layer_uri,
+                crs,
+                locale)
+             for exposure_layer_uri in exposure_layer_uris),
+            merge_multi_exposure_analysis.s(
+                hazard_layer_uri,
+                exposure_layer_uris,
+                aggregation_layer_uri,
+                crs,
+                locale,
+                output_geopackage))
+        if self.request.is_eager:
+            return workflow.apply().get()
+        return self.replace(workflow)
+
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     start_inasafe(locale)
 
+    try:
+        crs = parse_crs(crs)
+    except ValueError as e:
+        return task_result(invalid_crs_result(e))
     reload(inasafe_analysis)
-    retval = inasafe_analysis.inasafe_multi_exposure_analysis(
-        hazard_layer_uri, exposure_layer_uris, aggregation_layer_uri, crs)
+    with outputs_in_use(
+            [hazard_layer_uri, aggregation_layer_uri] + exposure_layer_uris):
+        retval = run_cached_analysis(
+            inasafe_analysis.inasafe_multi_exposure_analysis,
+            (hazard_layer_uri, exposure_layer_uris, aggregation_layer_uri,
+             crs, locale, output_geopackage),
+            hazard_layer_uri, exposure_layer_uris, aggregation_layer_uri, crs,
+            None, output_geopackage)
+
+    return task_result(retval)
+
 
+@app.task(
+    name='inasafe.headless.tasks.merge_multi_exposure_analysis',
+    queue='inasafe-headless',
+    autoretry_for=(Exception,))
+def merge_multi_exposure_analysis(
+        results,
+        hazard_layer_uri,
+        exposure_layer_uris,
+        aggregation_layer_uri=None,
+        crs=None,
+        locale='en_US',
+        output_geopackage=False):
+    """Merge the single exposure analysis of run_exposure_analysis subtasks.
+
+    It is the final step of run_multi_exposure_analysis in parallel mode.
+    The multi exposure analysis loads the outputs of the subtasks instead of
+    analysing each exposure again. An exposure whose subtask failed is
+    analysed here.
+
+    :param results: List of run_exposure_analysis results, in the same
+        order as the exposures.
+    :type results: list
+
+    The other parameters and the output format are the same as
+    run_multi_exposure_analysis.
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    start_inasafe(locale)
+
+    impact_layer_uris = [
+        result['output'][layer_purpose_analysis_impacted['key']]
+        for result in results if result['status'] == ANALYSIS_SUCCESS]
+
+    try:
+        crs = parse_crs(crs)
+    except ValueError as e:
+        return task_result(invalid_crs_result(e))
+    reload(inasafe_analysis)
+    layer_uris = sum(
+        (output_paths(result['output']) for result in results
+         if result['status'] == ANALYSIS_SUCCESS),
+        [hazard_layer_uri, aggregation_layer_uri] + exposure_layer_uris)
+    with outputs_in_use(layer_uris):
+        retval = run_cached_analysis(
+            inasafe_analysis.inasafe_multi_exposure_analysis,
+            (hazard_layer_uri, exposure_layer_uris, aggregation_layer_uri,
+             crs, locale, output_geopackage),
+            hazard_layer_uri, exposure_layer_uris, aggregation_layer_uri, crs,
+            impact_layer_uris, output_geopackage)
+    retval = task_result(retval)
+    if 'metrics' in retval:
+        retval['metrics']['subtasks'] = [
+            result.get('metrics') for result in results]
     return retval
 
 
 @app.task(
     name='inasafe.headless.tasks.generate_report', queue='inasafe-headless',
-    autoretry_for=(Exception,))
+    autoretry_for=(Exception,), bind=True)
 def generate_report(
+        self,
         impact_layer_uri,
         custom_report_template_uri=None,
         custom_layer_order=None,
         custom_legend_layer=None,
         use_template_extent=False,
-        locale='en_US'):
+        locale='en_US',
+        parallel=False,
+        incremental=True,
+        components=None):
     """Generate report based on impact layer uri.
 
+    If parallel is True, each report is rendered by a separate
+    render_report_components subtask, so several reporting workers can
+    render them at the same time. This task is then replaced by the
+    subtasks and a merge_report task, which gives the same output.
+
     :param impact_layer_uri: The uri to impact layer (one of them).
     :type impact_layer_uri: basestring
 
@@ -163,6 +657,18 @@ def generate_report(
     :param custom_layer_order: List of layers uri for map report layers order.
     :type custom_layer_order: list
 
+    :param parallel: Render reports in parallel subtasks.
+    :type parallel: bool
+
+    :param incremental: Only render reports which are missing or out of
+        date. Up to date reports are returned without rendering them again.
+    :type incremental: bool
+
+    :param components: Keys of the report components to render, for
+        instance ['impact-report-pdf'] to only get the pdf impact report.
+        If None, all components are rendered.
+    :type components: list
+
     :returns: A dictionary of output's report key and Uri with status and
         message.
     :rtype: dict
@@ -192,19 +698,124 @@ def generate_report(
     }
 
     """
+    if parallel:
+        report_arguments = (
+            impact_layer_uri,
+            custom_report_template_uri,
+            custom_layer_order,
+            custom_legend_layer,
+            use_template_extent,
+            locale,
+            incremental,
+            components)
+        workflow = chord(
+            (render_report_components.s([key], *report_arguments)
+             for key in inasafe_analysis.default_report_keys(components)),
+            merge_report.s(impact_layer_uri))
+        if self.request.is_eager:
+            return workflow.apply().get()
+        return self.replace(workflow)
+
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     _, IFACE = start_inasafe(locale)
 
     reload(inasafe_analysis)
-    retval = inasafe_analysis.generate_report(
+    layer_uris = (
+        [impact_layer_uri]
+        + inasafe_analysis.provenance_layer_uris(impact_layer_uri)
+        + (custom_layer_order or [])
+        + (custom_legend_layer or []))
+    with outputs_in_use(layer_uris):
+        retval = inasafe_analysis.generate_report(
+            impact_layer_uri,
+            custom_report_template_uri,
+            custom_layer_order,
+            custom_legend_layer,
+            use_template_extent,
+            IFACE,
+            locale=locale,
+            incremental=incremental,
+            components=components)
+
+    return task_result(retval)
+
+
+@app.task(
+    name='inasafe.headless.tasks.render_report_components',
+    queue='inasafe-headless-reporting',
+    autoretry_for=(Exception,))
+def render_report_components(
+        report_keys,
         impact_layer_uri,
-        custom_report_template_uri,
-        custom_layer_order,
-        custom_legend_layer,
-        use_template_extent,
-        IFACE)
+        custom_report_template_uri=None,
+        custom_layer_order=None,
+        custom_legend_layer=None,
+        use_template_extent=False,
+        locale='en_US',
+        incremental=True,
+        components=None):
+    """Render some of the reports of an impact layer.
 
-    return retval
+    It is a subtask of generate_report in parallel mode.
+
+    :param report_keys: Keys of the reports to render.
+    :type report_keys: list
+
+    The other parameters and the output format are the same as
+    generate_report, but the output only has the rendered reports.
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    _, IFACE = start_inasafe(locale)
+
+    reload(inasafe_analysis)
+    layer_uris = (
+        [impact_layer_uri]
+        + inasafe_analysis.provenance_layer_uris(impact_layer_uri)
+        + (custom_layer_order or [])
+        + (custom_legend_layer or []))
+    with outputs_in_use(layer_uris):
+        retval = inasafe_analysis.generate_report(
+            impact_layer_uri,
+            custom_report_template_uri,
+            custom_layer_order,
+            custom_legend_layer,
+            use_template_extent,
+            IFACE,
+            report_keys,
+            locale,
+            incremental,
+            components)
+
+    return task_result(retval)
+
+
+@app.task(
+    name='inasafe.headless.tasks.merge_report',
+    queue='inasafe-headless-reporting')
+def merge_report(results, impact_layer_uri):
+    """Merge the outputs of render_report_components subtasks.
+
+    It is the final step of generate_report in parallel mode. It writes the
+    merged report metadata file.
+
+    :param results: List of render_report_components results.
+    :type results: list
+
+    :param impact_layer_uri: The uri to impact layer (one of them).
+    :type impact_layer_uri: basestring
+
+    :returns: The same output as generate_report.
+    :rtype: dict
+    """
+    with outputs_in_use([impact_layer_uri]):
+        retval = inasafe_analysis.merge_report_results(
+            results, impact_layer_uri)
+    retval['metrics'] = {
+        'subtasks': [result.get('metrics') for result in results]
+    }
+    return serializable_result(retval, app.conf.result_serializer)
 
 
 @app.task(
@@ -246,21 +857,41 @@ def get_generated_report(impact_layer_uri):
     }
     """
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     start_inasafe()
 
     reload(inasafe_analysis)
-    result = inasafe_analysis.get_generated_report(impact_layer_uri)
-    return result
+    with outputs_in_use([impact_layer_uri]):
+        result = inasafe_analysis.get_generated_report(impact_layer_uri)
+    return task_result(result)
 
 
 @app.task(
     name='inasafe.headless.tasks.generate_contour', queue='inasafe-headless')
-def generate_contour(layer_uri):
+def generate_contour(
+        layer_uri,
+        smoothing_method=NUMPY_SMOOTHING,
+        smoothing_factor=0.5,
+        tile_size=None):
     """Create contour from raster layer_uri to output_uri
 
+    Contours of identical rasters and parameters are reused when
+    HEADLESS_CONTOUR_CACHE_ENABLED is set.
+
     :param layer_uri: The shakemap raster layer uri.
     :type layer_uri: basestring
 
+    :param smoothing_method: Smoothing method applied to the raster.
+    :type smoothing_method: str
+
+    :param smoothing_factor: Smoothing factor.
+    :type smoothing_factor: float
+
+    :param tile_size: Contour the raster by tiles of this many pixels, to
+        bound memory on large rasters. 0 contours the whole raster at once.
+        If None, HEADLESS_CONTOUR_TILE_SIZE is used.
+    :type tile_size: int
+
     :returns: The output layer uri if success
     :rtype: basestring
 
@@ -270,11 +901,14 @@ def generate_contour(layer_uri):
     current_datetime format: 25January2018_09h25-17.597909
     """
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     start_inasafe()
 
     reload(inasafe_analysis)
-    result = inasafe_analysis.generate_contour(layer_uri)
-    return result
+    with outputs_in_use([layer_uri]):
+        result = inasafe_analysis.generate_contour(
+            layer_uri, smoothing_method, smoothing_factor, tile_size)
+    return task_result(result)
 
 
 @app.task(
@@ -288,15 +922,74 @@ def check_broker_connection():
     return True
 
 
+@app.task(
+    name='inasafe.headless.tasks.get_worker_stats',
+    queue='inasafe-headless')
+def get_worker_stats():
+    """Get statistics of the worker process caches.
+
+    Statistics are kept per worker process, so it returns the statistics of
+    the process which executes this task. Output retention statistics are
+    shared by all workers using the same output directory.
+
+    :returns: A dictionary of statistics.
+    :rtype: dict
+
+    The output format will be:
+    output = {
+        'init': {
+            'mode': 'warm',
+            'elapsed': 0.01
+        },
+        'metadata_cache': {
+            'size': 10,
+            'max_size': 512,
+            'hits': 100,
+            'misses': 10
+        },
+        'output_retention': {
+            'directories': 120,
+            'size': 1073741824,
+            'evicted': 30,
+            'evicted_bytes': 268435456,
+            'skipped_in_use': 1,
+        }
+    }
+    """
+    stats = headless_stats()
+    output_retention = get_output_retention()
+    if output_retention:
+        stats['output_retention'] = output_retention.stats()
+    return stats
+
+
 @app.task(
     name='inasafe.headless.tasks.push_to_geonode',
     queue='inasafe-headless-geonode')
-def push_to_geonode(layer_uri):
+def push_to_geonode(
+        layer_uri,
+        geonode_url=None,
+        geonode_user=None,
+        geonode_password=None):
     """Upload layer to geonode instance.
 
+    The worker reuses its GeoNode login session between uploads.
+
     :param layer_uri: The uri to the layer.
     :type layer_uri: basestring
 
+    :param geonode_url: GeoNode url, default to REALTIME_GEONODE_URL.
+    :type geonode_url: basestring
+
+    :param geonode_user: GeoNode user, default to REALTIME_GEONODE_USER if
+        the url is REALTIME_GEONODE_URL. Required for other urls.
+    :type geonode_user: basestring
+
+    :param geonode_password: GeoNode password, default to
+        REALTIME_GEONODE_PASSWORD if the url is REALTIME_GEONODE_URL.
+        Required for other urls.
+    :type geonode_password: basestring
+
     :returns: A dictionary of the url of the successfully uploaded layer.
     :rtype: dict
 
@@ -308,11 +1001,168 @@ def push_to_geonode(layer_uri):
             'uri': '/layer/layer_name',
             'full_uri': 'http://realtimegeonode.com/layer/layer_name'
         },
+        'throughput': {
+            'bytes': 1048576,
+            'seconds': 2.0,
+            'bytes_per_second': 524288.0,
+        },
     }
     """
     # Initialize QGIS and InaSAFE
+    phase_timer.reset()
     start_inasafe()
 
     reload(inasafe_analysis)
-    result = inasafe_analysis.push_to_geonode(layer_uri)
-    return result
+    with outputs_in_use([layer_uri]):
+        result = inasafe_analysis.push_to_geonode(
+            layer_uri, geonode_url, geonode_user, geonode_password)
+    return task_result(result)
+
+
+@app.task(
+    name='inasafe.headless.tasks.run_event_pipeline',
+    queue='inasafe-headless', bind=True)
+def run_event_pipeline(
+        self,
+        hazard_layer_uri,
+        exposure_layer_uri,
+        aggregation_layer_uri=None,
+        crs=None,
+        locale='en_US',
+        smoothing_method=NUMPY_SMOOTHING,
+        smoothing_factor=0.5,
+        tile_size=None,
+        custom_report_template_uri=None,
+        custom_layer_order=None,
+        custom_legend_layer=None,
+        use_template_extent=False,
+        report_keys=None,
+        push_layer_keys=None,
+        output_geopackage=None):
+    """Process a hazard event in one task: contour, analysis, report, push.
+
+    It replaces a chain of generate_contour, run_analysis, generate_report
+    and push_to_geonode tasks. InaSAFE is initialized once, and the report
+    is generated from the impact function of the analysis instead of
+    loading it again from the output metadata.
+
+    The pipeline result so far is sent to the result backend after each
+    stage, as the meta of a PROGRESS state, so clients can use the contour
+    and the analysis before the reports are done.
+
+    :param hazard_layer_uri: Uri to the shakemap raster hazard layer.
+    :type hazard_layer_uri: basestring
+
+    :param exposure_layer_uri: Uri to exposure layer.
+    :type exposure_layer_uri: basestring
+
+    :param aggregation_layer_uri: Uri to aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param crs: CRS for the analysis (if the aggregation is not set). It can
+        also be an EPSG code, an authority id such as 'EPSG:4326' or WKT.
+    :param crs: QgsCoordinateReferenceSystem, int, basestring
+
+    :param smoothing_method: Smoothing method of the contour.
+    :type smoothing_method: str
+
+    :param smoothing_factor: Smoothing factor of the contour.
+    :type smoothing_factor: float
+
+    :param tile_size: Tile size of the contour, see generate_contour.
+    :type tile_size: int
+
+    :param custom_report_template_uri: The uri to report template.
+    :type custom_report_template_uri: basestring
+
+    :param custom_layer_order: List of layers uri for map report layers order.
+    :type custom_layer_order: list
+
+    :param report_keys: Keys of the reports to generate, from
+        inasafe_analysis.default_report_keys(). If None, all reports are
+        generated.
+    :type report_keys: list
+
+    :param push_layer_keys: Keys of the analysis output layers to upload to
+        GeoNode with the contour layer, such as ['exposure_summary']. If
+        empty, nothing is uploaded.
+    :type push_layer_keys: list
+
+    :param output_geopackage: Store all output layers in a single
+        GeoPackage. Default to HEADLESS_OUTPUT_GEOPACKAGE_ENABLED.
+    :type output_geopackage: bool
+
+    :returns: A dictionary of the result of each stage, with status, message
+        and the latency of each stage.
+    :rtype: dict
+
+    The output format will be:
+    output = {
+        'status': 0,
+        'message': '',
+        'output': {
+            'contour': 'contour_layer_path',
+            'analysis': {'status': 0, 'message': '', 'output': {}},
+            'report': {'status': 0, 'message': '', 'output': {}},
+            'push': {
+                'contour': {'status': 0, 'message': '', 'output': {}},
+                'exposure_summary': {
+                    'status': 0, 'message': '', 'output': {}},
+            },
+        },
+        'latency': {
+            'contour': 1.2,
+            'analysis': 10.5,
+            'report': 20.1,
+            'push': 3.2,
+            'total': 35.0,
+        }
+    }
+    """
+    # Initialize QGIS and InaSAFE
+    phase_timer.reset()
+    _, IFACE = start_inasafe(locale)
+
+    if output_geopackage is None:
+        output_geopackage = headless_settings.OUTPUT_GEOPACKAGE_ENABLED
+
+    def stream_stage(stage, retval):
+        """Send the pipeline result after a stage to the result backend."""
+        if self.request.is_eager:
+            return
+        meta = dict(retval, stage=stage)
+        self.update_state(
+            state='PROGRESS',
+            meta=serializable_result(meta, app.conf.result_serializer))
+
+    try:
+        crs = parse_crs(crs)
+    except ValueError as e:
+        return task_result(invalid_crs_result(
+            e, inasafe_analysis.EVENT_PIPELINE_FAILED))
+    reload(inasafe_analysis)
+    layer_uris = (
+        [hazard_layer_uri, exposure_layer_uri, aggregation_layer_uri]
+        + (custom_layer_order or [])
+        + (custom_legend_layer or []))
+    with outputs_in_use(layer_uris):
+        retval = inasafe_analysis.inasafe_event_pipeline(
+            hazard_layer_uri,
+            exposure_layer_uri,
+            aggregation_layer_uri,
+            crs,
+            IFACE,
+            locale,
+            smoothing_method,
+            smoothing_factor,
+            tile_size,
+            custom_report_template_uri,
+            custom_layer_order,
+            custom_legend_layer,
+            use_template_extent,
+            report_keys=report_keys,
+            push_layer_keys=push_layer_keys,
+            output_geopackage=output_geopackage,
+            stage_callback=stream_stage)
+
+    return task_result(retval)
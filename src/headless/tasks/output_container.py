@@ -0,0 +1,255 @@
+# coding=utf-8
+"""Store the output layers of an analysis in a single GeoPackage."""
+import glob
+import os
+import shutil
+
+from osgeo import ogr
+from qgis.core import QgsVectorLayer
+
+from safe.definitions.layer_purposes import layer_purpose_analysis_impacted
+from safe.utilities.metadata import write_iso19115_metadata
+
+from headless.tasks.partitioned_analysis import (
+    open_vector_layer, split_layer_uri)
+from headless.utils import (
+    get_headless_logger, layer_base_path, layer_files, read_metadata)
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Name of the GeoPackage holding the output layers of an analysis, in the
+# directory of the analysis.
+OUTPUT_CONTAINER_NAME = 'analysis_outputs.gpkg'
+
+
+def container_layer_uri(container_path, layer_name):
+    """Get the uri of a layer of a GeoPackage.
+
+    :param container_path: Path to the GeoPackage.
+    :type container_path: basestring
+
+    :param layer_name: Name of the layer in the GeoPackage.
+    :type layer_name: basestring
+
+    :return: Uri to the layer, such as path.gpkg|layername=name.
+    :rtype: basestring
+    """
+    return '%s|layername=%s' % (container_path, layer_name)
+
+
+def output_layers(output, prefix=''):
+    """List the layers of an analysis output dictionary.
+
+    Layers of the analysis of each exposure in a multi exposure output are
+    named after the exposure, so all names are unique.
+
+    :param output: Analysis output, possibly nested per exposure.
+    :type output: dict
+
+    :param prefix: Prefix of the layer names.
+    :type prefix: basestring
+
+    :return: List of (layer name, layer uri).
+    :rtype: list
+    """
+    layers = []
+    for key, value in sorted(output.items()):
+        if isinstance(value, dict):
+            layers.extend(output_layers(value, '%s%s_' % (prefix, key)))
+        else:
+            layers.append(('%s%s' % (prefix, key), value))
+    return layers
+
+
+def replace_uris(value, uri_map):
+    """Replace layer uris in a keyword value, such as the provenance.
+
+    :param value: Keyword value, possibly a nested dictionary or list.
+
+    :param uri_map: New uri of each old uri.
+    :type uri_map: dict
+
+    :return: The value with old uris replaced.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (key, replace_uris(item, uri_map)) for key, item in value.items())
+    if isinstance(value, list):
+        return [replace_uris(item, uri_map) for item in value]
+    if isinstance(value, basestring):
+        return uri_map.get(value, value)
+    return value
+
+
+def is_in_directory(path, directory):
+    """Check if a path is in a directory or its subdirectories.
+
+    :type path: basestring
+    :type directory: basestring
+    :rtype: bool
+    """
+    relative_path = os.path.relpath(
+        os.path.realpath(path), os.path.realpath(directory))
+    return not relative_path.startswith(os.pardir)
+
+
+def save_default_style(layer_uri, style_path):
+    """Save a style as the default style of a GeoPackage layer.
+
+    QGIS keeps default styles of GeoPackage layers in its style database.
+
+    :param layer_uri: Uri to the layer, such as path.gpkg|layername=name.
+    :type layer_uri: basestring
+
+    :param style_path: Path to the qml file.
+    :type style_path: basestring
+    """
+    layer = QgsVectorLayer(layer_uri, layer_uri, 'ogr')
+    layer.loadNamedStyle(style_path)
+    layer.saveDefaultStyle()
+
+
+def load_container_metadata(layer_uri):
+    """Load keywords and styles of the layers of a GeoPackage in the worker.
+
+    InaSAFE reads keywords of GeoPackage layers from its metadata database
+    and QGIS reads their styles from its style database. Both are per user,
+    so before InaSAFE loads layers packed by another worker, keywords and
+    styles are copied from their files next to the GeoPackage to these
+    databases.
+
+    :param layer_uri: Uri to a layer of the GeoPackage. Other uris are
+        ignored.
+    :type layer_uri: basestring
+    """
+    container_path, layer_name = split_layer_uri(layer_uri)
+    if not layer_name:
+        return
+    base_path = layer_base_path(layer_uri)
+    for xml_path in glob.glob(
+            os.path.join(os.path.dirname(base_path), '*.xml')):
+        name = os.path.splitext(os.path.basename(xml_path))[0]
+        uri = container_layer_uri(container_path, name)
+        write_iso19115_metadata(uri, read_metadata(uri))
+        style_path = os.path.splitext(xml_path)[0] + '.qml'
+        if os.path.exists(style_path):
+            save_default_style(uri, style_path)
+
+
+def pack_analysis_outputs(output, container_path=None):
+    """Move the output layers of an analysis into a single GeoPackage.
+
+    Each vector layer is copied to a layer of the GeoPackage, with its
+    keywords and style. Uris of output layers in the keywords, such as the
+    provenance used to generate reports, are replaced by uris into the
+    GeoPackage. The original files are removed, except those outside the
+    directory of the GeoPackage, which may belong to other analysis.
+
+    Keywords and styles are written in a directory named after the
+    GeoPackage, see layer_base_path, so any worker can read them. They are
+    also saved in the InaSAFE metadata database and the QGIS style database
+    of the worker, see load_container_metadata.
+
+    :param output: Analysis output, possibly nested per exposure.
+    :type output: dict
+
+    :param container_path: Path to the GeoPackage, default to
+        OUTPUT_CONTAINER_NAME in the directory of the analysis summary.
+    :type container_path: basestring
+
+    :return: The analysis output, with uris into the GeoPackage.
+    :rtype: dict
+    """
+    if not container_path:
+        analysis_path = split_layer_uri(
+            output[layer_purpose_analysis_impacted['key']])[0]
+        container_path = os.path.join(
+            os.path.dirname(analysis_path), OUTPUT_CONTAINER_NAME)
+    temp_path = '%s.%d.tmp.gpkg' % (
+        os.path.splitext(container_path)[0], os.getpid())
+    container = ogr.GetDriverByName('GPKG').CreateDataSource(temp_path)
+    if container is None:
+        raise ValueError('Can not create %s.' % container_path)
+
+    uri_map = {}
+    for layer_name, layer_uri in output_layers(output):
+        try:
+            data_source, layer = open_vector_layer(layer_uri)
+        except ValueError:
+            LOGGER.debug('Keep %s out of the GeoPackage' % layer_uri)
+            continue
+        if container.CopyLayer(layer, layer_name) is None:
+            raise ValueError('Can not copy %s to %s.' % (
+                layer_uri, container_path))
+        del data_source
+        uri_map[layer_uri] = container_layer_uri(container_path, layer_name)
+    container = None
+    os.rename(temp_path, container_path)
+
+    metadata_directory = os.path.splitext(container_path)[0]
+    if not os.path.isdir(metadata_directory):
+        os.makedirs(metadata_directory)
+    for layer_uri, new_uri in uri_map.items():
+        keywords = read_metadata(layer_uri)
+        metadata = write_iso19115_metadata(
+            new_uri, replace_uris(keywords, uri_map))
+        base_path = layer_base_path(new_uri)
+        metadata.write_to_file(base_path + '.xml')
+        style_path = os.path.splitext(layer_uri)[0] + '.qml'
+        if os.path.exists(style_path):
+            shutil.copyfile(style_path, base_path + '.qml')
+            save_default_style(new_uri, style_path)
+
+    container_directory = os.path.dirname(container_path)
+    for layer_uri in uri_map:
+        if not is_in_directory(layer_uri, container_directory):
+            continue
+        for path in layer_files(layer_uri):
+            os.remove(path)
+        # Remove the directory of the analysis of an exposure if it is empty
+        directory = os.path.dirname(layer_uri)
+        if directory != container_directory and not os.listdir(directory):
+            os.rmdir(directory)
+    LOGGER.debug('Packed %d output layers in %s' % (
+        len(uri_map), container_path))
+    return replace_uris(output, uri_map)
+
+
+def export_layer(layer_uri, output_directory):
+    """Export a layer of a GeoPackage to a shapefile with its sidecar files.
+
+    It is used to upload a layer to GeoNode, which takes a file per layer.
+
+    :param layer_uri: Uri to the layer, such as path.gpkg|layername=name.
+    :type layer_uri: basestring
+
+    :param output_directory: Directory of the shapefile.
+    :type output_directory: basestring
+
+    :return: Path to the shapefile, with its keywords and style files.
+    :rtype: basestring
+    """
+    layer_name = split_layer_uri(layer_uri)[1]
+    output_path = os.path.join(output_directory, layer_name + '.shp')
+    data_source, layer = open_vector_layer(layer_uri)
+    shapefile = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(
+        output_path)
+    if shapefile.CopyLayer(layer, layer_name) is None:
+        raise ValueError('Can not export %s.' % layer_uri)
+    shapefile = None
+    del data_source
+
+    write_iso19115_metadata(output_path, read_metadata(layer_uri))
+    style_path = layer_base_path(layer_uri) + '.qml'
+    output_style_path = os.path.splitext(output_path)[0] + '.qml'
+    if os.path.exists(style_path):
+        shutil.copyfile(style_path, output_style_path)
+    else:
+        QgsVectorLayer(layer_uri, layer_name, 'ogr').saveNamedStyle(
+            output_style_path)
+    return output_path
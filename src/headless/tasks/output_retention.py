@@ -0,0 +1,554 @@
+# coding=utf-8
+"""Size and age bounded retention of the InaSAFE output directory."""
+import fcntl
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from headless import settings as headless_settings
+from headless.tasks.result_cache import ResultCache
+from headless.utils import get_headless_logger
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+OUTPUT_RETENTION_INDEX_NAME = 'output_retention.json'
+
+# Directory of the lock files held by tasks using an output directory.
+OUTPUT_RETENTION_LOCK_DIRECTORY = '.retention_locks'
+
+# Cache directories keyed by layer content, they are not evicted.
+RETAINED_DIRECTORIES = ['spatial_index', 'ingest_cache']
+
+# Directories accessed or modified more recently than this, in seconds, are
+# never evicted. It covers outputs still being written by running tasks.
+OUTPUT_RETENTION_GRACE_PERIOD = 3600
+
+EMPTY_STATS = {
+    'steps': 0,
+    'scanned': 0,
+    'evicted': 0,
+    'evicted_bytes': 0,
+    'skipped_in_use': 0,
+    'last_step': None,
+}
+
+
+def output_lock_path(directory, name):
+    """Get the path of the lock file of an output directory.
+
+    :param directory: The output directory.
+    :type directory: basestring
+
+    :param name: Name of the directory in the output directory.
+    :type name: basestring
+
+    :return: Path to the lock file.
+    :rtype: basestring
+    """
+    lock_directory = os.path.join(directory, OUTPUT_RETENTION_LOCK_DIRECTORY)
+    try:
+        os.makedirs(lock_directory)
+    except OSError:
+        if not os.path.isdir(lock_directory):
+            raise
+    return os.path.join(lock_directory, name + '.lock')
+
+
+def open_output_lock(directory, name, operation):
+    """Open and lock the lock file of an output directory.
+
+    Lock files of deleted directories are removed under the exclusive lock,
+    see exclusive_output_lock. If the file was removed while waiting for
+    the lock, the lock is taken again on a new file.
+
+    :param directory: The output directory.
+    :type directory: basestring
+
+    :param name: Name of the directory in the output directory.
+    :type name: basestring
+
+    :param operation: flock operation, such as fcntl.LOCK_SH.
+    :type operation: int
+
+    :return: The locked file, or None if the operation is non blocking and
+        the lock is held by another task.
+    :rtype: file
+    """
+    lock_path = output_lock_path(directory, name)
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, operation)
+        except IOError:
+            lock_file.close()
+            return None
+        try:
+            current = os.stat(lock_path).st_ino
+        except OSError:
+            current = None
+        if current == os.fstat(lock_file.fileno()).st_ino:
+            return lock_file
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def remove_output_lock(directory, name):
+    """Remove the lock file of an output directory which no longer exists.
+
+    The caller holds the exclusive lock.
+
+    :param directory: The output directory.
+    :type directory: basestring
+
+    :param name: Name of the directory in the output directory.
+    :type name: basestring
+    """
+    if os.path.exists(os.path.join(directory, name)):
+        return
+    try:
+        os.remove(output_lock_path(directory, name))
+    except OSError:
+        pass
+
+
+@contextmanager
+def exclusive_output_lock(directory, name):
+    """Context manager trying to lock an output directory exclusively.
+
+    It does not wait, the lock is not taken while a task uses the
+    directory. If the directory no longer exists when the block exits, its
+    lock file is removed before the lock is released.
+
+    :param directory: The output directory.
+    :type directory: basestring
+
+    :param name: Name of the directory in the output directory.
+    :type name: basestring
+
+    :return: True if the lock is held in the block, False if a task uses
+        the directory.
+    :rtype: bool
+    """
+    lock_file = open_output_lock(
+        directory, name, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    if lock_file is None:
+        yield False
+        return
+    try:
+        yield True
+        remove_output_lock(directory, name)
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def scan_directory(path):
+    """Compute the size and the last modification time of a directory.
+
+    :param path: Path to the directory.
+    :type path: basestring
+
+    :return: Tuple of the size in bytes of its files and the latest mtime of
+        the directory and its files, or None if it does not exist anymore.
+    :rtype: tuple
+    """
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return None
+    size = 0
+    for root, directories, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                stat = os.lstat(os.path.join(root, file_name))
+            except OSError:
+                continue
+            size += stat.st_size
+            modified = max(modified, stat.st_mtime)
+    return size, modified
+
+
+class OutputRetention(ResultCache):
+    """Evict output directories above a disk budget or a maximum age.
+
+    Each directory of the output directory, such as an analysis, contour or
+    partition directory, is tracked in a JSON index with its size and last
+    access. The index is shared by all worker processes using the same
+    output directory.
+
+    Eviction is incremental: each collect_garbage step scans and evicts a
+    bounded number of directories, least recently used first. Tasks hold a
+    shared lock on the directories they use, with in_use, and a directory
+    is only deleted under an exclusive lock, so it is never evicted while a
+    task uses it.
+    """
+
+    index_name = OUTPUT_RETENTION_INDEX_NAME
+
+    def __init__(self, directory, max_size=0, max_age=0, batch_size=100):
+        """Constructor.
+
+        :param directory: The output directory.
+        :type directory: basestring
+
+        :param max_size: Disk budget of the output directories in bytes, 0
+            for no limit.
+        :type max_size: int
+
+        :param max_age: Maximum time since the last access of an output
+            directory in seconds, 0 for no limit.
+        :type max_age: int
+
+        :param batch_size: Maximum number of directories scanned, and of
+            directories evicted, in a collect_garbage step.
+        :type batch_size: int
+        """
+        super(OutputRetention, self).__init__(directory, 0, max_age)
+        self.directory = directory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.lock_directory = os.path.join(
+            directory, OUTPUT_RETENTION_LOCK_DIRECTORY)
+
+    def _evict(self, index):
+        """Eviction only runs in collect_garbage steps.
+
+        :param index: The retention index.
+        :type index: dict
+        """
+        pass
+
+    def managed_directories(self):
+        """List the output directories under retention.
+
+        :return: Names of the directories.
+        :rtype: list
+        """
+        names = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.') or name in RETAINED_DIRECTORIES:
+                continue
+            if os.path.isdir(os.path.join(self.directory, name)):
+                names.append(name)
+        return names
+
+    def directory_name(self, layer_uri):
+        """Get the output directory a layer belongs to.
+
+        :param layer_uri: Uri to a layer or path to a file.
+        :type layer_uri: basestring
+
+        :return: Name of the output directory, or None if the layer is not
+            in an output directory under retention.
+        :rtype: basestring
+        """
+        path = os.path.realpath(layer_uri.split('|')[0])
+        relative_path = os.path.relpath(
+            path, os.path.realpath(self.directory))
+        if relative_path.startswith(os.pardir):
+            return None
+        name = relative_path.split(os.sep)[0]
+        if (name in (os.curdir, relative_path)
+                or name.startswith('.')
+                or name in RETAINED_DIRECTORIES):
+            return None
+        return name
+
+    def touch(self, names):
+        """Record an access to output directories.
+
+        :param names: Names of the output directories.
+        :type names: list
+        """
+        now = time.time()
+        with self._index() as index:
+            directories = index.setdefault('directories', {})
+            for name in names:
+                entry = directories.setdefault(
+                    name, {'size': None, 'accessed': now, 'scanned': 0})
+                entry['accessed'] = now
+
+    @contextmanager
+    def in_use(self, layer_uris, touch=True):
+        """Context manager held while a task uses layers.
+
+        The output directories of the layers can not be evicted until it
+        exits.
+
+        :param layer_uris: Uris of the layers.
+        :type layer_uris: list
+
+        :param touch: If the access to the directories is recorded in the
+            index.
+        :type touch: bool
+        """
+        names = sorted(set(
+            self.directory_name(layer_uri)
+            for layer_uri in layer_uris if layer_uri) - {None})
+        lock_files = []
+        try:
+            for name in names:
+                lock_files.append(
+                    open_output_lock(self.directory, name, fcntl.LOCK_SH))
+            if names and touch:
+                self.touch(names)
+            yield
+        finally:
+            for lock_file in lock_files:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _remove_directory(self, name, accessed):
+        """Delete an output directory if no task uses it.
+
+        The lock file is deleted with the directory, tasks waiting on it
+        lock a new one, see open_output_lock.
+
+        :param name: Name of the output directory.
+        :type name: basestring
+
+        :param accessed: Last access of the directory when it was selected
+            for eviction.
+        :type accessed: float
+
+        :return: True if it is deleted, False if a task uses it or used it
+            since it was selected.
+        :rtype: bool
+        """
+        with exclusive_output_lock(self.directory, name) as locked:
+            if not locked:
+                return False
+            with self._index() as index:
+                entry = index.get('directories', {}).get(name)
+                if entry is not None and entry['accessed'] > accessed:
+                    return False
+            shutil.rmtree(
+                os.path.join(self.directory, name), ignore_errors=True)
+        return True
+
+    def prune_locks(self):
+        """Delete lock files of output directories which no longer exist.
+
+        Directories deleted by retention remove their lock file, others,
+        such as directories deleted by hand, leave it behind.
+
+        :return: Number of deleted lock files.
+        :rtype: int
+        """
+        if not os.path.isdir(self.lock_directory):
+            return 0
+        pruned = 0
+        for file_name in os.listdir(self.lock_directory)[:self.batch_size]:
+            name, extension = os.path.splitext(file_name)
+            if extension != '.lock' or os.path.exists(
+                    os.path.join(self.directory, name)):
+                continue
+            with exclusive_output_lock(self.directory, name) as locked:
+                pruned += int(locked)
+        return pruned
+
+    def collect_garbage(self):
+        """Run an incremental eviction step.
+
+        It tracks new output directories, refreshes the size of the least
+        recently scanned ones, then deletes expired directories and the
+        least recently used ones while the disk budget is exceeded. Lock
+        files of deleted directories are pruned last.
+
+        Directories are scanned and deleted without holding the index lock,
+        so tasks are not blocked meanwhile.
+
+        :return: List of names of the deleted directories.
+        :rtype: list
+        """
+        with self._index() as index:
+            directories = index.setdefault('directories', {})
+            names = set(self.managed_directories())
+            for name in list(directories):
+                if name not in names:
+                    del directories[name]
+            for name in names:
+                directories.setdefault(
+                    name, {'size': None, 'accessed': 0, 'scanned': 0})
+            scanned_names = sorted(
+                directories, key=lambda n: directories[n]['scanned'])
+            scanned_names = scanned_names[:self.batch_size]
+
+        scans = dict(
+            (name, scan_directory(os.path.join(self.directory, name)))
+            for name in scanned_names)
+
+        now = time.time()
+        with self._index() as index:
+            directories = index.setdefault('directories', {})
+            for name, scan in scans.items():
+                entry = directories.get(name)
+                if entry is None or scan is None:
+                    continue
+                entry['size'], modified = scan
+                entry['scanned'] = now
+                entry['accessed'] = max(entry['accessed'], modified)
+            evicted = self._evicted_directories(directories, now)
+
+        deleted = []
+        skipped_in_use = 0
+        for name, entry in evicted:
+            if self._remove_directory(name, entry['accessed']):
+                deleted.append((name, entry['size']))
+            else:
+                skipped_in_use += 1
+
+        with self._index() as index:
+            directories = index.setdefault('directories', {})
+            stats = index.setdefault('stats', dict(EMPTY_STATS))
+            for name, size in deleted:
+                directories.pop(name, None)
+                stats['evicted'] += 1
+                stats['evicted_bytes'] += size
+            stats['skipped_in_use'] += skipped_in_use
+            stats['steps'] += 1
+            stats['scanned'] += len(scans)
+            stats['last_step'] = now
+
+        self.prune_locks()
+        for name, _ in deleted:
+            LOGGER.debug('Evicted output directory %s' % name)
+        return [name for name, _ in deleted]
+
+    def _evicted_directories(self, directories, now):
+        """Select expired and least recently used output directories.
+
+        :param directories: Entries of the output directories by name.
+        :type directories: dict
+
+        :param now: Current time.
+        :type now: float
+
+        :return: List of names and entries of the directories to delete,
+            least recently used first.
+        :rtype: list
+        """
+        total_size = sum(
+            entry['size'] or 0 for entry in directories.values())
+        candidates = sorted(
+            (name for name, entry in directories.items()
+             if entry['size'] is not None
+             and now - entry['accessed'] > OUTPUT_RETENTION_GRACE_PERIOD),
+            key=lambda n: directories[n]['accessed'])
+        evicted = []
+        for name in candidates:
+            entry = directories[name]
+            expired = self.max_age and now - entry['accessed'] > self.max_age
+            over_budget = self.max_size and total_size > self.max_size
+            if not (expired or over_budget):
+                break
+            if len(evicted) >= self.batch_size:
+                break
+            total_size -= entry['size']
+            evicted.append((name, dict(entry)))
+        return evicted
+
+    def stats(self):
+        """Get retention statistics, shared by all worker processes.
+
+        :return: Dictionary of tracked directories, their total size, the
+            limits and eviction counters.
+        :rtype: dict
+        """
+        index = {}
+        if os.path.isdir(self.directory):
+            with self._index() as index:
+                pass
+        directories = index.get('directories', {})
+        stats = dict(EMPTY_STATS)
+        stats.update(index.get('stats', {}))
+        stats.update({
+            'directories': len(directories),
+            'size': sum(entry['size'] or 0 for entry in directories.values()),
+            'max_size': self.max_size,
+            'max_age': self.max_age,
+        })
+        return stats
+
+
+def get_output_retention():
+    """Get the output retention manager, following current settings.
+
+    :return: The retention manager, or None if it is disabled.
+    :rtype: OutputRetention
+    """
+    if not (headless_settings.OUTPUT_DIRECTORY and (
+            headless_settings.OUTPUT_RETENTION_MAX_SIZE
+            or headless_settings.OUTPUT_RETENTION_MAX_AGE)):
+        return None
+    return OutputRetention(
+        headless_settings.OUTPUT_DIRECTORY,
+        headless_settings.OUTPUT_RETENTION_MAX_SIZE,
+        headless_settings.OUTPUT_RETENTION_MAX_AGE,
+        headless_settings.OUTPUT_RETENTION_BATCH_SIZE)
+
+
+@contextmanager
+def outputs_in_use(layer_uris):
+    """Context manager protecting the output directories of layers.
+
+    The directories are locked when the output retention or the contour
+    cache may delete them.
+
+    :param layer_uris: Uris of the layers used by a task.
+    :type layer_uris: list
+    """
+    output_retention = get_output_retention()
+    touch = True
+    if (output_retention is None and headless_settings.OUTPUT_DIRECTORY
+            and headless_settings.CONTOUR_CACHE_ENABLED):
+        # Only lock them, accesses are not tracked without retention
+        output_retention = OutputRetention(
+            headless_settings.OUTPUT_DIRECTORY)
+        touch = False
+    if output_retention is None:
+        yield
+    else:
+        with output_retention.in_use(layer_uris, touch):
+            yield
+
+
+def run_retention(interval):
+    """Run eviction steps forever, it is the body of the retention thread.
+
+    :param interval: Seconds between eviction steps.
+    :type interval: int
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            output_retention = get_output_retention()
+            if output_retention and os.path.isdir(
+                    output_retention.directory):
+                output_retention.collect_garbage()
+        except Exception as e:
+            LOGGER.exception(e)
+
+
+def start_retention_thread():
+    """Start background eviction of output directories in this process.
+
+    :return: The thread, or None if retention is disabled.
+    :rtype: threading.Thread
+    """
+    if get_output_retention() is None:
+        return None
+    thread = threading.Thread(
+        target=run_retention,
+        args=(headless_settings.OUTPUT_RETENTION_INTERVAL, ),
+        name='output-retention')
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,572 @@
+# coding=utf-8
+"""Split an analysis by aggregation areas and merge the partial outputs."""
+import hashlib
+import json
+import math
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+from osgeo import ogr
+
+from safe.definitions.fields import count_fields, count_ratio_mapping
+from safe.definitions.layer_purposes import layer_purpose_analysis_impacted
+from safe.definitions.provenance import (
+    provenance_aggregation_keywords,
+    provenance_aggregation_layer,
+    provenance_analysis_extent,
+    provenance_data_store_uri,
+    provenance_duration,
+    provenance_end_datetime,
+    provenance_start_datetime)
+from safe.utilities.metadata import write_iso19115_metadata
+from safe.utilities.settings import setting
+
+from headless.tasks.output_container import replace_uris
+from headless.utils import get_headless_logger, layer_digest, read_metadata
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Bump it when partitions are written differently.
+PARTITION_VERSION = 1
+
+# Format of the partition aggregation layers.
+PARTITION_DRIVER = 'GeoJSON'
+
+# List of partition layers written when all partitions are ready.
+PARTITION_INDEX = 'partitions.json'
+
+NUMERIC_FIELD_TYPES = (ogr.OFTInteger, ogr.OFTInteger64, ogr.OFTReal)
+
+
+def split_layer_uri(layer_uri):
+    """Split a layer uri into the data source path and the layer name.
+
+    :param layer_uri: Uri to layer, such as path.gpkg|layername=name.
+    :type layer_uri: basestring
+
+    :return: Tuple of path and layer name, None if the uri has none.
+    :rtype: (basestring, basestring)
+    """
+    if '|layername=' in layer_uri:
+        path, layer_name = layer_uri.split('|layername=', 1)
+        return path, layer_name
+    return layer_uri, None
+
+
+def open_vector_layer(layer_uri):
+    """Open a vector layer with OGR.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :return: Tuple of the data source, to keep it open, and the layer.
+    :rtype: (ogr.DataSource, ogr.Layer)
+
+    :raises: ValueError if it is not a vector layer.
+    """
+    path, layer_name = split_layer_uri(layer_uri)
+    data_source = ogr.Open(path)
+    if data_source is None:
+        raise ValueError('%s is not a vector layer.' % layer_uri)
+    if layer_name:
+        layer = data_source.GetLayerByName(layer_name)
+    else:
+        layer = data_source.GetLayer()
+    if layer is None:
+        raise ValueError('%s is not a vector layer.' % layer_uri)
+    return data_source, layer
+
+
+def partition_key(aggregation_layer_uri, partitions, partition_field=None):
+    """Compute the key of the partitions of an aggregation layer.
+
+    :param aggregation_layer_uri: Uri to aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param partitions: Number of partitions.
+    :type partitions: int
+
+    :param partition_field: Field grouping the aggregation areas.
+    :type partition_field: basestring
+
+    :return: Hex digest of the layer content and partition parameters.
+    :rtype: str
+    """
+    key = json.dumps([
+        PARTITION_VERSION,
+        layer_digest(aggregation_layer_uri),
+        partitions,
+        partition_field])
+    return hashlib.sha1(key).hexdigest()
+
+
+def balanced_groups(sizes, partitions):
+    """Distribute groups of features into partitions of similar size.
+
+    The largest groups are placed first, each in the smallest partition.
+
+    :param sizes: Number of features of each group, by group.
+    :type sizes: dict
+
+    :param partitions: Number of partitions.
+    :type partitions: int
+
+    :return: List of non empty lists of groups.
+    :rtype: list
+    """
+    buckets = [[0, []] for _ in range(partitions)]
+    for group in sorted(sizes, key=lambda g: (-sizes[g], g)):
+        bucket = min(buckets, key=lambda b: b[0])
+        bucket[0] += sizes[group]
+        bucket[1].append(group)
+    return [groups for _, groups in buckets if groups]
+
+
+def grid_cells(centroids, partitions):
+    """Split points into grid cells holding the same number of points.
+
+    Points are cut into vertical strips by x, then each strip is cut into
+    cells by y, so cells are compact and balanced.
+
+    :param centroids: List of (feature id, x, y).
+    :type centroids: list
+
+    :param partitions: Number of cells.
+    :type partitions: int
+
+    :return: List of non empty lists of feature ids.
+    :rtype: list
+    """
+    columns = int(math.ceil(math.sqrt(partitions)))
+    rows = int(math.ceil(partitions / float(columns)))
+
+    def split(items, count):
+        size = len(items)
+        return [
+            items[size * i // count:size * (i + 1) // count]
+            for i in range(count)]
+
+    cells = []
+    for strip in split(sorted(centroids, key=lambda c: (c[1], c[2])),
+                       columns):
+        for cell in split(sorted(strip, key=lambda c: (c[2], c[1])), rows):
+            if cell:
+                cells.append([feature_id for feature_id, _, _ in cell])
+    return cells
+
+
+def create_layer_like(data_source, layer_name, layer):
+    """Create a layer with the projection, geometry and fields of another.
+
+    :param data_source: Data source to create the layer in.
+    :type data_source: ogr.DataSource
+
+    :param layer_name: Name of the new layer.
+    :type layer_name: basestring
+
+    :param layer: Layer to copy the definition from.
+    :type layer: ogr.Layer
+
+    :return: The new layer.
+    :rtype: ogr.Layer
+    """
+    new_layer = data_source.CreateLayer(
+        str(layer_name), layer.GetSpatialRef(), layer.GetGeomType())
+    definition = layer.GetLayerDefn()
+    for index in range(definition.GetFieldCount()):
+        new_layer.CreateField(definition.GetFieldDefn(index))
+    return new_layer
+
+
+def partition_aggregation(
+        aggregation_layer_uri,
+        partitions,
+        partition_field=None,
+        output_directory=None):
+    """Split an aggregation layer into spatial partitions.
+
+    Aggregation areas are grouped by the value of partition_field, such as a
+    province code, or by grid cells of their centroids. Each partition is
+    written as a layer with the keywords of the aggregation layer.
+    Partitions are kept by layer content and parameters, so an aggregation
+    layer is only split once.
+
+    :param aggregation_layer_uri: Uri to aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param partitions: Maximum number of partitions.
+    :type partitions: int
+
+    :param partition_field: Field grouping the aggregation areas. If None,
+        areas are grouped by grid cells.
+    :type partition_field: basestring
+
+    :param output_directory: Directory of the partition directories,
+        default to the InaSAFE user directory.
+    :type output_directory: basestring
+
+    :return: List of partition layer uris.
+    :rtype: list
+    """
+    output_directory = output_directory or setting('defaultUserDirectory')
+    key = partition_key(aggregation_layer_uri, partitions, partition_field)
+    partition_directory = os.path.join(output_directory, 'partitions_' + key)
+    index_path = os.path.join(partition_directory, PARTITION_INDEX)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            partition_uris = json.load(f)
+        if all(os.path.exists(uri) for uri in partition_uris):
+            return partition_uris
+
+    data_source, layer = open_vector_layer(aggregation_layer_uri)
+    if partition_field:
+        groups = {}
+        for feature in layer:
+            groups.setdefault(
+                feature.GetField(partition_field), []).append(feature.GetFID())
+        sizes = dict((value, len(ids)) for value, ids in groups.items())
+        feature_groups = [
+            sum((groups[value] for value in values), [])
+            for values in balanced_groups(sizes, partitions)]
+    else:
+        centroids = []
+        for feature in layer:
+            centroid = feature.GetGeometryRef().Centroid()
+            centroids.append(
+                (feature.GetFID(), centroid.GetX(), centroid.GetY()))
+        feature_groups = grid_cells(centroids, partitions)
+
+    try:
+        os.makedirs(partition_directory)
+    except OSError:
+        if not os.path.isdir(partition_directory):
+            raise
+    keywords = read_metadata(aggregation_layer_uri)
+    base_name = os.path.splitext(
+        os.path.basename(split_layer_uri(aggregation_layer_uri)[0]))[0]
+    driver = ogr.GetDriverByName(PARTITION_DRIVER)
+    partition_uris = []
+    for index, feature_ids in enumerate(feature_groups):
+        partition_uri = os.path.join(
+            partition_directory, '%s_%d.geojson' % (base_name, index))
+        if os.path.exists(partition_uri):
+            driver.DeleteDataSource(partition_uri)
+        partition_source = driver.CreateDataSource(partition_uri)
+        partition_layer = create_layer_like(
+            partition_source, base_name, layer)
+        partition_definition = partition_layer.GetLayerDefn()
+        for feature_id in sorted(feature_ids):
+            feature = ogr.Feature(partition_definition)
+            feature.SetFrom(layer.GetFeature(feature_id))
+            partition_layer.CreateFeature(feature)
+        partition_source = None
+        write_iso19115_metadata(partition_uri, keywords)
+        partition_uris.append(partition_uri)
+    del data_source
+
+    temp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(partition_uris, f)
+    os.rename(temp_path, index_path)
+    LOGGER.debug('Split %s into %d partitions' % (
+        aggregation_layer_uri, len(partition_uris)))
+    return partition_uris
+
+
+def is_additive_field(field_key):
+    """Check if the values of an InaSAFE field add up across areas.
+
+    Counts and totals do. Ids, ratios and densities do not.
+
+    :param field_key: Key of the field in the inasafe_fields keyword. Keys
+        of dynamic fields are formatted, such as high_hazard_count_field.
+    :type field_key: basestring
+
+    :return: True if the field is a count or a total.
+    :rtype: bool
+    """
+    if field_key in [field['key'] for field in count_fields]:
+        return True
+    return bool({'count', 'total'} & set(field_key.split('_')))
+
+
+def merged_fields(keywords):
+    """Find the fields to sum and to recompute when merging a layer.
+
+    :param keywords: Keywords of the layer.
+    :type keywords: dict
+
+    :return: Tuple of the names of the fields to sum, and the names of the
+        ratio fields with the name of their count field.
+    :rtype: (set, dict)
+    """
+    inasafe_fields = keywords.get('inasafe_fields', {})
+    additive_names = set()
+    for field_key, field_names in inasafe_fields.items():
+        if not is_additive_field(field_key):
+            continue
+        if isinstance(field_names, basestring):
+            field_names = [field_names]
+        additive_names.update(field_names)
+    ratio_names = {}
+    for count_key, ratio_key in count_ratio_mapping.items():
+        count_name = inasafe_fields.get(count_key)
+        ratio_name = inasafe_fields.get(ratio_key)
+        if isinstance(count_name, basestring) and isinstance(
+                ratio_name, basestring):
+            ratio_names[ratio_name] = count_name
+    return additive_names, ratio_names
+
+
+def add_field_values(totals, bases, feature, additive_names, ratio_names):
+    """Add the values of a feature to running totals.
+
+    :param totals: Totals by field name, updated in place.
+    :type totals: dict
+
+    :param bases: Sum of the count divided by the ratio, by ratio field name,
+        updated in place. The merged ratio is the total count divided by it.
+    :type bases: dict
+
+    :param feature: The feature.
+    :type feature: ogr.Feature
+
+    :param additive_names: Names of the fields to sum.
+    :type additive_names: set
+
+    :param ratio_names: Names of the ratio fields with their count field.
+    :type ratio_names: dict
+    """
+    for name in additive_names:
+        index = feature.GetFieldIndex(name)
+        if index < 0:
+            continue
+        value = feature.GetField(index)
+        if value is None:
+            continue
+        totals[name] = totals.get(name, 0) + value
+    for ratio_name, count_name in ratio_names.items():
+        ratio_index = feature.GetFieldIndex(ratio_name)
+        count_index = feature.GetFieldIndex(count_name)
+        if ratio_index < 0 or count_index < 0:
+            continue
+        ratio = feature.GetField(ratio_index)
+        count = feature.GetField(count_index)
+        if ratio and count is not None:
+            bases[ratio_name] = bases.get(ratio_name, 0) + count / ratio
+
+
+def merge_layers(layer_uris, output_uri, layer_purpose):
+    """Merge the same output layer of several partitions.
+
+    Summary tables, which have no geometry, are grouped by their text fields
+    and their count and total fields are summed. The analysis summary is
+    dissolved into one feature with summed count and total fields. Ratio
+    fields of these layers are recomputed from their count field, other
+    fields keep the value of the first feature. Other layers are the union
+    of the partition features.
+
+    :param layer_uris: Uris of the layer in each partition.
+    :type layer_uris: list
+
+    :param output_uri: Uri of the merged layer.
+    :type output_uri: basestring
+
+    :param layer_purpose: Layer purpose of the layer.
+    :type layer_purpose: basestring
+    """
+    sources = [open_vector_layer(uri) for uri in layer_uris]
+    first_layer = sources[0][1]
+    definition = first_layer.GetLayerDefn()
+    additive_names, ratio_names = merged_fields(read_metadata(layer_uris[0]))
+
+    path, layer_name = split_layer_uri(output_uri)
+    driver = sources[0][0].GetDriver()
+    if os.path.exists(path) and layer_name:
+        output_source = ogr.Open(path, 1)
+    else:
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        output_source = driver.CreateDataSource(path)
+    output_layer = create_layer_like(
+        output_source,
+        layer_name or first_layer.GetName(),
+        first_layer)
+    output_definition = output_layer.GetLayerDefn()
+
+    dissolve = layer_purpose == layer_purpose_analysis_impacted['key']
+    is_table = first_layer.GetGeomType() == ogr.wkbNone
+    if dissolve or is_table:
+        # Features are grouped by their non numeric fields
+        groups = OrderedDict()
+        for _, layer in sources:
+            layer.ResetReading()
+            for feature in layer:
+                if dissolve:
+                    group_key = None
+                else:
+                    group_key = tuple(
+                        feature.GetField(index)
+                        for index in range(definition.GetFieldCount())
+                        if definition.GetFieldDefn(index).GetType()
+                        not in NUMERIC_FIELD_TYPES)
+                if group_key not in groups:
+                    groups[group_key] = [feature.Clone(), {}, {}, None]
+                group = groups[group_key]
+                add_field_values(
+                    group[1], group[2], feature, additive_names, ratio_names)
+                geometry = feature.GetGeometryRef()
+                if dissolve and geometry is not None:
+                    if group[3] is None:
+                        group[3] = geometry.Clone()
+                    else:
+                        group[3] = group[3].Union(geometry)
+        for first_feature, totals, bases, geometry in groups.values():
+            feature = ogr.Feature(output_definition)
+            feature.SetFrom(first_feature)
+            for name, value in totals.items():
+                feature.SetField(name, value)
+            for ratio_name, base in bases.items():
+                count_name = ratio_names[ratio_name]
+                if base and count_name in totals:
+                    feature.SetField(ratio_name, totals[count_name] / base)
+            if geometry is not None:
+                feature.SetGeometry(geometry)
+            output_layer.CreateFeature(feature)
+    else:
+        for _, layer in sources:
+            layer.ResetReading()
+            for feature in layer:
+                new_feature = ogr.Feature(output_definition)
+                new_feature.SetFrom(feature)
+                output_layer.CreateFeature(new_feature)
+    output_source = None
+    sources = None
+
+
+def merged_provenance(provenances, uri_map, merged_directory):
+    """Build the provenance of a merged analysis from its partitions.
+
+    :param provenances: Provenance of the layer in each partition.
+    :type provenances: list
+
+    :param uri_map: Uri of the full aggregation layer and of the merged
+        layers, by uri of the partition aggregation layer and output layers.
+    :type uri_map: dict
+
+    :param merged_directory: Directory of the merged analysis.
+    :type merged_directory: basestring
+
+    :return: The provenance of the merged layer, based on the first partition
+        with its uris replaced, the analysis extent covering all partitions,
+        the merged directory as data store and the time span of all
+        partitions.
+    :rtype: dict
+    """
+    provenance = replace_uris(provenances[0], uri_map)
+
+    extent_key = provenance_analysis_extent['provenance_key']
+    extent = None
+    for partition_provenance in provenances:
+        if not partition_provenance.get(extent_key):
+            continue
+        geometry = ogr.CreateGeometryFromWkt(
+            str(partition_provenance[extent_key]))
+        if geometry is None:
+            continue
+        extent = geometry if extent is None else extent.Union(geometry)
+    if extent is not None:
+        provenance[extent_key] = extent.ExportToWkt()
+
+    provenance[provenance_data_store_uri['provenance_key']] = merged_directory
+
+    aggregation_key = provenance_aggregation_layer['provenance_key']
+    if provenance.get(aggregation_key):
+        provenance[provenance_aggregation_keywords['provenance_key']] = (
+            read_metadata(provenance[aggregation_key]))
+
+    start_key = provenance_start_datetime['provenance_key']
+    end_key = provenance_end_datetime['provenance_key']
+    duration_key = provenance_duration['provenance_key']
+    starts = [p[start_key] for p in provenances if p.get(start_key)]
+    ends = [p[end_key] for p in provenances if p.get(end_key)]
+    if starts:
+        provenance[start_key] = min(starts)
+    if ends:
+        provenance[end_key] = max(ends)
+    durations = [p.get(duration_key) for p in provenances]
+    if all(isinstance(duration, (int, long, float))
+           for duration in durations):
+        # Time spent analysing, partitions may run in parallel
+        provenance[duration_key] = sum(durations)
+    return provenance
+
+
+def merge_partition_outputs(
+        results,
+        aggregation_layer_uri,
+        partition_uris,
+        output_directory=None):
+    """Merge the analysis outputs of the partitions of an aggregation layer.
+
+    Each merged layer gets the keywords of the layer of the first partition,
+    with a provenance rebuilt for the merged analysis, see
+    merged_provenance.
+
+    :param results: Analysis results of each partition, same format as
+        inasafe_analysis. They must all be successful.
+    :type results: list
+
+    :param aggregation_layer_uri: Uri to the full aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param partition_uris: Uris of the partition aggregation layers, in the
+        same order as the results.
+    :type partition_uris: list
+
+    :param output_directory: Directory of the merged analysis directory,
+        default to the InaSAFE user directory.
+    :type output_directory: basestring
+
+    :return: The merged outputs, by layer purpose.
+    :rtype: dict
+    """
+    output_directory = output_directory or setting('defaultUserDirectory')
+    # Make it same format as analysis directory
+    current_datetime = datetime.now().strftime('%d%B%Y_%Hh%M-%S.%f')
+    merged_directory = os.path.join(
+        output_directory, 'partitioned_%s' % current_datetime)
+    os.makedirs(merged_directory)
+
+    outputs = {}
+    uri_map = {
+        partition_uri: aggregation_layer_uri
+        for partition_uri in partition_uris}
+    for layer_purpose, first_uri in results[0]['output'].items():
+        path, layer_name = split_layer_uri(first_uri)
+        output_uri = os.path.join(merged_directory, os.path.basename(path))
+        if layer_name:
+            output_uri = '%s|layername=%s' % (output_uri, layer_name)
+        outputs[layer_purpose] = output_uri
+        uri_map[first_uri] = output_uri
+
+    for layer_purpose, first_uri in results[0]['output'].items():
+        layer_uris = [result['output'][layer_purpose] for result in results]
+        output_uri = outputs[layer_purpose]
+        merge_layers(layer_uris, output_uri, layer_purpose)
+
+        keywords = read_metadata(first_uri)
+        if 'provenance_data' in keywords:
+            keywords['provenance_data'] = merged_provenance(
+                [read_metadata(uri).get('provenance_data', {})
+                 for uri in layer_uris],
+                uri_map,
+                merged_directory)
+        write_iso19115_metadata(output_uri, keywords)
+    return outputs
@@ -0,0 +1,277 @@
+# coding=utf-8
+"""Content addressed cache of analysis results."""
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from qgis.core import QgsCoordinateReferenceSystem
+
+from headless import settings as headless_settings
+from headless.utils import get_headless_logger, layer_digest
+from safe.definitions.default_settings import inasafe_default_settings
+from safe.utilities.settings import setting
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Increase it if the cache key or entry format changes.
+RESULT_CACHE_VERSION = 1
+
+RESULT_CACHE_INDEX_NAME = 'result_cache.json'
+
+RESULT_CACHE_HIT = 'hit'
+RESULT_CACHE_MISS = 'miss'
+
+
+def crs_key(crs):
+    """Get a stable representation of a CRS.
+
+    :param crs: The CRS, or None.
+    :type crs: QgsCoordinateReferenceSystem
+
+    :return: Authority id or WKT of the CRS.
+    :rtype: str
+    """
+    if crs is None:
+        return None
+    if isinstance(crs, QgsCoordinateReferenceSystem):
+        return crs.authid() or crs.toWkt()
+    return '%s' % crs
+
+
+def effective_settings():
+    """Get the InaSAFE settings values which are currently in use.
+
+    :return: Sorted list of (key, value) of InaSAFE settings.
+    :rtype: list
+    """
+    return sorted(
+        (key, '%s' % setting(key))
+        for key in inasafe_default_settings)
+
+
+def analysis_key(
+        hazard_layer_uri,
+        exposure_layer_uris,
+        aggregation_layer_uri=None,
+        crs=None,
+        locale='en_US',
+        output_geopackage=False,
+        use_exposure_view_only=True):
+    """Compute the cache key of an analysis.
+
+    :param hazard_layer_uri: Uri to hazard layer.
+    :type hazard_layer_uri: basestring
+
+    :param exposure_layer_uris: Uri to exposure layer for single exposure
+        analysis or list of uri to exposure layers for multi exposure
+        analysis.
+    :type exposure_layer_uris: basestring, list
+
+    :param aggregation_layer_uri: Uri to aggregation layer.
+    :type aggregation_layer_uri: basestring
+
+    :param crs: CRS for the analysis (if the aggregation is not set).
+    :type crs: QgsCoordinateReferenceSystem
+
+    :param locale: Locale of the analysis.
+    :type locale: str
+
+    :param output_geopackage: If the output layers are stored in a single
+        GeoPackage.
+    :type output_geopackage: bool
+
+    :param use_exposure_view_only: If the single exposure analysis only
+        analyses the exposure in the analysis extent, see
+        execute_impact_function.
+    :type use_exposure_view_only: bool
+
+    :return: Hex digest identifying the analysis.
+    :rtype: str
+    """
+    content = {
+        'version': RESULT_CACHE_VERSION,
+        'hazard': layer_digest(hazard_layer_uri),
+        'exposures': (
+            layer_digest(exposure_layer_uris)
+            if isinstance(exposure_layer_uris, basestring) else
+            [layer_digest(uri) for uri in exposure_layer_uris]),
+        'aggregation': (
+            layer_digest(aggregation_layer_uri)
+            if aggregation_layer_uri else None),
+        'crs': crs_key(crs),
+        'locale': locale,
+        'settings': effective_settings(),
+    }
+    if output_geopackage:
+        content['output_geopackage'] = True
+    if not use_exposure_view_only:
+        content['use_exposure_view_only'] = False
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def output_paths(output):
+    """List all paths of an analysis output dictionary.
+
+    :param output: Analysis output, possibly nested per exposure.
+    :type output: dict
+
+    :return: List of paths. Uris of layers in a GeoPackage give the path of
+        the GeoPackage.
+    :rtype: list
+    """
+    paths = []
+    for value in output.values():
+        if isinstance(value, dict):
+            paths.extend(output_paths(value))
+        else:
+            paths.append(value.split('|')[0])
+    return paths
+
+
+class ResultCache(object):
+    """Cache of analysis results, indexed in a JSON file.
+
+    The index is shared by all worker processes using the same output
+    directory, so it is always accessed under a file lock.
+    """
+
+    index_name = RESULT_CACHE_INDEX_NAME
+
+    def __init__(self, directory, max_entries=1000, max_age=0):
+        """Constructor.
+
+        :param directory: Directory of the index file.
+        :type directory: basestring
+
+        :param max_entries: Maximum number of entries in the index.
+        :type max_entries: int
+
+        :param max_age: Maximum age of an entry in seconds, 0 for no limit.
+        :type max_age: int
+        """
+        self.index_path = os.path.join(directory, self.index_name)
+        self.lock_path = self.index_path + '.lock'
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    @contextmanager
+    def _index(self):
+        """Context manager giving exclusive access to the index.
+
+        The index is written back when the block exits.
+        """
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.index_path) as f:
+                        index = json.load(f)
+                except (IOError, ValueError):
+                    index = {}
+                yield index
+                self._evict(index)
+                temp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+                with open(temp_path, 'w') as f:
+                    json.dump(index, f)
+                os.rename(temp_path, self.index_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _evicted_keys(self, index):
+        """List expired entries and the least recently used ones.
+
+        :param index: The cache index.
+        :type index: dict
+
+        :return: Keys of the entries to evict.
+        :rtype: list
+        """
+        keys = []
+        if self.max_age:
+            now = time.time()
+            keys = [k for k, v in index.items()
+                    if now - v['created'] > self.max_age]
+        remaining = [k for k in index if k not in keys]
+        excess = len(remaining) - self.max_entries
+        if excess > 0:
+            remaining.sort(key=lambda k: index[k]['accessed'])
+            keys.extend(remaining[:excess])
+        return keys
+
+    def _evict(self, index):
+        """Evict expired entries and the least recently used ones.
+
+        Only index entries are removed, output directories are left in
+        place.
+
+        :param index: The cache index.
+        :type index: dict
+        """
+        for key in self._evicted_keys(index):
+            del index[key]
+
+    def get(self, key):
+        """Get a cached analysis result.
+
+        :param key: The analysis key.
+        :type key: str
+
+        :return: The cached analysis result, or None if there is no valid
+            entry for the key.
+        :rtype: dict
+        """
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if not all(os.path.exists(p) for p in output_paths(
+                    entry['result']['output'])):
+                LOGGER.debug('Cached result %s is gone' % key)
+                del index[key]
+                return None
+            entry['accessed'] = time.time()
+            return entry['result']
+
+    def put(self, key, result):
+        """Store an analysis result.
+
+        :param key: The analysis key.
+        :type key: str
+
+        :param result: The analysis result with status, message and output.
+        :type result: dict
+        """
+        now = time.time()
+        with self._index() as index:
+            index[key] = {
+                'created': now,
+                'accessed': now,
+                'result': {
+                    'status': result['status'],
+                    'message': result['message'],
+                    'output': result['output'],
+                }
+            }
+
+
+def get_result_cache():
+    """Get the result cache, following current settings.
+
+    :return: The result cache, or None if it is disabled.
+    :rtype: ResultCache
+    """
+    if not (headless_settings.RESULT_CACHE_ENABLED
+            and headless_settings.OUTPUT_DIRECTORY):
+        return None
+    return ResultCache(
+        headless_settings.OUTPUT_DIRECTORY,
+        headless_settings.RESULT_CACHE_MAX_ENTRIES,
+        headless_settings.RESULT_CACHE_MAX_AGE)
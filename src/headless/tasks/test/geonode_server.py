@@ -0,0 +1,134 @@
+# coding=utf-8
+"""Local stand-in GeoNode server for upload tests."""
+import json
+import re
+import threading
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGIN_PAGE = (
+    "<form method='post'>"
+    "<input type='hidden' name='csrfmiddlewaretoken' value='%s' />"
+    "</form>")
+UPLOAD_PAGE = '<script>csrf_token = "%s",</script>'
+
+
+class GeoNodeRequestHandler(BaseHTTPRequestHandler):
+    """Handle the GeoNode login and layer upload requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def session_id(self):
+        cookies = self.headers.get('Cookie', '')
+        match = re.search('sessionid=([a-z0-9]+)', cookies)
+        return match.group(1) if match else None
+
+    @property
+    def logged_in(self):
+        return self.session_id in self.server.sessions
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def redirect_to_login(self):
+        self.respond(302, headers={
+            'Location': '/account/login/?next=%s' % self.path})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if 'login' in path:
+            self.respond(200, LOGIN_PAGE % self.server.csrf_token)
+        elif 'upload' in path:
+            if not self.logged_in:
+                return self.redirect_to_login()
+            self.respond(200, UPLOAD_PAGE % self.server.csrf_token)
+        else:
+            self.respond(200, 'GeoNode')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if 'login' in path:
+            form = parse_qs(body)
+            credentials = (
+                form.get('username', [None])[0],
+                form.get('password', [None])[0])
+            if credentials != (self.server.user, self.server.password):
+                return self.respond(
+                    200, LOGIN_PAGE % self.server.csrf_token)
+            session_id = uuid.uuid4().hex
+            self.server.sessions.add(session_id)
+            self.server.logins += 1
+            self.respond(302, headers={
+                'Location': '/',
+                'Set-Cookie': 'sessionid=%s; Path=/' % session_id})
+        elif 'upload' in path:
+            if not self.logged_in:
+                return self.respond(403, 'Forbidden')
+            file_names = re.findall('filename="([^"]+)"', body)
+            self.server.uploads.append(file_names)
+            layer_name = file_names[0].rsplit('.', 1)[0]
+            self.respond(200, json.dumps({
+                'url': '/layers/geonode:%s' % layer_name,
+                'success': True,
+            }))
+        else:
+            self.respond(404)
+
+
+class GeoNodeServer(ThreadingMixIn, HTTPServer):
+    """Stand-in GeoNode server running in a thread.
+
+    It records logins and uploads, and sessions can be expired to test
+    login again.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+            self,
+            user='admin',
+            password='admin',
+            handler_class=GeoNodeRequestHandler):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.user = user
+        self.password = password
+        self.csrf_token = uuid.uuid4().hex
+        self.sessions = set()
+        self.logins = 0
+        self.uploads = []
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def expire_sessions(self):
+        self.sessions.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,48 @@
+# coding=utf-8
+import unittest
+
+from headless.tasks.benchmark.run_benchmark import compare, summarize
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_summarize(self):
+        """Test summary of timings."""
+        summary = summarize([3.0, 1.0, 2.0, 4.0])
+        self.assertEqual(1.0, summary['min'])
+        self.assertEqual(2.5, summary['median'])
+        self.assertEqual(2.5, summary['mean'])
+        self.assertEqual(4.0, summary['max'])
+        self.assertEqual(4, summary['runs'])
+
+    def test_compare(self):
+        """Test regressions are detected with the threshold."""
+        baseline = {
+            'scenarios': {
+                'analysis': {
+                    'run': summarize([1.0]),
+                    'prepare': summarize([1.0]),
+                }
+            }
+        }
+        current = {
+            'scenarios': {
+                'analysis': {
+                    'run': summarize([1.05]),
+                    'prepare': summarize([1.5]),
+                    'load': summarize([1.0]),
+                },
+                'contour': {
+                    'contour': summarize([1.0]),
+                }
+            }
+        }
+        regressions = compare(current, baseline, threshold=0.1)
+        self.assertEqual(1, len(regressions))
+        self.assertEqual('prepare', regressions[0]['phase'])
+        self.assertEqual([], compare(current, baseline, threshold=0.6))
@@ -2,8 +2,12 @@
 """Unit test for celery task."""
 import os
 import pickle
+import shutil
+import tempfile
 import unittest
 
+import mock
+
 from headless.settings import OUTPUT_DIRECTORY
 from headless.tasks.inasafe_analysis import (
     clean_metadata,
@@ -13,6 +17,7 @@ from headless.tasks.inasafe_wrapper import (
     get_keywords,
     generate_contour,
     check_broker_connection,
+    get_worker_stats,
 )
 from headless.tasks.test.helpers import \
     place_layer_uri, earthquake_layer_uri, \
@@ -26,6 +31,7 @@ from safe.definitions.layer_purposes import (
     layer_purpose_exposure,
     layer_purpose_hazard,
     layer_purpose_aggregation)
+from headless.utils import MetadataCache
 from safe.test.utilities import get_qgis_app
 
 QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
@@ -129,3 +135,67 @@ class TestHeadlessCeleryTask(unittest.TestCase):
         self.assertTrue(isinstance(metadata['url'], basestring))
         self.assertTrue(
             isinstance(metadata['extra_keywords']['url'], basestring))
+
+    @retry_on_worker_lost_error()
+    def test_get_worker_stats(self):
+        """Test get_worker_stats task."""
+        get_keywords.delay(place_layer_uri).get()
+        get_keywords.delay(place_layer_uri).get()
+        stats = get_worker_stats.delay().get()
+        self.assertLess(0, stats['metadata_cache']['hits'])
+        self.assertLess(0, stats['metadata_cache']['size'])
+
+    def test_clean_metadata_cache(self):
+        """Test cleaned metadata is cached and returned as a copy."""
+        cache = MetadataCache(max_size=2)
+        clean = mock.Mock(wraps=clean_metadata)
+        keywords = cache.get(place_layer_uri, clean)
+        keywords['layer_purpose'] = 'changed'
+        keywords = cache.get(place_layer_uri, clean)
+        self.assertEqual(1, clean.call_count)
+        self.assertEqual(
+            keywords['layer_purpose'], layer_purpose_exposure['key'])
+
+    def test_metadata_cache(self):
+        """Test metadata cache hit, invalidation and persistence."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            layer_uri = os.path.join(temp_dir, 'places.geojson')
+            shutil.copy(place_layer_uri, layer_uri)
+            shutil.copy(
+                os.path.splitext(place_layer_uri)[0] + '.xml',
+                os.path.join(temp_dir, 'places.xml'))
+            cache_path = os.path.join(temp_dir, 'metadata_cache.pickle')
+
+            cache = MetadataCache(max_size=2, cache_path=cache_path)
+            keywords = cache.get(layer_uri)
+            self.assertEqual(
+                keywords['layer_purpose'], layer_purpose_exposure['key'])
+            cache.get(layer_uri)
+            self.assertEqual(1, cache.stats()['hits'])
+            self.assertEqual(1, cache.stats()['misses'])
+
+            # Returned metadata is a copy
+            keywords['layer_purpose'] = 'changed'
+            self.assertEqual(
+                cache.get(layer_uri)['layer_purpose'],
+                layer_purpose_exposure['key'])
+
+            # Persisted cache is reused by a new instance
+            self.assertFalse(os.path.exists(cache_path))
+            cache.save()
+            self.assertEqual(
+                [], [f for f in os.listdir(temp_dir) if f.endswith('.tmp')])
+            new_cache = MetadataCache(max_size=2, cache_path=cache_path)
+            new_cache.get(layer_uri)
+            self.assertEqual(1, new_cache.stats()['hits'])
+
+            # Changed metadata file invalidates the entry
+            xml_path = os.path.join(temp_dir, 'places.xml')
+            stat = os.stat(xml_path)
+            os.utime(xml_path, (stat.st_atime, stat.st_mtime + 10))
+            new_cache.get(layer_uri)
+            self.assertEqual(1, new_cache.stats()['misses'])
+            self.assertEqual(1, new_cache.stats()['size'])
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,173 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from headless.celeryconfig import task_always_eager
+from headless.tasks.contour_cache import (
+    ContourCache,
+    contour_key,
+    CONTOUR_CACHE_GRACE_PERIOD,
+    CONTOUR_CACHE_MARKER_NAME)
+from headless.tasks.inasafe_wrapper import generate_contour
+from headless.tasks.output_retention import OutputRetention
+from headless.tasks.test.helpers import (
+    shakemap_layer_uri, earthquake_layer_uri, retry_on_worker_lost_error)
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestContourCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_contour(self, name):
+        """Create a fake contour file in its own contour directory."""
+        directory = os.path.join(self.temp_dir, 'contour_%s' % name)
+        os.makedirs(directory)
+        path = os.path.join(directory, '%s.shp' % name)
+        open(path, 'w').close()
+        return path
+
+    def test_contour_key(self):
+        """Test contour key depends on the raster and parameters."""
+        parameters = {'smoothing_factor': 0.5}
+        key = contour_key(shakemap_layer_uri, parameters)
+        self.assertEqual(key, contour_key(shakemap_layer_uri, parameters))
+        self.assertNotEqual(
+            key, contour_key(shakemap_layer_uri, {'smoothing_factor': 1}))
+        self.assertNotEqual(key, contour_key(earthquake_layer_uri, parameters))
+
+    def test_get_put(self):
+        """Test contour is returned until it is gone."""
+        cache = ContourCache(self.temp_dir)
+        self.assertIsNone(cache.get('key'))
+
+        contour_uri = self.create_contour('shakemap')
+        cache.put('key', contour_uri)
+        self.assertEqual(contour_uri, cache.get('key'))
+
+        os.remove(contour_uri)
+        self.assertIsNone(cache.get('key'))
+
+    def test_eviction(self):
+        """Test evicted contour directories are deleted."""
+        cache = ContourCache(self.temp_dir, max_entries=1)
+        first_uri = self.create_contour('first')
+        cache.put('first', first_uri)
+        second_uri = self.create_contour('second')
+        cache.put('second', second_uri)
+
+        self.assertIsNone(cache.get('first'))
+        self.assertFalse(os.path.exists(os.path.dirname(first_uri)))
+        self.assertEqual(second_uri, cache.get('second'))
+
+    def test_eviction_in_use(self):
+        """Test contour directories used by a task are not evicted."""
+        cache = ContourCache(self.temp_dir, max_entries=1)
+        first_uri = self.create_contour('first')
+        cache.put('first', first_uri)
+        second_uri = self.create_contour('second')
+        with OutputRetention(self.temp_dir).in_use([first_uri], False):
+            cache.put('second', second_uri)
+            self.assertTrue(os.path.exists(first_uri))
+        self.assertEqual(
+            [os.path.dirname(first_uri)], cache.collect_garbage())
+        self.assertIsNone(cache.get('first'))
+        self.assertEqual(second_uri, cache.get('second'))
+
+    def test_collect_garbage(self):
+        """Test expired contours and the ones left by the cache are deleted.
+        """
+        cache = ContourCache(self.temp_dir)
+        cached_uri = self.create_contour('cached')
+        cache.put('cached', cached_uri)
+        expired_uri = self.create_contour('expired')
+        cache.put('expired', expired_uri)
+        with cache._index() as index:
+            index['expired']['created'] -= 120
+        # Dropped from the index a while ago, or just now
+        for name in ['old', 'new']:
+            uri = self.create_contour(name)
+            cache.put(name, uri)
+            os.remove(uri)
+            self.assertIsNone(cache.get(name))
+        old_time = time.time() - CONTOUR_CACHE_GRACE_PERIOD - 60
+        os.utime(
+            os.path.join(self.temp_dir, 'contour_old',
+                         CONTOUR_CACHE_MARKER_NAME),
+            (old_time, old_time))
+        # Not created by the cache
+        other_uri = self.create_contour('other')
+        os.utime(os.path.dirname(other_uri), (old_time, old_time))
+
+        deleted = ContourCache(self.temp_dir, max_age=60).collect_garbage()
+        self.assertEqual(
+            sorted([os.path.dirname(expired_uri),
+                    os.path.join(self.temp_dir, 'contour_old')]),
+            sorted(deleted))
+        self.assertTrue(os.path.exists(cached_uri))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_dir, 'contour_new')))
+        self.assertTrue(os.path.exists(other_uri))
+
+    def test_generating(self):
+        """Test identical contours in flight wait for the first one."""
+        cache = ContourCache(self.temp_dir)
+        contour_uri = self.create_contour('shakemap')
+        results = []
+
+        def wait_for_contour():
+            with cache.generating('key'):
+                results.append(cache.get('key'))
+
+        with cache.generating('key'):
+            thread = threading.Thread(target=wait_for_contour)
+            thread.start()
+            time.sleep(0.2)
+            # The second request is still waiting
+            self.assertEqual([], results)
+            cache.put('key', contour_uri)
+        thread.join()
+        self.assertEqual([contour_uri], results)
+
+    @unittest.skipUnless(
+        task_always_eager,
+        'This test is only relevant on sync mode')
+    @retry_on_worker_lost_error()
+    def test_generate_contour_cached(self):
+        """Test generate_contour reuses the contour of the same raster."""
+        # Settings are reloaded from environment by start_inasafe
+        patched_env = {
+            'HEADLESS_CONTOUR_CACHE_ENABLED': 'True'
+        }
+        with mock.patch.dict(os.environ, patched_env):
+            result = generate_contour.delay(shakemap_layer_uri).get()
+            self.assertTrue(os.path.exists(result))
+
+            cached_result = generate_contour.delay(shakemap_layer_uri).get()
+            self.assertEqual(result, cached_result)
+
+            other_result = generate_contour.delay(
+                shakemap_layer_uri, smoothing_factor=1.0).get()
+            self.assertNotEqual(result, other_result)
+            self.assertTrue(os.path.exists(other_result))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# coding=utf-8
+import os
+import unittest
+
+import mock
+
+from headless.celery_app import start_inasafe
+from headless.tasks import inasafe_analysis
+from headless.tasks.inasafe_analysis import (
+    EVENT_PIPELINE_FAILED, EVENT_PIPELINE_SUCCESS, default_report_keys)
+from headless.tasks.inasafe_wrapper import run_analysis, run_event_pipeline
+from headless.tasks.test.helpers import (
+    aggregation_layer_uri,
+    place_layer_uri,
+    retry_on_worker_lost_error,
+    shakemap_layer_uri)
+from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.report.impact_report import ImpactReport
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestEventPipeline(unittest.TestCase):
+
+    @retry_on_worker_lost_error()
+    def test_run_event_pipeline(self):
+        """Test the pipeline gives the outputs of the separate tasks."""
+        result = run_event_pipeline.delay(
+            shakemap_layer_uri, place_layer_uri, aggregation_layer_uri).get()
+        self.assertEqual(
+            EVENT_PIPELINE_SUCCESS, result['status'], result['message'])
+        output = result['output']
+        self.assertEqual(
+            ['analysis', 'contour', 'report'], sorted(output.keys()))
+        self.assertTrue(os.path.exists(output['contour']))
+
+        analysis_result = run_analysis.delay(
+            shakemap_layer_uri, place_layer_uri, aggregation_layer_uri).get()
+        self.assertEqual(ANALYSIS_SUCCESS, output['analysis']['status'])
+        self.assertEqual(
+            sorted(analysis_result['output'].keys()),
+            sorted(output['analysis']['output'].keys()))
+
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS,
+            output['report']['status'],
+            output['report']['message'])
+        for products in output['report']['output'].values():
+            for product_uri in products.values():
+                self.assertTrue(os.path.exists(product_uri), product_uri)
+
+        for stage in ['contour', 'analysis', 'report', 'total']:
+            self.assertIn(stage, result['latency'])
+        self.assertGreaterEqual(
+            result['latency']['total'],
+            result['latency']['analysis'] + result['latency']['report'])
+
+    @retry_on_worker_lost_error()
+    def test_run_event_pipeline_report_keys(self):
+        """Test the pipeline only generates the given reports."""
+        result = run_event_pipeline.delay(
+            shakemap_layer_uri,
+            place_layer_uri,
+            aggregation_layer_uri,
+            report_keys=default_report_keys(['impact-report-pdf'])).get()
+        self.assertEqual(
+            EVENT_PIPELINE_SUCCESS, result['status'], result['message'])
+        report = result['output']['report']
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS,
+            report['status'],
+            report['message'])
+        product_keys = [
+            key for products in report['output'].values()
+            for key in products]
+        self.assertIn('impact-report-pdf', product_keys)
+        self.assertNotIn('inasafe-map-report-landscape', product_keys)
+
+    def test_stage_callback(self):
+        """Test each stage result is reported as soon as it is done."""
+        stages = []
+
+        def stage_callback(stage, retval):
+            self.assertIn(stage, retval['output'])
+            self.assertIn(stage, retval['latency'])
+            stages.append(stage)
+
+        iface = start_inasafe()[1]
+        result = inasafe_analysis.inasafe_event_pipeline(
+            shakemap_layer_uri,
+            place_layer_uri,
+            aggregation_layer_uri,
+            IFACE=iface,
+            stage_callback=stage_callback)
+        self.assertEqual(
+            EVENT_PIPELINE_SUCCESS, result['status'], result['message'])
+        self.assertEqual(['contour', 'analysis', 'report'], stages)
+
+    def test_no_exposure_summary(self):
+        """Test the report stage fails if there is no exposure summary."""
+        iface = start_inasafe()[1]
+        analysis_result = {
+            'status': ANALYSIS_SUCCESS,
+            'message': '',
+            'output': {}
+        }
+        with mock.patch.object(
+                inasafe_analysis,
+                'execute_impact_function',
+                return_value=(analysis_result, None)):
+            result = inasafe_analysis.inasafe_event_pipeline(
+                shakemap_layer_uri,
+                place_layer_uri,
+                aggregation_layer_uri,
+                IFACE=iface)
+        self.assertEqual(EVENT_PIPELINE_FAILED, result['status'])
+        self.assertIn('report stage', result['message'])
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_FAILED,
+            result['output']['report']['status'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# coding=utf-8
+import os
+import unittest
+
+import mock
+from qgis.core import QgsFeatureRequest, QgsMapLayerRegistry
+
+from headless.tasks import exposure_clip, inasafe_analysis
+from headless.tasks.exposure_clip import clip_exposure_layer, clip_extent
+from headless.tasks.test.helpers import (
+    aggregation_layer_uri,
+    buildings_layer_uri,
+    earthquake_layer_uri)
+from headless.utils import load_layer, read_metadata
+from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.definitions.layer_purposes import (
+    layer_purpose_aggregation_summary,
+    layer_purpose_analysis_impacted,
+    layer_purpose_exposure_summary)
+from safe.definitions.provenance import provenance_exposure_layer
+from safe.report.impact_report import ImpactReport
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def read_attributes(layer_uri):
+    """Read the attributes of the features of a layer."""
+    layer = load_layer(layer_uri)[0]
+    names = [field.name() for field in layer.fields()]
+    return [
+        dict(zip(names, feature.attributes()))
+        for feature in layer.getFeatures()]
+
+
+@mock.patch.object(exposure_clip, 'MINIMUM_CLIP_GAIN', 0)
+class TestExposureClip(unittest.TestCase):
+
+    def tearDown(self):
+        QgsMapLayerRegistry.instance().removeAllMapLayers()
+
+    def test_clip_exposure_layer(self):
+        """Test clipped exposure keeps every feature in the extent."""
+        exposure_layer = load_layer(buildings_layer_uri)[0]
+        hazard_layer = load_layer(earthquake_layer_uri)[0]
+        aggregation_layer = load_layer(aggregation_layer_uri)[0]
+
+        layer = clip_exposure_layer(
+            exposure_layer, hazard_layer, aggregation_layer)
+        self.assertIsNot(exposure_layer, layer)
+        self.assertEqual(exposure_layer.keywords, layer.keywords)
+        self.assertEqual(exposure_layer.extent(), layer.extent())
+        # The clipped features are in a file with the exposure keywords
+        clipped_path = layer.source().split('|')[0]
+        self.assertTrue(os.path.isfile(clipped_path))
+        self.assertEqual(
+            exposure_layer.keywords['exposure'],
+            read_metadata(clipped_path)['exposure'])
+
+        extent = clip_extent(exposure_layer, hazard_layer, aggregation_layer)
+        expected = len(list(exposure_layer.getFeatures(
+            QgsFeatureRequest().setFilterRect(extent))))
+        self.assertLess(0, expected)
+        self.assertEqual(expected, layer.featureCount())
+
+        # Raster exposures are not clipped
+        self.assertIs(
+            hazard_layer, clip_exposure_layer(hazard_layer, hazard_layer))
+
+    def test_clipped_analysis(self):
+        """Test analysis with a clipped exposure gives the same results."""
+        results = []
+        for enabled in (False, True):
+            with mock.patch.object(
+                    inasafe_analysis, 'EXPOSURE_CLIP_ENABLED', enabled):
+                result = inasafe_analysis.inasafe_analysis(
+                    earthquake_layer_uri,
+                    buildings_layer_uri,
+                    aggregation_layer_uri)
+            self.assertEqual(
+                ANALYSIS_SUCCESS, result['status'], result['message'])
+            results.append(result['output'])
+        unclipped, clipped = results
+        self.assertEqual(sorted(unclipped.keys()), sorted(clipped.keys()))
+
+        for layer_purpose in [
+                layer_purpose_exposure_summary,
+                layer_purpose_aggregation_summary,
+                layer_purpose_analysis_impacted]:
+            key = layer_purpose['key']
+            self.assertEqual(
+                len(read_attributes(unclipped[key])),
+                len(read_attributes(clipped[key])))
+        summary = read_attributes(
+            unclipped[layer_purpose_analysis_impacted['key']])[0]
+        clipped_summary = read_attributes(
+            clipped[layer_purpose_analysis_impacted['key']])[0]
+        self.assertEqual(summary, clipped_summary)
+
+        # The provenance points to the clipped layer, reports load it
+        impact_layer_uri = clipped[layer_purpose_analysis_impacted['key']]
+        provenance = read_metadata(impact_layer_uri)['provenance_data']
+        clipped_layer_uri = provenance[
+            provenance_exposure_layer['provenance_key']]
+        self.assertNotEqual(buildings_layer_uri, clipped_layer_uri)
+        self.assertTrue(load_layer(clipped_layer_uri)[0].isValid())
+        result = inasafe_analysis.generate_report(
+            impact_layer_uri, IFACE=IFACE)
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        for products in result['output'].values():
+            for product_uri in products.values():
+                self.assertTrue(os.path.exists(product_uri))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -284,6 +284,157 @@ class TestGenerateReport(unittest.TestCase):
                 if custom_map_template_basename == product_key:
                     print product_uri
 
+    @retry_on_worker_lost_error()
+    def test_generate_report_parallel(self):
+        """Test generate report with parallel report subtasks."""
+        # Run analysis first
+        result_delay = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+        result = result_delay.get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+
+        # Retrieve impact analysis uri
+        impact_analysis_uri = result['output'][
+            layer_purpose_exposure_summary['key']]
+
+        # Generate reports serially first to compare
+        async_result = generate_report.delay(impact_analysis_uri)
+        serial_result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, serial_result['status'])
+
+        async_result = generate_report.delay(
+            impact_analysis_uri, parallel=True, incremental=False)
+        result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        self.assertDictEqual(serial_result['output'], result['output'])
+        for key, products in result['output'].items():
+            for product_key, product_uri in products.items():
+                message = 'Product %s is not found in %s' % (
+                    product_key, product_uri)
+                self.assertTrue(os.path.exists(product_uri), message)
+
+        # Merged report metadata is written
+        async_result = get_generated_report.delay(impact_analysis_uri)
+        generated_result = async_result.get()
+        self.assertEqual(REPORT_METADATA_EXIST, generated_result['status'])
+        self.assertDictEqual(result['output'], generated_result['output'])
+
+    @retry_on_worker_lost_error()
+    def test_generate_report_incremental(self):
+        """Test generate report only renders missing reports."""
+        # Run analysis first
+        result_delay = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+        result = result_delay.get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+
+        # Retrieve impact analysis uri
+        impact_analysis_uri = result['output'][
+            layer_purpose_exposure_summary['key']]
+
+        async_result = generate_report.delay(
+            impact_analysis_uri, incremental=False)
+        first_result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, first_result['status'])
+        self.assertIn('report', first_result['metrics']['phases'])
+
+        # Reports are up to date, nothing is rendered
+        async_result = generate_report.delay(impact_analysis_uri)
+        result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'])
+        self.assertDictEqual(first_result['output'], result['output'])
+        self.assertNotIn('report', result['metrics']['phases'])
+
+        # A missing product is rendered again
+        missing_uri = first_result['output']['pdf_product_tag'][
+            'impact-report-pdf']
+        os.remove(missing_uri)
+        async_result = generate_report.delay(impact_analysis_uri)
+        result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        self.assertIn('report', result['metrics']['phases'])
+        self.assertDictEqual(first_result['output'], result['output'])
+        self.assertTrue(os.path.exists(missing_uri))
+
+        # Report metadata still has all the reports
+        async_result = get_generated_report.delay(impact_analysis_uri)
+        generated_result = async_result.get()
+        self.assertDictEqual(
+            first_result['output'], generated_result['output'])
+
+    @retry_on_worker_lost_error()
+    def test_generate_report_components(self):
+        """Test generate report with selected components."""
+        # Run analysis first
+        result_delay = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+        result = result_delay.get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+
+        # Retrieve impact analysis uri
+        impact_analysis_uri = result['output'][
+            layer_purpose_exposure_summary['key']]
+
+        async_result = generate_report.delay(
+            impact_analysis_uri,
+            incremental=False,
+            components=['impact-report-pdf'])
+        result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        product_path = result['output']['pdf_product_tag'][
+            'impact-report-pdf']
+        self.assertTrue(os.path.exists(product_path))
+        # Other reports are not rendered
+        for products in result['output'].values():
+            self.assertNotIn('inasafe-map-report-landscape', products)
+            self.assertNotIn('action-checklist-pdf', products)
+
+        # Unknown components
+        async_result = generate_report.delay(
+            impact_analysis_uri, components=['unknown-component'])
+        result = async_result.get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_FAILED, result['status'])
+
+    @retry_on_worker_lost_error()
+    def test_generate_report_components_keep_others(self):
+        """Test rendering one component keeps the other products listed."""
+        result = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        impact_analysis_uri = result['output'][
+            layer_purpose_exposure_summary['key']]
+
+        result = generate_report.delay(impact_analysis_uri).get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        report_metadata = result['output']
+
+        for incremental in [False, True]:
+            result = generate_report.delay(
+                impact_analysis_uri,
+                incremental=incremental,
+                components=['impact-report-pdf']).get()
+            self.assertEqual(
+                ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+                result['message'])
+
+            result = get_generated_report.delay(impact_analysis_uri).get()
+            self.assertEqual(REPORT_METADATA_EXIST, result['status'])
+            for product_tag, products in report_metadata.items():
+                self.assertEqual(
+                    sorted(products), sorted(result['output'][product_tag]))
+
     @retry_on_worker_lost_error()
     def test_get_generated_report(self):
         """Test get generated report task."""
@@ -71,3 +71,12 @@ class TestGeoNodePush(unittest.TestCase):
         result = async_result.get()
         self.assertEqual(result['status'], GEONODE_UPLOAD_FAILED)
         self.assertTrue('Failed to login' in result['message'])
+
+    @retry_on_worker_lost_error()
+    def test_push_to_other_geonode_without_credentials(self):
+        """Test realtime credentials are not sent to another GeoNode."""
+        async_result = push_to_geonode.delay(
+            shakemap_layer_uri, geonode_url='http://other.geonode.test/')
+        result = async_result.get()
+        self.assertEqual(result['status'], GEONODE_UPLOAD_FAILED)
+        self.assertIn('is empty', result['message'])
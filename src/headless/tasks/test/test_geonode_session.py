@@ -0,0 +1,96 @@
+# coding=utf-8
+import unittest
+
+from headless.geonode_session import GeoNodeSessionPool, geonode_sessions
+from headless.tasks.inasafe_analysis import (
+    GEONODE_UPLOAD_SUCCESS,
+    GEONODE_UPLOAD_FAILED,
+    push_to_geonode,
+)
+from headless.tasks.test.geonode_server import GeoNodeServer
+from headless.tasks.test.helpers import shapefile_layer_uri
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestGeoNodeSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = GeoNodeServer(user='user', password='password')
+        self.server.start()
+        geonode_sessions.close()
+
+    def tearDown(self):
+        geonode_sessions.close()
+        self.server.stop()
+
+    def push(self, password='password'):
+        return push_to_geonode(
+            shapefile_layer_uri,
+            geonode_url=self.server.url,
+            geonode_user='user',
+            geonode_password=password)
+
+    def test_session_pool(self):
+        """Test sessions are reused until they expire."""
+        pool = GeoNodeSessionPool(max_age=3600)
+        session = pool.get(self.server.url, 'user', 'password')
+        self.assertIs(session, pool.get(self.server.url, 'user', 'password'))
+        self.assertEqual(1, self.server.logins)
+        self.assertTrue(pool.is_logged_in(self.server.url, session))
+
+        renewed_session = pool.get(
+            self.server.url, 'user', 'password', renew=True)
+        self.assertIsNot(session, renewed_session)
+        self.assertEqual(2, self.server.logins)
+
+        pool.max_age = -1
+        pool.get(self.server.url, 'user', 'password')
+        self.assertEqual(3, self.server.logins)
+
+        stats = pool.stats()
+        self.assertEqual(1, stats['size'])
+        self.assertEqual(3, stats['logins'])
+        self.assertEqual(1, stats['reuses'])
+        self.assertEqual(2, stats['expirations'])
+        pool.close()
+
+    def test_push_reuses_session(self):
+        """Test uploads in a burst only login once."""
+        for _ in range(3):
+            result = self.push()
+            self.assertEqual(
+                GEONODE_UPLOAD_SUCCESS, result['status'], result['message'])
+            self.assertIn('full_url', result['output'])
+            self.assertLess(0, result['throughput']['bytes'])
+        self.assertEqual(1, self.server.logins)
+        self.assertEqual(3, len(self.server.uploads))
+
+    def test_push_login_again(self):
+        """Test upload login again when GeoNode expired the session."""
+        result = self.push()
+        self.assertEqual(GEONODE_UPLOAD_SUCCESS, result['status'])
+
+        self.server.expire_sessions()
+        result = self.push()
+        self.assertEqual(
+            GEONODE_UPLOAD_SUCCESS, result['status'], result['message'])
+        self.assertEqual(2, self.server.logins)
+        self.assertEqual(2, len(self.server.uploads))
+
+    def test_push_login_failed(self):
+        """Test upload with wrong credentials."""
+        result = self.push(password='NotPassword')
+        self.assertEqual(GEONODE_UPLOAD_FAILED, result['status'])
+        self.assertTrue('Failed to login' in result['message'])
+        self.assertEqual(0, len(self.server.uploads))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from qgis.core import QgsMapLayerRegistry
+
+from headless import settings as headless_settings
+from headless import utils
+from headless.tasks.test.helpers import buildings_layer_uri, place_layer_uri
+from headless.utils import (
+    IngestCache,
+    layer_files,
+    load_input_layer,
+    load_layer,
+    provider_file_path)
+from safe.definitions.layer_purposes import layer_purpose_exposure
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestIngestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = IngestCache(os.path.join(self.temp_dir, 'ingest'))
+
+    def tearDown(self):
+        QgsMapLayerRegistry.instance().removeAllMapLayers()
+        shutil.rmtree(self.temp_dir)
+
+    def test_convert(self):
+        """Test the GeoPackage copy has the features and keywords."""
+        cached_path = self.cache.get(buildings_layer_uri)
+        self.assertTrue(cached_path.endswith('.gpkg'))
+        self.assertTrue(
+            os.path.exists(os.path.splitext(cached_path)[0] + '.xml'))
+        self.assertEqual(cached_path, self.cache.get(buildings_layer_uri))
+        self.assertEqual(
+            {'hits': 1, 'conversions': 1}, self.cache.stats())
+
+        original_layer = load_layer(buildings_layer_uri)[0]
+        layer, layer_purpose = load_layer(cached_path)
+        self.assertTrue(layer.isValid())
+        self.assertEqual(layer_purpose_exposure['key'], layer_purpose)
+        self.assertEqual(original_layer.featureCount(), layer.featureCount())
+        self.assertDictEqual(original_layer.keywords, layer.keywords)
+
+        # Other formats are not converted
+        self.assertIsNone(self.cache.get(buildings_layer_uri + '.qlr'))
+
+    def test_invalidation(self):
+        """Test a changed layer is converted again."""
+        layer_uri = os.path.join(self.temp_dir, 'places.geojson')
+        for path in layer_files(place_layer_uri):
+            shutil.copy(path, self.temp_dir)
+        cached_path = self.cache.get(layer_uri)
+
+        stat = os.stat(layer_uri)
+        os.utime(layer_uri, (stat.st_atime, stat.st_mtime + 10))
+        new_cached_path = self.cache.get(layer_uri)
+        self.assertNotEqual(cached_path, new_cached_path)
+        self.assertFalse(os.path.exists(cached_path))
+        self.assertTrue(os.path.exists(new_cached_path))
+        self.assertEqual(2, self.cache.stats()['conversions'])
+
+    @mock.patch.object(headless_settings, 'INGEST_CACHE_ENABLED', True)
+    def test_load_input_layer(self):
+        """Test input layers are loaded from their copy."""
+        with mock.patch.object(utils, 'ingest_cache', self.cache):
+            layer, layer_purpose = load_input_layer(buildings_layer_uri)
+        self.assertTrue(layer.isValid())
+        self.assertEqual(layer_purpose_exposure['key'], layer_purpose)
+        self.assertTrue(provider_file_path(layer).endswith('.gpkg'))
+        # Provenance still refers to the input layer
+        self.assertEqual(buildings_layer_uri, layer.source())
+        self.assertEqual('buildings', layer.name())
+
+
+if __name__ == '__main__':
+    unittest.main()
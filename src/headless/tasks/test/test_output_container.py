@@ -0,0 +1,176 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from headless.tasks.inasafe_wrapper import (
+    generate_report, run_analysis, run_multi_exposure_analysis)
+from headless.tasks.output_container import (
+    OUTPUT_CONTAINER_NAME, export_layer, output_layers, replace_uris)
+from headless.tasks.partitioned_analysis import (
+    open_vector_layer, split_layer_uri)
+from headless.tasks.test.helpers import (
+    aggregation_layer_uri,
+    buildings_layer_uri,
+    earthquake_layer_uri,
+    place_layer_uri,
+    retry_on_worker_lost_error)
+from headless.utils import (
+    layer_base_path, load_layer, metadata_file_path, read_metadata)
+from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.definitions.layer_purposes import (
+    layer_purpose_analysis_impacted, layer_purpose_exposure_summary)
+from safe.impact_function.impact_function import ImpactFunction
+from safe.report.impact_report import ImpactReport
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestOutputContainer(unittest.TestCase):
+
+    def test_output_layers(self):
+        """Test layers of each exposure get unique names."""
+        output = {
+            'analysis_summary': '/a/analysis_summary.geojson',
+            'structure': {
+                'analysis_summary': '/b/analysis_summary.geojson',
+            }
+        }
+        self.assertEqual(
+            [('analysis_summary', '/a/analysis_summary.geojson'),
+             ('structure_analysis_summary', '/b/analysis_summary.geojson')],
+            output_layers(output))
+
+    def test_replace_uris(self):
+        """Test uris are replaced in nested keywords."""
+        uri_map = {'/a/layer.geojson': '/a/outputs.gpkg|layername=layer'}
+        keywords = {
+            'layer_purpose': 'analysis_summary',
+            'provenance_data': {
+                'layer': '/a/layer.geojson',
+                'layers': ['/a/layer.geojson', '/a/other.geojson'],
+                'count': 1,
+            }
+        }
+        self.assertEqual({
+            'layer_purpose': 'analysis_summary',
+            'provenance_data': {
+                'layer': '/a/outputs.gpkg|layername=layer',
+                'layers': [
+                    '/a/outputs.gpkg|layername=layer', '/a/other.geojson'],
+                'count': 1,
+            }
+        }, replace_uris(keywords, uri_map))
+
+    def test_layer_base_path(self):
+        """Test files of GeoPackage layers are in a directory per package."""
+        self.assertEqual(
+            '/a/outputs/layer',
+            layer_base_path('/a/outputs.gpkg|layername=layer'))
+        self.assertEqual('/a/layer', layer_base_path('/a/layer.geojson'))
+
+    def check_container_output(self, output):
+        """Check all output layers are readable layers of one GeoPackage."""
+        container_paths = set()
+        for layer_name, layer_uri in output_layers(output):
+            path, name = split_layer_uri(layer_uri)
+            self.assertEqual(OUTPUT_CONTAINER_NAME, os.path.basename(path))
+            self.assertEqual(layer_name, name)
+            container_paths.add(path)
+            layer = load_layer(layer_uri)[0]
+            self.assertTrue(layer.isValid(), layer_uri)
+            self.assertIn('layer_purpose', layer.keywords)
+            # Keywords are readable by workers without them in their
+            # metadata database
+            self.assertEqual(
+                layer_base_path(layer_uri) + '.xml',
+                metadata_file_path(layer_uri))
+        self.assertEqual(1, len(container_paths))
+        container_path = container_paths.pop()
+        # The layer files are removed from the analysis directory
+        extensions = [
+            os.path.splitext(file_name)[1]
+            for file_name in os.listdir(os.path.dirname(container_path))]
+        self.assertNotIn('.geojson', extensions)
+        self.assertNotIn('.shp', extensions)
+        return container_path
+
+    @retry_on_worker_lost_error()
+    def test_run_analysis(self):
+        """Test analysis outputs are stored in a single GeoPackage."""
+        result = run_analysis.delay(
+            earthquake_layer_uri,
+            place_layer_uri,
+            aggregation_layer_uri,
+            output_geopackage=True).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        container_path = self.check_container_output(result['output'])
+
+        # The provenance refers to layers of the GeoPackage
+        impact_layer_uri = result['output'][
+            layer_purpose_analysis_impacted['key']]
+        impact_function = ImpactFunction.load_from_output_metadata(
+            read_metadata(impact_layer_uri))
+        self.assertEqual(
+            container_path,
+            split_layer_uri(impact_function.analysis_impacted.source())[0])
+
+        # Reports are generated from the GeoPackage
+        result = generate_report.delay(
+            result['output'][layer_purpose_exposure_summary['key']]).get()
+        self.assertEqual(
+            ImpactReport.REPORT_GENERATION_SUCCESS, result['status'],
+            result['message'])
+        for products in result['output'].values():
+            for product_uri in products.values():
+                self.assertTrue(os.path.exists(product_uri), product_uri)
+
+    @retry_on_worker_lost_error()
+    def test_run_multi_exposure_analysis(self):
+        """Test multi exposure outputs are stored in a single GeoPackage."""
+        result = run_multi_exposure_analysis.delay(
+            earthquake_layer_uri,
+            [place_layer_uri, buildings_layer_uri],
+            aggregation_layer_uri,
+            output_geopackage=True).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        self.check_container_output(result['output'])
+
+    @retry_on_worker_lost_error()
+    def test_export_layer(self):
+        """Test a GeoPackage layer is exported with its keywords."""
+        result = run_analysis.delay(
+            earthquake_layer_uri,
+            place_layer_uri,
+            aggregation_layer_uri,
+            output_geopackage=True).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        layer_uri = result['output'][layer_purpose_analysis_impacted['key']]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            shapefile_path = export_layer(layer_uri, temp_dir)
+            self.assertTrue(os.path.exists(
+                os.path.splitext(shapefile_path)[0] + '.xml'))
+            data_source, layer = open_vector_layer(layer_uri)
+            feature_count = layer.GetFeatureCount()
+            data_source = None
+            data_source, layer = open_vector_layer(shapefile_path)
+            self.assertEqual(feature_count, layer.GetFeatureCount())
+            del data_source
+            self.assertEqual(
+                read_metadata(layer_uri)['layer_purpose'],
+                read_metadata(shapefile_path)['layer_purpose'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
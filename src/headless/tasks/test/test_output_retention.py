@@ -0,0 +1,193 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from headless import settings as headless_settings
+from headless.tasks.output_retention import (
+    OUTPUT_RETENTION_GRACE_PERIOD,
+    OutputRetention,
+    exclusive_output_lock,
+    get_output_retention,
+    output_lock_path,
+    outputs_in_use)
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestOutputRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_directory(self, name, size, age):
+        """Create an output directory with a file of size bytes.
+
+        :return: Path to the file.
+        :rtype: basestring
+        """
+        path = os.path.join(self.temp_dir, name)
+        os.makedirs(path)
+        file_path = os.path.join(path, 'layer.geojson')
+        with open(file_path, 'wb') as f:
+            f.write(b'0' * size)
+        mtime = time.time() - age
+        os.utime(file_path, (mtime, mtime))
+        os.utime(path, (mtime, mtime))
+        return file_path
+
+    def test_max_age(self):
+        """Test directories not accessed for too long are evicted."""
+        old_age = OUTPUT_RETENTION_GRACE_PERIOD + 3600
+        self.create_directory('old', 10, old_age)
+        self.create_directory('recent', 10, OUTPUT_RETENTION_GRACE_PERIOD)
+        self.create_directory('spatial_index', 10, old_age)
+        retention = OutputRetention(self.temp_dir, max_age=old_age - 60)
+
+        self.assertEqual(['old'], retention.collect_garbage())
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'old')))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_dir, 'recent')))
+        # Cache directories are not managed
+        self.assertTrue(
+            os.path.exists(os.path.join(self.temp_dir, 'spatial_index')))
+
+        stats = retention.stats()
+        self.assertEqual(1, stats['steps'])
+        self.assertEqual(1, stats['evicted'])
+        self.assertEqual(10, stats['evicted_bytes'])
+        self.assertEqual(1, stats['directories'])
+        self.assertEqual(10, stats['size'])
+
+    def test_max_size(self):
+        """Test least recently used directories are evicted above budget."""
+        age = OUTPUT_RETENTION_GRACE_PERIOD + 3600
+        for index, name in enumerate(['a', 'b', 'c', 'd']):
+            self.create_directory(name, 100, age - index * 60)
+        retention = OutputRetention(self.temp_dir, max_size=250)
+
+        self.assertEqual(['a', 'b'], retention.collect_garbage())
+        self.assertEqual(
+            ['c', 'd'], sorted(retention.managed_directories()))
+        self.assertEqual([], retention.collect_garbage())
+        self.assertEqual(200, retention.stats()['size'])
+
+    def test_incremental(self):
+        """Test a step scans and evicts a bounded number of directories."""
+        age = OUTPUT_RETENTION_GRACE_PERIOD + 3600
+        for index in range(5):
+            self.create_directory('analysis_%d' % index, 10, age)
+        retention = OutputRetention(self.temp_dir, max_age=60, batch_size=2)
+
+        self.assertEqual(2, len(retention.collect_garbage()))
+        self.assertEqual(3, len(retention.managed_directories()))
+        retention.collect_garbage()
+        retention.collect_garbage()
+        self.assertEqual([], retention.managed_directories())
+        self.assertEqual(5, retention.stats()['evicted'])
+
+    def test_in_use(self):
+        """Test directories used by a task are never evicted."""
+        age = OUTPUT_RETENTION_GRACE_PERIOD + 3600
+        layer_path = self.create_directory('contour_shakemap', 10, age)
+        retention = OutputRetention(self.temp_dir, max_age=60)
+
+        with retention.in_use([layer_path, None, '/elsewhere/layer.shp']):
+            self.assertEqual([], retention.collect_garbage())
+            self.assertEqual(0, retention.stats()['skipped_in_use'])
+        self.assertTrue(os.path.exists(layer_path))
+
+        # Using it is an access, then it expires again
+        entry_age = age + 60
+        with retention.in_use(['%s|layername=contour' % layer_path]):
+            with retention._index() as index:
+                index['directories']['contour_shakemap']['accessed'] -= (
+                    entry_age)
+            self.assertEqual([], retention.collect_garbage())
+            self.assertEqual(1, retention.stats()['skipped_in_use'])
+        self.assertEqual(['contour_shakemap'], retention.collect_garbage())
+
+    def test_lock_files(self):
+        """Test lock files of deleted directories are removed."""
+        age = OUTPUT_RETENTION_GRACE_PERIOD + 3600
+        old_path = self.create_directory('old', 10, age)
+        recent_path = self.create_directory('recent', 10, 0)
+        retention = OutputRetention(self.temp_dir, max_age=60)
+        with retention.in_use([old_path, recent_path]):
+            pass
+        # Lock file of a directory deleted by hand
+        gone_lock_path = output_lock_path(self.temp_dir, 'gone')
+        open(gone_lock_path, 'a').close()
+
+        self.assertEqual(['old'], retention.collect_garbage())
+        self.assertFalse(
+            os.path.exists(output_lock_path(self.temp_dir, 'old')))
+        self.assertFalse(os.path.exists(gone_lock_path))
+        self.assertTrue(
+            os.path.exists(output_lock_path(self.temp_dir, 'recent')))
+
+        # A task locking a deleted directory gets a new lock file
+        with retention.in_use([old_path]):
+            self.assertTrue(
+                os.path.exists(output_lock_path(self.temp_dir, 'old')))
+            with exclusive_output_lock(self.temp_dir, 'old') as locked:
+                self.assertFalse(locked)
+
+    def test_directory_name(self):
+        """Test layers are mapped to their output directory."""
+        retention = OutputRetention(self.temp_dir)
+        self.assertEqual('analysis', retention.directory_name(
+            os.path.join(self.temp_dir, 'analysis', 'sub', 'layer.shp')))
+        self.assertEqual('analysis', retention.directory_name(
+            os.path.join(self.temp_dir, 'analysis', 'outputs.gpkg') +
+            '|layername=impact'))
+        self.assertIsNone(retention.directory_name(
+            os.path.join(self.temp_dir, 'result_cache.json')))
+        self.assertIsNone(retention.directory_name(
+            os.path.join(self.temp_dir, 'ingest_cache', 'layer.gpkg')))
+        self.assertIsNone(retention.directory_name('/elsewhere/layer.shp'))
+
+    def test_disabled(self):
+        """Test retention is disabled without budget or maximum age."""
+        with mock.patch.multiple(
+                headless_settings,
+                OUTPUT_DIRECTORY=self.temp_dir,
+                OUTPUT_RETENTION_MAX_SIZE=0,
+                OUTPUT_RETENTION_MAX_AGE=0,
+                CONTOUR_CACHE_ENABLED=False):
+            self.assertIsNone(get_output_retention())
+            with outputs_in_use([os.path.join(self.temp_dir, 'a', 'b')]):
+                pass
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, 'output_retention.json')))
+
+    def test_contour_cache_locks(self):
+        """Test outputs are locked for the contour cache without retention.
+        """
+        with mock.patch.multiple(
+                headless_settings,
+                OUTPUT_DIRECTORY=self.temp_dir,
+                OUTPUT_RETENTION_MAX_SIZE=0,
+                OUTPUT_RETENTION_MAX_AGE=0,
+                CONTOUR_CACHE_ENABLED=True):
+            with outputs_in_use([os.path.join(self.temp_dir, 'a', 'b')]):
+                with exclusive_output_lock(self.temp_dir, 'a') as locked:
+                    self.assertFalse(locked)
+            with exclusive_output_lock(self.temp_dir, 'a') as locked:
+                self.assertTrue(locked)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, 'output_retention.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import ogr
+
+from headless.tasks.inasafe_wrapper import run_analysis
+from headless.tasks.partitioned_analysis import (
+    balanced_groups,
+    grid_cells,
+    merge_layers,
+    open_vector_layer,
+    partition_aggregation)
+from headless.tasks.test.helpers import (
+    aggregation_layer_uri,
+    earthquake_layer_uri,
+    place_layer_uri,
+    retry_on_worker_lost_error)
+from headless.utils import read_metadata
+from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.definitions.fields import (
+    analysis_id_field,
+    female_count_field,
+    female_ratio_field,
+    total_affected_field)
+from safe.definitions.layer_purposes import (
+    layer_purpose_aggregation_summary,
+    layer_purpose_analysis_impacted)
+from safe.definitions.provenance import (
+    provenance_aggregation_layer,
+    provenance_analysis_extent,
+    provenance_data_store_uri)
+from safe.test.utilities import get_qgis_app
+from safe.utilities.metadata import write_iso19115_metadata
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def read_features(layer_uri):
+    """Read the attributes of the features of a layer."""
+    data_source, layer = open_vector_layer(layer_uri)
+    features = [feature.items() for feature in layer]
+    del data_source
+    return features
+
+
+class TestPartitionedAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_grid_cells(self):
+        """Test grid cells are balanced and keep every feature."""
+        centroids = [(i, i % 10, i // 10) for i in range(100)]
+        cells = grid_cells(centroids, 4)
+        self.assertEqual(4, len(cells))
+        self.assertEqual([25] * 4, [len(cell) for cell in cells])
+        self.assertEqual(range(100), sorted(sum(cells, [])))
+        # Cells are compact: the first cell is the lower left quarter
+        self.assertEqual(
+            sorted(i for i, x, y in centroids if x < 5 and y < 5),
+            sorted(cells[0]))
+
+        # Less features than partitions
+        self.assertEqual(2, len(grid_cells(centroids[:2], 4)))
+
+    def test_balanced_groups(self):
+        """Test groups are distributed in partitions of similar size."""
+        sizes = {'a': 5, 'b': 3, 'c': 2, 'd': 1, 'e': 1}
+        partitions = balanced_groups(sizes, 2)
+        self.assertEqual(2, len(partitions))
+        self.assertEqual(
+            [6, 6],
+            sorted(sum(sizes[g] for g in groups) for groups in partitions))
+
+    def test_partition_aggregation(self):
+        """Test aggregation partitions keep features and keywords."""
+        partition_uris = partition_aggregation(
+            aggregation_layer_uri, 2, output_directory=self.temp_dir)
+        self.assertEqual(2, len(partition_uris))
+        features = []
+        for partition_uri in partition_uris:
+            partition_features = read_features(partition_uri)
+            self.assertLess(0, len(partition_features))
+            features.extend(partition_features)
+            self.assertEqual(
+                read_metadata(aggregation_layer_uri)['layer_purpose'],
+                read_metadata(partition_uri)['layer_purpose'])
+        self.assertEqual(
+            sorted(read_features(aggregation_layer_uri)), sorted(features))
+
+        # Partitions are reused
+        self.assertEqual(
+            partition_uris,
+            partition_aggregation(
+                aggregation_layer_uri, 2, output_directory=self.temp_dir))
+
+    @retry_on_worker_lost_error()
+    def test_merge_layers(self):
+        """Test only counts and totals are summed when merging a summary."""
+        fields = [
+            (analysis_id_field, ogr.OFTInteger),
+            (total_affected_field, ogr.OFTInteger),
+            (female_count_field, ogr.OFTInteger),
+            (female_ratio_field, ogr.OFTReal),
+        ]
+        keywords = {
+            'layer_purpose': layer_purpose_analysis_impacted['key'],
+            'inasafe_fields': {
+                field['key']: field['field_name'] for field, _ in fields},
+        }
+        driver = ogr.GetDriverByName('GeoJSON')
+        layer_uris = []
+        for index, values in enumerate([(1, 50, 30, 0.3), (1, 70, 60, 0.6)]):
+            layer_uri = os.path.join(self.temp_dir, 'part_%d.geojson' % index)
+            data_source = driver.CreateDataSource(layer_uri)
+            layer = data_source.CreateLayer('analysis', None, ogr.wkbPolygon)
+            for field, field_type in fields:
+                layer.CreateField(
+                    ogr.FieldDefn(field['field_name'], field_type))
+            feature = ogr.Feature(layer.GetLayerDefn())
+            for (field, _), value in zip(fields, values):
+                feature.SetField(field['field_name'], value)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                'POLYGON ((%d 0, %d 1, %d 1, %d 0, %d 0))' % (
+                    index, index, index + 1, index + 1, index)))
+            layer.CreateFeature(feature)
+            data_source = None
+            write_iso19115_metadata(layer_uri, keywords)
+            layer_uris.append(layer_uri)
+
+        output_uri = os.path.join(self.temp_dir, 'merged.geojson')
+        merge_layers(
+            layer_uris, output_uri, layer_purpose_analysis_impacted['key'])
+        features = read_features(output_uri)
+        self.assertEqual(1, len(features))
+        self.assertEqual(1, features[0][analysis_id_field['field_name']])
+        self.assertEqual(120, features[0][total_affected_field['field_name']])
+        self.assertEqual(90, features[0][female_count_field['field_name']])
+        # 90 females in a population of 100 + 100
+        self.assertAlmostEqual(
+            0.45, features[0][female_ratio_field['field_name']])
+
+    def test_run_partitioned_analysis(self):
+        """Test partitioned analysis gives the same outputs as one run."""
+        single_result = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri).get()
+        self.assertEqual(
+            ANALYSIS_SUCCESS, single_result['status'],
+            single_result['message'])
+
+        result = run_analysis.delay(
+            earthquake_layer_uri,
+            place_layer_uri,
+            aggregation_layer_uri,
+            partitions=2).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        self.assertEqual(
+            sorted(single_result['output'].keys()),
+            sorted(result['output'].keys()))
+        for layer_purpose, layer_uri in result['output'].items():
+            self.assertTrue(os.path.exists(layer_uri))
+            self.assertEqual(
+                layer_purpose, read_metadata(layer_uri)['layer_purpose'])
+
+        # Provenance of the merged analysis
+        analysis_key = layer_purpose_analysis_impacted['key']
+        analysis_uri = result['output'][analysis_key]
+        provenance = read_metadata(analysis_uri)['provenance_data']
+        single_provenance = read_metadata(
+            single_result['output'][analysis_key])['provenance_data']
+        self.assertEqual(
+            aggregation_layer_uri,
+            provenance[provenance_aggregation_layer['provenance_key']])
+        self.assertEqual(
+            os.path.dirname(analysis_uri),
+            provenance[provenance_data_store_uri['provenance_key']])
+        extent_key = provenance_analysis_extent['provenance_key']
+        self.assertAlmostEqual(
+            ogr.CreateGeometryFromWkt(
+                str(single_provenance[extent_key])).GetArea(),
+            ogr.CreateGeometryFromWkt(str(provenance[extent_key])).GetArea(),
+            places=6)
+
+        # Same aggregation areas
+        aggregation_key = layer_purpose_aggregation_summary['key']
+        self.assertEqual(
+            len(read_features(single_result['output'][aggregation_key])),
+            len(read_features(result['output'][aggregation_key])))
+
+        # Same analysis summary
+        single_summary = read_features(
+            single_result['output'][analysis_key])
+        summary = read_features(result['output'][analysis_key])
+        self.assertEqual(1, len(summary))
+        for name, value in single_summary[0].items():
+            if isinstance(value, (int, long, float)):
+                self.assertAlmostEqual(value, summary[0][name], places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
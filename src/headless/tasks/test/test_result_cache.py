@@ -0,0 +1,138 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from headless.celeryconfig import task_always_eager
+from headless.tasks.inasafe_wrapper import run_analysis
+from headless.tasks.result_cache import (
+    ResultCache,
+    analysis_key,
+    RESULT_CACHE_HIT,
+    RESULT_CACHE_MISS)
+from headless.tasks.test.helpers import (
+    earthquake_layer_uri, place_layer_uri, aggregation_layer_uri,
+    retry_on_worker_lost_error)
+from headless.utils import layer_digest
+from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_result(self, name):
+        """Create a fake analysis result with an existing output file."""
+        path = os.path.join(self.temp_dir, name)
+        open(path, 'w').close()
+        return {
+            'status': ANALYSIS_SUCCESS,
+            'message': '',
+            'output': {
+                'impact_analysis': path
+            }
+        }
+
+    def test_analysis_key(self):
+        """Test analysis key depends on the inputs."""
+        key = analysis_key(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri)
+        self.assertEqual(key, analysis_key(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri))
+        self.assertNotEqual(key, analysis_key(
+            earthquake_layer_uri, place_layer_uri))
+        self.assertNotEqual(key, analysis_key(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri,
+            locale='id'))
+        # Multi exposure with one exposure is a different analysis
+        self.assertNotEqual(key, analysis_key(
+            earthquake_layer_uri, [place_layer_uri], aggregation_layer_uri))
+        self.assertNotEqual(key, analysis_key(
+            earthquake_layer_uri, place_layer_uri, aggregation_layer_uri,
+            use_exposure_view_only=False))
+
+    def test_layer_digest(self):
+        """Test layer digest ignores files written by GDAL and QGIS."""
+        layer_uri = os.path.join(self.temp_dir, 'hazard.asc')
+        shutil.copy(earthquake_layer_uri, layer_uri)
+        shutil.copy(
+            os.path.splitext(earthquake_layer_uri)[0] + '.xml',
+            os.path.join(self.temp_dir, 'hazard.xml'))
+        digest = layer_digest(layer_uri)
+
+        with open(layer_uri + '.aux.xml', 'w') as f:
+            f.write('<PAMDataset></PAMDataset>')
+        self.assertEqual(digest, layer_digest(layer_uri))
+
+        with open(os.path.join(self.temp_dir, 'hazard.xml'), 'a') as f:
+            f.write('\n')
+        self.assertNotEqual(digest, layer_digest(layer_uri))
+
+    def test_get_put(self):
+        """Test result is returned until its outputs are gone."""
+        cache = ResultCache(self.temp_dir)
+        self.assertIsNone(cache.get('key'))
+
+        result = self.create_result('impact.geojson')
+        cache.put('key', result)
+        self.assertDictEqual(result, cache.get('key'))
+
+        # The index is shared between instances
+        self.assertDictEqual(result, ResultCache(self.temp_dir).get('key'))
+
+        os.remove(result['output']['impact_analysis'])
+        self.assertIsNone(cache.get('key'))
+
+    def test_eviction(self):
+        """Test entries are evicted by count and by age."""
+        cache = ResultCache(self.temp_dir, max_entries=2)
+        for i in range(3):
+            cache.put('key_%d' % i, self.create_result('impact_%d' % i))
+        self.assertIsNone(cache.get('key_0'))
+        self.assertIsNotNone(cache.get('key_1'))
+        self.assertIsNotNone(cache.get('key_2'))
+
+        cache = ResultCache(self.temp_dir, max_age=10)
+        with mock.patch('time.time', return_value=time.time() + 20):
+            self.assertIsNone(cache.get('key_1'))
+
+    @unittest.skipUnless(
+        task_always_eager,
+        'This test is only relevant on sync mode')
+    @retry_on_worker_lost_error()
+    def test_run_analysis_cached(self):
+        """Test run_analysis returns cached result for identical inputs."""
+        # Settings are reloaded from environment by start_inasafe
+        patched_env = {
+            'HEADLESS_RESULT_CACHE_ENABLED': 'True'
+        }
+        with mock.patch.dict(os.environ, patched_env):
+            result = run_analysis.delay(
+                earthquake_layer_uri, place_layer_uri,
+                aggregation_layer_uri).get()
+            self.assertEqual(
+                ANALYSIS_SUCCESS, result['status'], result['message'])
+
+            cached_result = run_analysis.delay(
+                earthquake_layer_uri, place_layer_uri,
+                aggregation_layer_uri).get()
+            self.assertIn(
+                result['cache'], [RESULT_CACHE_HIT, RESULT_CACHE_MISS])
+            self.assertEqual(RESULT_CACHE_HIT, cached_result['cache'])
+            self.assertDictEqual(result['output'], cached_result['output'])
@@ -4,8 +4,13 @@ import unittest
 from distutils.util import strtobool
 
 from headless.settings import OUTPUT_DIRECTORY
+from headless.tasks.inasafe_analysis import (
+    BATCH_ANALYSIS_SUCCESS,
+    BATCH_ANALYSIS_PARTIAL_FAILURE,
+    BATCH_ANALYSIS_FAILED)
 from headless.tasks.inasafe_wrapper import (
     run_analysis,
+    run_analysis_batch,
     run_multi_exposure_analysis,
     generate_report,
 )
@@ -14,7 +19,8 @@ from headless.tasks.test.helpers import earthquake_layer_uri, \
     aggregation_layer_uri, buildings_layer_uri, \
     population_multi_fields_layer_uri, buildings_layer_qlr_uri, \
     retry_on_worker_lost_error
-from safe.definitions.constants import ANALYSIS_SUCCESS
+from safe.definitions.constants import (
+    ANALYSIS_SUCCESS, ANALYSIS_FAILED_BAD_INPUT)
 from safe.definitions.layer_purposes import (
     layer_purpose_exposure_summary)
 from safe.report.impact_report import ImpactReport
@@ -43,6 +49,18 @@ class TestRunAnalysis(unittest.TestCase):
             self.assertTrue(os.path.exists(layer_uri))
             self.assertTrue(layer_uri.startswith(OUTPUT_DIRECTORY))
 
+        # Check task metrics
+        metrics = result['metrics']
+        for phase in ['init', 'load', 'prepare', 'run']:
+            self.assertIn(phase, metrics['phases'])
+            self.assertLessEqual(0, metrics['phases'][phase]['wall'])
+        self.assertLess(0, metrics['peak_rss'])
+        self.assertLess(0, metrics['inputs'][place_layer_uri]['features'])
+        self.assertLess(0, metrics['inputs'][earthquake_layer_uri]['pixels'])
+        for key, size in metrics['outputs'].items():
+            self.assertIn(key, result['output'])
+            self.assertLess(0, size)
+
         # No aggregation
         result_delay = run_analysis.delay(
             earthquake_layer_uri, place_layer_uri)
@@ -53,6 +71,56 @@ class TestRunAnalysis(unittest.TestCase):
             self.assertTrue(os.path.exists(layer_uri))
             self.assertTrue(layer_uri.startswith(OUTPUT_DIRECTORY))
 
+    @retry_on_worker_lost_error()
+    def test_run_analysis_invalid_crs(self):
+        """Test an invalid CRS fails the analysis without retrying it."""
+        result = run_analysis.delay(
+            earthquake_layer_uri, place_layer_uri, crs='not a crs').get()
+        self.assertEqual(ANALYSIS_FAILED_BAD_INPUT, result['status'])
+        self.assertIn('not a crs', result['message'])
+
+    @retry_on_worker_lost_error()
+    def test_run_analysis_batch(self):
+        """Test run analysis batch."""
+        jobs = [
+            (place_layer_uri, aggregation_layer_uri, None),
+            (buildings_layer_uri, ),
+            # Invalid exposure should fail without affecting other jobs
+            ('/not/exist.geojson', aggregation_layer_uri, None),
+            (population_multi_fields_layer_uri, None, None),
+        ]
+        result_delay = run_analysis_batch.delay(earthquake_layer_uri, jobs)
+        result = result_delay.get()
+        self.assertEqual(
+            BATCH_ANALYSIS_PARTIAL_FAILURE, result['status'],
+            result['message'])
+        self.assertEqual(len(jobs), len(result['output']))
+        for index, job_result in enumerate(result['output']):
+            if index == 2:
+                self.assertNotEqual(ANALYSIS_SUCCESS, job_result['status'])
+                self.assertDictEqual({}, job_result['output'])
+                continue
+            self.assertEqual(
+                ANALYSIS_SUCCESS, job_result['status'],
+                job_result['message'])
+            self.assertLess(0, len(job_result['output']))
+            for key, layer_uri in job_result['output'].items():
+                self.assertTrue(os.path.exists(layer_uri))
+                self.assertTrue(layer_uri.startswith(OUTPUT_DIRECTORY))
+
+        # All succeed
+        result_delay = run_analysis_batch.delay(
+            earthquake_layer_uri, jobs[:2])
+        result = result_delay.get()
+        self.assertEqual(
+            BATCH_ANALYSIS_SUCCESS, result['status'], result['message'])
+
+        # Invalid hazard, all jobs fail
+        result_delay = run_analysis_batch.delay(place_layer_uri, jobs[:2])
+        result = result_delay.get()
+        self.assertEqual(BATCH_ANALYSIS_FAILED, result['status'])
+        self.assertEqual(2, len(result['output']))
+
     @retry_on_worker_lost_error()
     def test_run_multi_exposure_analysis(self):
         """Test run multi_exposure analysis."""
@@ -101,6 +169,52 @@ class TestRunAnalysis(unittest.TestCase):
         # of exposures
         self.assertEqual(num_exposure_output, len(exposure_layer_uris))
 
+    @retry_on_worker_lost_error()
+    def test_run_multi_exposure_analysis_parallel(self):
+        """Test run multi_exposure analysis with parallel exposures."""
+        exposure_layer_uris = [
+            place_layer_uri,
+            buildings_layer_uri,
+            population_multi_fields_layer_uri
+        ]
+        serial_result = run_multi_exposure_analysis.delay(
+            earthquake_layer_uri,
+            exposure_layer_uris,
+            aggregation_layer_uri).get()
+        self.assertEqual(
+            ANALYSIS_SUCCESS, serial_result['status'],
+            serial_result['message'])
+
+        result = run_multi_exposure_analysis.delay(
+            earthquake_layer_uri,
+            exposure_layer_uris,
+            aggregation_layer_uri,
+            parallel=True).get()
+        self.assertEqual(ANALYSIS_SUCCESS, result['status'], result['message'])
+        # Same outputs as the serial analysis
+        self.assertEqual(
+            sorted(serial_result['output'].keys()),
+            sorted(result['output'].keys()))
+        for key, layer_uri in result['output'].items():
+            if isinstance(layer_uri, dict):
+                self.assertEqual(
+                    sorted(serial_result['output'][key].keys()),
+                    sorted(layer_uri.keys()))
+                for the_layer_uri in layer_uri.values():
+                    self.assertTrue(os.path.exists(the_layer_uri))
+            else:
+                self.assertTrue(os.path.exists(layer_uri))
+                self.assertTrue(layer_uri.startswith(OUTPUT_DIRECTORY))
+
+        # An invalid CRS fails before the subtasks are started
+        result = run_multi_exposure_analysis.delay(
+            earthquake_layer_uri,
+            exposure_layer_uris,
+            crs='not a crs',
+            parallel=True).get()
+        self.assertEqual(ANALYSIS_FAILED_BAD_INPUT, result['status'])
+        self.assertIn('not a crs', result['message'])
+
     @unittest.skipIf(
         strtobool(os.environ.get('ON_TRAVIS', 'False')),
         """Skipped because we don't have remote service QLR anymore.""")
@@ -119,6 +233,18 @@ class TestRunAnalysis(unittest.TestCase):
             self.assertTrue(os.path.exists(layer_uri))
             self.assertTrue(layer_uri.startswith(OUTPUT_DIRECTORY))
 
+        # Check task metrics
+        metrics = result['metrics']
+        for phase in ['init', 'load', 'prepare', 'run']:
+            self.assertIn(phase, metrics['phases'])
+            self.assertLessEqual(0, metrics['phases'][phase]['wall'])
+        self.assertLess(0, metrics['peak_rss'])
+        self.assertLess(0, metrics['inputs'][place_layer_uri]['features'])
+        self.assertLess(0, metrics['inputs'][earthquake_layer_uri]['pixels'])
+        for key, size in metrics['outputs'].items():
+            self.assertIn(key, result['output'])
+            self.assertLess(0, size)
+
         # No aggregation
         result_delay = run_analysis.delay(
             earthquake_layer_uri, buildings_layer_qlr_uri)
@@ -0,0 +1,60 @@
+# coding=utf-8
+import json
+import unittest
+from datetime import datetime
+
+from PyQt4.QtCore import QUrl
+from qgis.core import QgsCoordinateReferenceSystem
+
+from headless.serialization import (
+    parse_crs,
+    to_plain,
+    serializable_result)
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_parse_crs(self):
+        """Test CRS is rebuilt from EPSG code, authority id and WKT."""
+        crs = QgsCoordinateReferenceSystem('EPSG:4326')
+        self.assertIs(crs, parse_crs(crs))
+        self.assertIsNone(parse_crs(None))
+        self.assertEqual('EPSG:4326', parse_crs(4326).authid())
+        self.assertEqual('EPSG:4326', parse_crs('EPSG:4326').authid())
+        self.assertEqual('EPSG:4326', parse_crs(crs.toWkt()).authid())
+        with self.assertRaises(ValueError):
+            parse_crs('not a crs')
+
+    def test_to_plain(self):
+        """Test result is converted to JSON compatible types."""
+        result = {
+            'url': QUrl('http://inasafe.org'),
+            'date': datetime(2018, 1, 25, 9, 25),
+            'crs': QgsCoordinateReferenceSystem('EPSG:4326'),
+            'nested': {
+                'list': (1, 'a', None)
+            }
+        }
+        expected = {
+            'url': 'http://inasafe.org',
+            'date': '2018-01-25T09:25:00',
+            'crs': 'EPSG:4326',
+            'nested': {
+                'list': [1, 'a', None]
+            }
+        }
+        plain = to_plain(result)
+        self.assertDictEqual(expected, plain)
+        self.assertDictEqual(expected, json.loads(json.dumps(plain)))
+
+        # Pickle results are not changed
+        self.assertIs(result, serializable_result(result, 'pickle'))
+        self.assertDictEqual(expected, serializable_result(result, 'json'))
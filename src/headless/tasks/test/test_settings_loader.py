@@ -1,17 +1,20 @@
 # coding=utf-8
 import os
+import shutil
+import tempfile
 import unittest
 
 import mock
 from qgis.core import QgsApplication
 
-from headless.celery_app import start_inasafe
+from headless.celery_app import (
+    start_inasafe, init_info, INIT_MODE_COLD, INIT_MODE_WARM)
 from headless.celeryconfig import task_always_eager
 from headless.tasks.test.helpers import settings_path, \
     minimum_needs_mapping_path
 from safe.gui.tools.minimum_needs.needs_profile import NeedsProfile
 from safe.test.utilities import get_qgis_app
-from safe.utilities.settings import setting
+from safe.utilities.settings import set_setting, setting
 
 QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
 
@@ -138,3 +141,94 @@ class TestSettingsLoader(unittest.TestCase):
             self.assertEqual(
                 'The minimum needs are based on Perka 7/2008.',
                 profile.provenance)
+
+    @unittest.skipUnless(
+        task_always_eager,
+        'This test is only relevant on sync mode')
+    def test_warm_init(self):
+        """Test start_inasafe skips reinitialization on unchanged state."""
+        patched_env = {
+            'INASAFE_SETTINGS_PATH': settings_path,
+            'MINIMUM_NEEDS_LOCALE_MAPPING_PATH': minimum_needs_mapping_path
+        }
+        with mock.patch.dict(os.environ, patched_env):
+            start_inasafe('id', force=True)
+            self.assertEqual(INIT_MODE_COLD, init_info()['mode'])
+
+            # Same state, should be a warm init
+            start_inasafe('id')
+            self.assertEqual(INIT_MODE_WARM, init_info()['mode'])
+            self.assertEqual(
+                setting('reportDisclaimer'),
+                'om telolet om. kasih telolet yaaa.')
+
+            # Settings changed by a previous task are reset
+            set_setting('reportDisclaimer', 'changed')
+            start_inasafe('id')
+            self.assertEqual(INIT_MODE_WARM, init_info()['mode'])
+            self.assertEqual(
+                setting('reportDisclaimer'),
+                'om telolet om. kasih telolet yaaa.')
+
+            # Different locale, should be a cold init
+            start_inasafe('en')
+            self.assertEqual(INIT_MODE_COLD, init_info()['mode'])
+
+        # Changed settings path, should be a cold init
+        patched_env = {
+            'INASAFE_SETTINGS_PATH': ''
+        }
+        with mock.patch.dict(os.environ, patched_env):
+            start_inasafe('en')
+            self.assertEqual(INIT_MODE_COLD, init_info()['mode'])
+
+    @unittest.skipUnless(
+        task_always_eager,
+        'This test is only relevant on sync mode')
+    def test_changed_minimum_needs_profile(self):
+        """Test a changed minimum needs profile is a cold init."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            settings_directory = os.path.join(temp_dir, 'settings')
+            shutil.copytree(
+                os.path.dirname(minimum_needs_mapping_path),
+                settings_directory)
+            mapping_path = os.path.join(
+                settings_directory,
+                os.path.basename(minimum_needs_mapping_path))
+            patched_env = {
+                'MINIMUM_NEEDS_LOCALE_MAPPING_PATH': mapping_path
+            }
+            with mock.patch.dict(os.environ, patched_env):
+                start_inasafe('id', force=True)
+                start_inasafe('id')
+                self.assertEqual(INIT_MODE_WARM, init_info()['mode'])
+
+                profile_path = os.path.join(
+                    settings_directory, 'minimum_needs', 'BNPB_id.json')
+                with open(profile_path, 'a') as f:
+                    f.write('\n')
+                start_inasafe('id')
+                self.assertEqual(INIT_MODE_COLD, init_info()['mode'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(
+        task_always_eager,
+        'This test is only relevant on sync mode')
+    def test_definitions_snapshot(self):
+        """Test locale switch restores definitions from snapshot."""
+        patched_env = {
+            'MINIMUM_NEEDS_LOCALE_MAPPING_PATH': minimum_needs_mapping_path
+        }
+        with mock.patch.dict(os.environ, patched_env):
+            start_inasafe('id')
+            from safe.definitions import minimum_needs
+            id_fields = minimum_needs.minimum_needs_fields
+
+            start_inasafe('en')
+            self.assertIsNot(id_fields, minimum_needs.minimum_needs_fields)
+
+            # Switching back uses the same definitions objects
+            start_inasafe('id')
+            self.assertIs(id_fields, minimum_needs.minimum_needs_fields)
@@ -0,0 +1,83 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import ogr
+
+from headless.spatial_index import SpatialIndexCache
+from headless.tasks.test.helpers import buildings_layer_uri
+from headless.utils import layer_files
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def envelopes(layer_uri):
+    """Read the bounding box of each feature of a layer."""
+    data_source = ogr.Open(layer_uri)
+    boxes = dict(
+        (feature.GetFID(), feature.GetGeometryRef().GetEnvelope())
+        for feature in data_source.GetLayer())
+    data_source = None
+    return boxes
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = SpatialIndexCache(os.path.join(self.temp_dir, 'index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_intersects(self):
+        """Test index queries find the same features as a full scan."""
+        index = self.cache.get(buildings_layer_uri)
+        boxes = envelopes(buildings_layer_uri)
+        self.assertEqual(len(boxes), len(index))
+
+        x_min, y_min, x_max, y_max = index.extent()
+        rectangle = (
+            x_min, y_min, (x_min + x_max) / 2, (y_min + y_max) / 2)
+        expected = sorted(
+            fid for fid, (left, right, bottom, top) in boxes.items()
+            if left <= rectangle[2] and right >= rectangle[0]
+            and bottom <= rectangle[3] and top >= rectangle[1])
+        self.assertLess(0, len(expected))
+        self.assertEqual(expected, list(index.intersects(*rectangle)))
+        self.assertEqual(
+            sorted(boxes), list(index.intersects(*index.extent())))
+
+    def test_cache(self):
+        """Test indexes are built once per layer version."""
+        layer_uri = os.path.join(self.temp_dir, 'buildings.geojson')
+        for path in layer_files(buildings_layer_uri):
+            shutil.copy(path, self.temp_dir)
+
+        index = self.cache.get(layer_uri)
+        self.assertIs(index, self.cache.get(layer_uri))
+        # Another process maps the same file
+        other_cache = SpatialIndexCache(self.cache.directory)
+        self.assertEqual(index.path, other_cache.get(layer_uri).path)
+        self.assertEqual(0, other_cache.builds)
+
+        # The layer changed
+        stat = os.stat(layer_uri)
+        os.utime(layer_uri, (stat.st_atime, stat.st_mtime + 10))
+        new_index = self.cache.get(layer_uri)
+        self.assertNotEqual(index.path, new_index.path)
+        self.assertFalse(os.path.exists(index.path))
+        self.assertEqual(
+            {'size': 1, 'hits': 1, 'builds': 2}, self.cache.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
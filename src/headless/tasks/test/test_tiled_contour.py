@@ -0,0 +1,157 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from osgeo import gdal, ogr
+
+from headless.tasks.inasafe_wrapper import generate_contour
+from headless.tasks.test.helpers import (
+    shakemap_layer_uri, retry_on_worker_lost_error)
+from headless.tasks.tiled_contour import (
+    create_tiled_contour, stitch_lines, tile_windows)
+from headless.utils import load_layer
+from safe.definitions.constants import NUMPY_SMOOTHING
+from safe.gis.raster.contour import create_smooth_contour
+from safe.test.utilities import get_qgis_app
+
+QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+def level_lengths(file_path):
+    """Read the total length of the lines of each MMI of a contour."""
+    lengths = {}
+    for mmi, length in read_lines(file_path):
+        lengths[mmi] = lengths.get(mmi, 0) + length
+    return lengths
+
+
+def read_lines(file_path):
+    """Read MMI and length of the lines of a contour shapefile."""
+    data_source = ogr.Open(file_path)
+    layer = data_source.GetLayer()
+    lines = sorted(
+        (feature.GetField('MMI'), feature.GetGeometryRef().Length())
+        for feature in layer)
+    data_source = None
+    return lines
+
+
+class TestTiledContour(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_tile_windows(self):
+        """Test tiles cover the raster and share their boundary pixels."""
+        windows = tile_windows(10, 7, 4)
+        self.assertIn((0, 0, 4, 4), windows)
+        self.assertIn((3, 0, 4, 4), windows)
+        self.assertIn((6, 3, 4, 4), windows)
+        self.assertEqual(6, len(windows))
+        covered = set()
+        for x, y, width, height in windows:
+            for i in range(x, x + width):
+                for j in range(y, y + height):
+                    covered.add((i, j))
+        self.assertEqual(10 * 7, len(covered))
+
+    def test_stitch_lines(self):
+        """Test lines cut by tile edges are joined."""
+        lines = [
+            (1.0, [(0, 0), (1, 0)]),
+            (1.0, [(2, 0), (1, 0)]),
+            (1.0, [(2, 0), (3, 1)]),
+            (1.5, [(1, 0), (1, 1)]),
+        ]
+        stitched = stitch_lines(lines)
+        self.assertEqual(2, len(stitched))
+        mmi, points = stitched[0]
+        self.assertEqual(1.0, mmi)
+        self.assertEqual(4, len(points))
+        self.assertEqual(
+            set([(0, 0), (3, 1)]), set([points[0], points[-1]]))
+
+    def test_create_tiled_contour(self):
+        """Test tiled contour gives the same isolines as a single tile."""
+        single_path = os.path.join(self.temp_dir, 'single.shp')
+        create_tiled_contour(shakemap_layer_uri, single_path, tile_size=10000)
+        tiled_path = os.path.join(self.temp_dir, 'tiled.shp')
+        create_tiled_contour(
+            shakemap_layer_uri, tiled_path, tile_size=32, workers=4)
+
+        single_lines = read_lines(single_path)
+        tiled_lines = read_lines(tiled_path)
+        self.assertLess(0, len(single_lines))
+        self.assertEqual(len(single_lines), len(tiled_lines))
+        for (single_mmi, single_length), (tiled_mmi, tiled_length) in zip(
+                single_lines, tiled_lines):
+            self.assertEqual(single_mmi, tiled_mmi)
+            self.assertAlmostEqual(single_length, tiled_length, places=6)
+
+    def test_same_as_smooth_contour(self):
+        """Test tiled contour gives the isolines of create_smooth_contour."""
+        expected_path = os.path.join(self.temp_dir, 'expected.shp')
+        create_smooth_contour(
+            load_layer(shakemap_layer_uri)[0],
+            output_file_path=expected_path,
+            smoothing_method=NUMPY_SMOOTHING,
+            smoothing_factor=0.5)
+        tiled_path = os.path.join(self.temp_dir, 'tiled.shp')
+        create_tiled_contour(
+            shakemap_layer_uri, tiled_path,
+            smoothing_method=NUMPY_SMOOTHING,
+            smoothing_factor=0.5,
+            tile_size=32)
+
+        expected_lengths = level_lengths(expected_path)
+        tiled_lengths = level_lengths(tiled_path)
+        self.assertLess(0, len(expected_lengths))
+        self.assertEqual(
+            sorted(expected_lengths.keys()), sorted(tiled_lengths.keys()))
+        for mmi, length in expected_lengths.items():
+            self.assertAlmostEqual(length, tiled_lengths[mmi], places=6)
+
+    def test_no_data(self):
+        """Test no data pixels are not smoothed into their neighbours."""
+        dataset = gdal.Open(shakemap_layer_uri)
+        array = dataset.GetRasterBand(1).ReadAsArray()
+        raster_path = os.path.join(self.temp_dir, 'no_data.tif')
+        no_data_dataset = gdal.GetDriverByName('GTiff').CreateCopy(
+            raster_path, dataset)
+        dataset = None
+        band = no_data_dataset.GetRasterBand(1)
+        band.SetNoDataValue(-9999)
+        array[:, :array.shape[1] // 2] = -9999
+        band.WriteArray(array)
+        no_data_dataset = None
+
+        output_path = os.path.join(self.temp_dir, 'no_data.shp')
+        create_tiled_contour(raster_path, output_path, tile_size=32)
+        # Smoothing no data values in would give isolines far below MMI 1
+        mmi_values = [mmi for mmi, _ in read_lines(output_path)]
+        self.assertLess(0, len(mmi_values))
+        self.assertLessEqual(0, min(mmi_values))
+
+    @retry_on_worker_lost_error()
+    def test_generate_tiled_contour(self):
+        """Test generate_contour task in tiled mode."""
+        result = generate_contour.delay(
+            shakemap_layer_uri, tile_size=64).get()
+        self.assertIsNotNone(result)
+        self.assertTrue(os.path.exists(result))
+        self.assertTrue(
+            os.path.exists(os.path.splitext(result)[0] + '.xml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# coding=utf-8
+import signal
+import unittest
+
+import mock
+
+from headless import utils
+from headless.utils import (
+    setup_process_display,
+    start_private_display,
+    WORKER_DISPLAY_XVFB)
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+
+class TestWorkerDisplay(unittest.TestCase):
+
+    def test_shared_display(self):
+        """Test default mode keeps the shared display."""
+        with mock.patch.object(
+                utils.headless_settings, 'WORKER_DISPLAY_MODE', ''), \
+                mock.patch.object(utils, 'start_private_display') as start:
+            self.assertEqual('', setup_process_display(3))
+            self.assertFalse(start.called)
+
+    def test_xvfb_display(self):
+        """Test each child process gets its own Xvfb display number."""
+        with mock.patch.object(
+                utils.headless_settings, 'WORKER_DISPLAY_MODE',
+                WORKER_DISPLAY_XVFB), \
+                mock.patch.object(
+                    utils.headless_settings, 'WORKER_DISPLAY_BASE', 100), \
+                mock.patch.object(utils, 'start_private_display') as start:
+            setup_process_display(0)
+            setup_process_display(3)
+            self.assertEqual(
+                [mock.call(100), mock.call(103)], start.call_args_list)
+
+    def test_unknown_display(self):
+        """Test unsupported modes, such as Qt5 offscreen, are rejected."""
+        with mock.patch.object(
+                utils.headless_settings, 'WORKER_DISPLAY_MODE', 'offscreen'):
+            self.assertRaises(ValueError, setup_process_display, 1)
+
+    def test_stale_display_socket(self):
+        """Test a stale socket is not taken for a started server."""
+        process = mock.Mock(pid=42)
+        process.poll.return_value = 1
+        with mock.patch.object(utils, '_reap_orphan_display'), \
+                mock.patch.object(
+                    utils.subprocess, 'Popen', return_value=process), \
+                mock.patch.object(
+                    utils.os.path, 'exists', return_value=True), \
+                mock.patch.object(utils, '_display_owner', return_value=7):
+            self.assertRaises(RuntimeError, start_private_display, 100)
+        self.assertIsNone(utils.PRIVATE_DISPLAY['process'])
+
+    def test_orphan_display(self):
+        """Test the orphan Xvfb of a crashed child process is killed."""
+        with mock.patch.object(utils, '_display_owner', return_value=55), \
+                mock.patch.object(
+                    utils, '_process_status',
+                    side_effect=[('Xvfb', 1), ('Xvfb', 1), None]), \
+                mock.patch.object(utils.os, 'kill') as kill:
+            utils._reap_orphan_display(100)
+            kill.assert_called_once_with(55, signal.SIGTERM)
+
+    def test_display_in_use(self):
+        """Test a display owned by a live process is not taken."""
+        with mock.patch.object(utils, '_display_owner', return_value=55), \
+                mock.patch.object(
+                    utils, '_process_status', return_value=('Xvfb', 999)), \
+                mock.patch.object(utils.os, 'kill') as kill:
+            self.assertRaises(
+                RuntimeError, utils._reap_orphan_display, 100)
+            self.assertFalse(kill.called)
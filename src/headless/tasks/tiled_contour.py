@@ -0,0 +1,358 @@
+# coding=utf-8
+"""Contour large shakemap rasters tile by tile, with bounded memory."""
+import multiprocessing
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy
+from osgeo import gdal, ogr, osr
+
+from safe.definitions.constants import NUMPY_SMOOTHING
+from safe.definitions.fields import contour_id_field, contour_mmi_field
+from safe.gis.raster.contour import (
+    convolve,
+    create_contour_metadata,
+    gaussian_kernel,
+    set_contour_properties)
+
+from headless.utils import get_headless_logger
+
+__copyright__ = "Copyright 2018, The InaSAFE Project"
+__license__ = "GPL version 3"
+__email__ = "info@inasafe.org"
+__revision__ = '$Format:%H$'
+
+LOGGER = get_headless_logger()
+
+# Same isolines as create_smooth_contour: every half MMI.
+CONTOUR_INTERVAL = 0.5
+CONTOUR_BASE = 0.0
+
+# Decimal places of pixel coordinates used to match line ends across tiles.
+STITCH_PRECISION = 6
+
+
+def tile_windows(width, height, tile_size):
+    """Split a raster into tiles.
+
+    Adjacent tiles share their boundary row or column of pixels, so their
+    isolines end on the same points and can be stitched.
+
+    :param width: Raster width in pixels.
+    :type width: int
+
+    :param height: Raster height in pixels.
+    :type height: int
+
+    :param tile_size: Tile width and height in pixels.
+    :type tile_size: int
+
+    :return: List of (x offset, y offset, width, height) of the tiles.
+    :rtype: list
+    """
+    step = max(tile_size - 1, 1)
+    windows = []
+    for y in range(0, max(height - 1, 1), step):
+        for x in range(0, max(width - 1, 1), step):
+            windows.append(
+                (x, y, min(tile_size, width - x), min(tile_size, height - y)))
+    return windows
+
+
+def tile_clip_box(window, width, height):
+    """Get the area where the isolines of a tile are kept.
+
+    GDAL extends isolines up to the edge of the pixels at the border of a
+    raster. Inside the raster, tile isolines are cut on the centers of the
+    boundary pixels shared with the next tile instead, so they join the
+    isolines of that tile.
+
+    :param window: (x offset, y offset, width, height) of the tile.
+    :type window: tuple
+
+    :param width: Raster width in pixels.
+    :type width: int
+
+    :param height: Raster height in pixels.
+    :type height: int
+
+    :return: Polygon in pixel coordinates.
+    :rtype: ogr.Geometry
+    """
+    x_offset, y_offset, tile_width, tile_height = window
+    outside = float(max(width, height) + 1)
+    min_x = x_offset + 0.5 if x_offset > 0 else -outside
+    min_y = y_offset + 0.5 if y_offset > 0 else -outside
+    max_x = x_offset + tile_width - 0.5 if (
+        x_offset + tile_width < width) else width + outside
+    max_y = y_offset + tile_height - 0.5 if (
+        y_offset + tile_height < height) else height + outside
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in (
+            (min_x, min_y), (max_x, min_y), (max_x, max_y),
+            (min_x, max_y), (min_x, min_y)):
+        ring.AddPoint_2D(x, y)
+    box = ogr.Geometry(ogr.wkbPolygon)
+    box.AddGeometry(ring)
+    return box
+
+
+def contour_tile(raster_path, active_band, window, kernel):
+    """Smooth and contour one tile of a raster.
+
+    The tile is read with a margin of the kernel radius and smoothed with
+    the convolution of InaSAFE, so the smoothed values match a smoothing of
+    the whole raster. The margin is mirrored at the raster edges, as
+    InaSAFE does. No data pixels are masked, they keep their value and do
+    not weigh on their neighbours.
+
+    :param raster_path: Path to the raster.
+    :type raster_path: basestring
+
+    :param active_band: The band to contour.
+    :type active_band: int
+
+    :param window: (x offset, y offset, width, height) of the tile.
+    :type window: tuple
+
+    :param kernel: Smoothing kernel, or None to not smooth.
+    :type kernel: numpy.ndarray
+
+    :return: List of (MMI, points) of the isolines of the tile, with points
+        in pixel coordinates of the raster.
+    :rtype: list
+    """
+    x_offset, y_offset, tile_width, tile_height = window
+    dataset = gdal.Open(raster_path)
+    band = dataset.GetRasterBand(active_band)
+    no_data = band.GetNoDataValue()
+    clip_box = tile_clip_box(
+        window, dataset.RasterXSize, dataset.RasterYSize)
+
+    radius = kernel.shape[0] // 2 if kernel is not None else 0
+    read_x = max(x_offset - radius, 0)
+    read_y = max(y_offset - radius, 0)
+    read_width = min(
+        x_offset + tile_width + radius, dataset.RasterXSize) - read_x
+    read_height = min(
+        y_offset + tile_height + radius, dataset.RasterYSize) - read_y
+    array = band.ReadAsArray(
+        read_x, read_y, read_width, read_height).astype(numpy.float64)
+    dataset = None
+
+    if kernel is not None:
+        padding = (
+            (radius - (y_offset - read_y),
+             radius - (read_y + read_height - y_offset - tile_height)),
+            (radius - (x_offset - read_x),
+             radius - (read_x + read_width - x_offset - tile_width)))
+        array = numpy.pad(array, padding, mode='symmetric')
+        mask = None
+        if no_data is not None:
+            mask = array == no_data
+            if not mask.any():
+                mask = None
+        array = convolve(array, kernel, mask=mask)
+        array = array[radius:radius + tile_height, radius:radius + tile_width]
+
+    # InaSAFE contours the smoothed raster as 32 bits floats
+    memory_driver = gdal.GetDriverByName('MEM')
+    tile_dataset = memory_driver.Create(
+        '', tile_width, tile_height, 1, gdal.GDT_Float32)
+    tile_dataset.SetGeoTransform(
+        (x_offset, 1, 0, y_offset, 0, 1))
+    tile_band = tile_dataset.GetRasterBand(1)
+    tile_band.WriteArray(array.astype(numpy.float32))
+
+    vector_driver = ogr.GetDriverByName('Memory')
+    vector_dataset = vector_driver.CreateDataSource('')
+    layer = vector_dataset.CreateLayer('contour')
+    layer.CreateField(ogr.FieldDefn('ID', ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn('MMI', ogr.OFTReal))
+    gdal.ContourGenerate(
+        tile_band,
+        CONTOUR_INTERVAL,
+        CONTOUR_BASE,
+        [],
+        1 if no_data is not None else 0,
+        no_data if no_data is not None else 0,
+        layer,
+        0,
+        1)
+
+    lines = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef().Intersection(clip_box)
+        if geometry is None or geometry.IsEmpty():
+            continue
+        if ogr.GT_Flatten(geometry.GetGeometryType()) == ogr.wkbLineString:
+            parts = [geometry]
+        else:
+            parts = [
+                geometry.GetGeometryRef(i)
+                for i in range(geometry.GetGeometryCount())]
+        for part in parts:
+            if ogr.GT_Flatten(part.GetGeometryType()) == ogr.wkbLineString:
+                lines.append((feature.GetField('MMI'), part.GetPoints()))
+    return lines
+
+
+def stitch_lines(lines):
+    """Join isolines of the same level which end on the same point.
+
+    :param lines: List of (MMI, points).
+    :type lines: list
+
+    :return: List of (MMI, points) with lines cut by tile edges joined.
+    :rtype: list
+    """
+    def point_key(point):
+        return (
+            round(point[0], STITCH_PRECISION),
+            round(point[1], STITCH_PRECISION))
+
+    stitched = []
+    levels = {}
+    for mmi, points in lines:
+        levels.setdefault(mmi, []).append(list(points))
+
+    for mmi, level_lines in sorted(levels.items()):
+        # Lines which are not closed, indexed by their end points
+        ends = {}
+        for index, points in enumerate(level_lines):
+            if point_key(points[0]) == point_key(points[-1]):
+                continue
+            ends.setdefault(point_key(points[0]), []).append(index)
+            ends.setdefault(point_key(points[-1]), []).append(index)
+
+        used = set()
+
+        def other_line(key, index):
+            for other in ends.get(key, []):
+                if other != index and other not in used:
+                    return other
+            return None
+
+        for index, points in enumerate(level_lines):
+            if index in used:
+                continue
+            used.add(index)
+            line = list(points)
+            # Extend forward then backward
+            for _ in range(2):
+                while point_key(line[0]) != point_key(line[-1]):
+                    key = point_key(line[-1])
+                    other = other_line(key, index)
+                    if other is None:
+                        break
+                    used.add(other)
+                    other_points = level_lines[other]
+                    if point_key(other_points[0]) != key:
+                        other_points = other_points[::-1]
+                    line.extend(other_points[1:])
+                line.reverse()
+            stitched.append((mmi, line))
+    return stitched
+
+
+def create_tiled_contour(
+        raster_path,
+        output_file_path,
+        active_band=1,
+        smoothing_method=NUMPY_SMOOTHING,
+        smoothing_factor=0.5,
+        tile_size=1024,
+        workers=None):
+    """Create smooth contour of a raster, tile by tile.
+
+    It smooths the raster with the kernel and the convolution of
+    create_smooth_contour, and gives the same isolines on rasters without
+    no data pixels. No data pixels are masked instead of being smoothed
+    into their neighbours. Only tiles of tile_size pixels are in memory at
+    a time, per worker. Tiles are processed in a thread pool, GDAL releases
+    the GIL while it contours a tile.
+
+    :param raster_path: Path to the shakemap raster.
+    :type raster_path: basestring
+
+    :param output_file_path: Path to the output shapefile.
+    :type output_file_path: basestring
+
+    :param active_band: The band to contour.
+    :type active_band: int
+
+    :param smoothing_method: Smoothing method. Like create_smooth_contour,
+        only NUMPY_SMOOTHING smooths the raster.
+    :type smoothing_method: str
+
+    :param smoothing_factor: Standard deviation of the gaussian smoothing,
+        in pixels.
+    :type smoothing_factor: float
+
+    :param tile_size: Tile width and height in pixels.
+    :type tile_size: int
+
+    :param workers: Number of tiles processed at the same time. Defaults to
+        the number of cores.
+    :type workers: int
+
+    :return: The output file path.
+    :rtype: basestring
+    """
+    dataset = gdal.Open(raster_path)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    geo_transform = dataset.GetGeoTransform()
+    projection = dataset.GetProjection()
+    dataset = None
+
+    if smoothing_method == NUMPY_SMOOTHING and smoothing_factor:
+        kernel = gaussian_kernel(smoothing_factor)
+    else:
+        kernel = None
+
+    windows = tile_windows(width, height, tile_size)
+    LOGGER.debug('Contour %s in %d tiles' % (raster_path, len(windows)))
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        tile_lines = pool.map(
+            lambda window: contour_tile(
+                raster_path, active_band, window, kernel),
+            windows)
+    finally:
+        pool.close()
+        pool.join()
+
+    lines = stitch_lines(
+        [line for lines in tile_lines for line in lines])
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(output_file_path):
+        driver.DeleteDataSource(output_file_path)
+    output_dataset = driver.CreateDataSource(output_file_path)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromWkt(projection)
+    layer = output_dataset.CreateLayer(
+        'contour', spatial_reference, ogr.wkbLineString)
+    layer.CreateField(
+        ogr.FieldDefn(contour_id_field['field_name'], ogr.OFTInteger))
+    layer.CreateField(
+        ogr.FieldDefn(contour_mmi_field['field_name'], ogr.OFTReal))
+    for feature_id, (mmi, points) in enumerate(lines):
+        geometry = ogr.Geometry(ogr.wkbLineString)
+        for pixel_x, pixel_y in (point[:2] for point in points):
+            geometry.AddPoint_2D(
+                geo_transform[0] + pixel_x * geo_transform[1] +
+                pixel_y * geo_transform[2],
+                geo_transform[3] + pixel_x * geo_transform[4] +
+                pixel_y * geo_transform[5])
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField(contour_id_field['field_name'], feature_id)
+        feature.SetField(contour_mmi_field['field_name'], mmi)
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+    output_dataset = None
+
+    set_contour_properties(output_file_path)
+    create_contour_metadata(output_file_path)
+    return output_file_path
@@ -1,7 +1,21 @@
 # coding=utf-8
+import cPickle as pickle
+import glob
+import hashlib
+import json
 import logging
 import os
+import resource
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
 
+from osgeo import ogr
 from qgis.core import QgsMapLayer
 
 from headless import settings as headless_settings
@@ -9,6 +23,7 @@ from safe.common.exceptions import NoKeywordsFoundError
 from safe.gis.tools import load_layer as inasafe_load_layer
 from safe.utilities.keyword_io import KeywordIO
 from safe.utilities.metadata import read_iso19115_metadata
+from safe.utilities.settings import setting
 from safe.utilities.utilities import monkey_patch_keywords
 
 
@@ -19,6 +34,174 @@ def set_logger():
     logger.setLevel(headless_settings.INASAFE_LOG_LEVEL)
 
 
+WORKER_DISPLAY_XVFB = 'xvfb'
+
+# Private Xvfb process of the current process, if any.
+PRIVATE_DISPLAY = {
+    'display': None,
+    'process': None,
+}
+
+
+def _display_owner(display_number):
+    """Get the process id written in the lock file of an X display.
+
+    :param display_number: The X display number.
+    :type display_number: int
+
+    :return: The process id owning the display, or None if it is free.
+    :rtype: int
+    """
+    try:
+        with open('/tmp/.X%d-lock' % display_number) as lock_file:
+            return int(lock_file.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def _process_status(pid):
+    """Get the command name and the parent process id of a live process.
+
+    :param pid: The process id.
+    :type pid: int
+
+    :return: Tuple of the command name and the parent process id, or None if
+        the process does not exist anymore or is a zombie.
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return None
+    # The command name is between parentheses and may contain spaces.
+    command = stat[stat.index('(') + 1:stat.rindex(')')]
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] in ('Z', 'X'):
+        return None
+    return command, int(fields[1])
+
+
+def _reap_orphan_display(display_number, timeout=10):
+    """Kill an orphan Xvfb server left on a display by a dead process.
+
+    Billiard gives the index of a dead child process to its replacement, so
+    the Xvfb server of a crashed child may still hold the display. It has
+    been reparented to init, which tells it apart from a server owned by a
+    live process.
+
+    :param display_number: The X display number.
+    :type display_number: int
+
+    :param timeout: Number of seconds to wait for the server to exit.
+    :type timeout: int
+
+    :raises: RuntimeError if the display is used by another live process.
+    """
+    pid = _display_owner(display_number)
+    status = pid and _process_status(pid)
+    if not status:
+        # Xvfb replaces stale lock files itself.
+        return
+    command, parent_pid = status
+    if command != 'Xvfb' or parent_pid != 1:
+        raise RuntimeError(
+            'Display :%d is already used by process %d (%s)' % (
+                display_number, pid, command))
+
+    LOGGER.info(
+        'Killing orphan Xvfb process %d on display :%d' % (
+            pid, display_number))
+    os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + timeout
+    while _process_status(pid):
+        if time.time() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            deadline = time.time() + timeout
+        time.sleep(0.1)
+
+
+def start_private_display(display_number, timeout=10):
+    """Start a private Xvfb server and use it for the current process.
+
+    An orphan Xvfb server left on the display by a crashed process is killed
+    first.
+
+    :param display_number: The X display number to use.
+    :type display_number: int
+
+    :param timeout: Number of seconds to wait for the server to be ready.
+    :type timeout: int
+
+    :return: The display name, such as ':100'.
+    :rtype: str
+
+    :raises: RuntimeError if the server does not start or the display is
+        used by another process.
+    """
+    display = ':%d' % display_number
+    socket_path = '/tmp/.X11-unix/X%d' % display_number
+    _reap_orphan_display(display_number, timeout)
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(
+            ['Xvfb', display, '-screen', '0', '1024x768x24',
+             '-nolisten', 'tcp'],
+            stdout=devnull, stderr=devnull)
+
+    # A stale socket may exist, the display is ready once our server owns
+    # its lock file and the socket exists.
+    deadline = time.time() + timeout
+    while not (_display_owner(display_number) == process.pid and
+               os.path.exists(socket_path)):
+        if process.poll() is not None or time.time() > deadline:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            raise RuntimeError(
+                'Failed to start Xvfb on display %s' % display)
+        time.sleep(0.1)
+
+    PRIVATE_DISPLAY['display'] = display
+    PRIVATE_DISPLAY['process'] = process
+    os.environ['DISPLAY'] = display
+    return display
+
+
+def stop_private_display():
+    """Stop the private Xvfb server of the current process, if any."""
+    process = PRIVATE_DISPLAY['process']
+    if process and process.poll() is None:
+        process.terminate()
+        process.wait()
+    PRIVATE_DISPLAY['display'] = None
+    PRIVATE_DISPLAY['process'] = None
+
+
+def setup_process_display(process_index=0):
+    """Give the current process its own display, following settings.
+
+    It must be called before the QGIS application is created in this
+    process, so QGIS binds to the private display.
+
+    :param process_index: Index of the child process in the worker pool.
+    :type process_index: int
+
+    :return: The display mode used.
+    :rtype: str
+
+    :raises: ValueError if the display mode is unknown.
+    """
+    mode = headless_settings.WORKER_DISPLAY_MODE
+    if mode == WORKER_DISPLAY_XVFB:
+        start_private_display(
+            headless_settings.WORKER_DISPLAY_BASE + process_index)
+    elif mode:
+        raise ValueError(
+            'Unknown HEADLESS_WORKER_DISPLAY_MODE %s, it must be empty or '
+            '%s.' % (mode, WORKER_DISPLAY_XVFB))
+    return mode
+
+
 def get_headless_logger():
     """Get an instance of InaSAFE Headless logger."""
     logger = logging.getLogger('InaSAFE Headless')
@@ -26,6 +209,464 @@ def get_headless_logger():
     return logger
 
 
+LOGGER = get_headless_logger()
+
+
+class PhaseTimer(object):
+    """Measure the time spent in named phases of a task.
+
+    Time of a phase entered several times is accumulated. It also records
+    the size of the input layers of the task.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.phases = OrderedDict()
+        self.inputs = OrderedDict()
+
+    def reset(self):
+        """Forget all measured phases and inputs."""
+        self.phases = OrderedDict()
+        self.inputs = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager measuring the wrapped block as a phase.
+
+        :param name: Name of the phase, such as 'load' or 'run'.
+        :type name: str
+        """
+        start_wall = time.time()
+        start_cpu = sum(os.times()[:2])
+        try:
+            yield
+        finally:
+            timing = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            timing['wall'] += time.time() - start_wall
+            timing['cpu'] += sum(os.times()[:2]) - start_cpu
+
+    def wall_times(self):
+        """Get wall time of each phase.
+
+        :return: Dictionary of phase name and wall time in seconds.
+        :rtype: dict
+        """
+        return OrderedDict(
+            (name, timing['wall']) for name, timing in self.phases.items())
+
+    def record_input(self, layer_uri, layer):
+        """Record the size of an input layer.
+
+        :param layer_uri: Uri to layer.
+        :type layer_uri: basestring
+
+        :param layer: The loaded layer.
+        :type layer: QgsMapLayer
+        """
+        if not layer or not layer.isValid():
+            return
+        if layer.type() == QgsMapLayer.VectorLayer:
+            self.inputs[layer_uri] = {'features': layer.featureCount()}
+        else:
+            self.inputs[layer_uri] = {
+                'pixels': layer.width() * layer.height()}
+
+    def metrics(self, output=None):
+        """Get metrics of the current task.
+
+        :param output: Output of the task, a path or a dictionary of paths
+            possibly nested, to measure output sizes.
+        :type output: basestring, dict
+
+        :return: Dictionary of phases wall and cpu time, peak RSS of the
+            worker process in kilobytes, input sizes and output sizes in
+            bytes.
+        :rtype: dict
+        """
+        return {
+            'phases': deepcopy(self.phases),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'inputs': deepcopy(self.inputs),
+            'outputs': output_sizes(output),
+        }
+
+
+def output_sizes(output):
+    """Compute size of task output files.
+
+    :param output: A path or a dictionary of paths, possibly nested.
+    :type output: basestring, dict
+
+    :return: Size in bytes of each output, including sidecar files, with the
+        same structure as output.
+    :rtype: int, dict
+    """
+    if isinstance(output, dict):
+        return dict(
+            (key, output_sizes(value)) for key, value in output.items())
+    if isinstance(output, list):
+        return [output_sizes(value) for value in output]
+    if isinstance(output, basestring) and os.path.exists(output):
+        return sum(os.path.getsize(path) for path in layer_files(output))
+    return None
+
+
+# Phase timer of the task running in this process.
+phase_timer = PhaseTimer()
+
+
+def file_version(file_path):
+    """Get version of a file, based on its modification time and size.
+
+    :param file_path: Path to the file.
+    :type file_path: basestring
+
+    :return: Tuple of mtime and size, or None if the file does not exist.
+    :rtype: tuple
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+# Extensions of the data, keywords and style files of a layer. Other files
+# with the same base name, such as .aux.xml statistics written by GDAL, are
+# not part of the layer.
+LAYER_FILE_EXTENSIONS = [
+    '.shp', '.shx', '.dbf', '.prj', '.cpg', '.qix',
+    '.geojson', '.json', '.gpkg', '.sqlite',
+    '.tif', '.tiff', '.asc',
+    '.xml', '.qml', '.sld']
+
+
+def layer_files(layer_uri):
+    """List the files a file based layer is made of.
+
+    It includes the layer file itself and the sidecar files with the same
+    base name and an extension of LAYER_FILE_EXTENSIONS, such as .dbf,
+    .shx, .prj, .xml and .qml files.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :return: Sorted list of existing file paths.
+    :rtype: list
+    """
+    base_path = os.path.splitext(layer_uri)[0]
+    paths = set(
+        path for path in glob.glob(base_path + '.*')
+        if path[len(base_path):].lower() in LAYER_FILE_EXTENSIONS)
+    if os.path.exists(layer_uri):
+        paths.add(layer_uri)
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+# Cache of file digests, keyed by (path, mtime, size)
+FILE_DIGESTS = {}
+
+
+def file_digest(file_path, block_size=1024 * 1024):
+    """Compute md5 digest of a file content.
+
+    Digests are remembered by path, mtime and size, so unchanged files are
+    not read again.
+
+    :param file_path: Path to the file.
+    :type file_path: basestring
+
+    :param block_size: Size of blocks read from the file.
+    :type block_size: int
+
+    :return: Hex digest of the file.
+    :rtype: str
+    """
+    key = (file_path, ) + file_version(file_path)
+    digest = FILE_DIGESTS.get(key)
+    if digest:
+        return digest
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    digest = md5.hexdigest()
+    FILE_DIGESTS[key] = digest
+    return digest
+
+
+def layer_digest(layer_uri):
+    """Compute a digest of a layer content, including its metadata.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :return: Hex digest of the layer files. If the layer is not file based,
+        the digest of the uri is returned.
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    paths = layer_files(layer_uri)
+    if not paths:
+        md5.update(layer_uri.encode('utf-8'))
+    for path in paths:
+        md5.update(os.path.splitext(path)[1].lower())
+        md5.update(file_digest(path))
+    return md5.hexdigest()
+
+
+def layer_base_path(layer_uri):
+    """Get the path of the keywords and style files of a layer, without
+    extension.
+
+    Files of a layer of a GeoPackage, such as path.gpkg|layername=name, are
+    in a directory named after the GeoPackage, path/name.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :return: Path without extension.
+    :rtype: basestring
+    """
+    path, separator, layer_name = layer_uri.partition('|layername=')
+    if separator:
+        return os.path.join(os.path.splitext(path)[0], layer_name)
+    return os.path.splitext(layer_uri)[0]
+
+
+def metadata_file_path(layer_uri):
+    """Get the path of the file holding the ISO 19115 metadata of a layer.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :return: Path to the xml file if it exists, otherwise the layer uri.
+    :rtype: basestring
+    """
+    xml_path = layer_base_path(layer_uri) + '.xml'
+    if os.path.exists(xml_path):
+        return xml_path
+    return layer_uri
+
+
+def copy_metadata(value):
+    """Copy the containers of a metadata value, sharing other values.
+
+    Dictionaries and lists are the only values callers change, other values
+    such as strings, numbers, dates and QUrl are shared with the copy.
+
+    :param value: Metadata or one of its values.
+
+    :return: The copy.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (key, copy_metadata(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [copy_metadata(item) for item in value]
+    return value
+
+
+class MetadataCache(object):
+    """Bounded LRU cache of layer metadata.
+
+    Entries are keyed by (path, mtime, size) of the metadata file, so a
+    changed file is never served from the cache. Cleaned copies of the
+    metadata are kept next to the entries, in memory only.
+    """
+
+    def __init__(self, max_size=512, cache_path=None, save_batch_size=16):
+        """Constructor.
+
+        :param max_size: Maximum number of metadata kept in the cache.
+        :type max_size: int
+
+        :param cache_path: File to persist the cache. If None, the cache is
+            only kept in memory.
+        :type cache_path: basestring
+
+        :param save_batch_size: Number of new entries after which the cache
+            is persisted. Remaining entries are persisted by save, when the
+            worker process shuts down.
+        :type save_batch_size: int
+        """
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self.save_batch_size = save_batch_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._cleaned = {}
+        self._unsaved = 0
+        self.load()
+
+    def key(self, layer_uri):
+        """Compute cache key of a layer.
+
+        :param layer_uri: Uri to layer.
+        :type layer_uri: basestring
+
+        :return: Tuple of path, mtime and size of the metadata file.
+        :rtype: tuple
+        """
+        path = metadata_file_path(layer_uri)
+        version = file_version(path)
+        if version is None:
+            return None
+        return (layer_uri, ) + version
+
+    def get(self, layer_uri, clean=None):
+        """Get metadata of a layer, read it if it is not in the cache.
+
+        :param layer_uri: Uri to layer.
+        :type layer_uri: basestring
+
+        :param clean: Function cleaning the metadata in place. It is only
+            called once per cache entry, the cleaned metadata is cached. It
+            must be the same function on every call.
+        :type clean: function
+
+        :return: A copy of the layer metadata, cleaned if clean is given.
+        :rtype: dict
+
+        :raises: NoKeywordsFoundError
+        """
+        key = self.key(layer_uri)
+        if key is not None and key in self._entries:
+            self.hits += 1
+            metadata = self._entries.pop(key)
+            self._entries[key] = metadata
+        else:
+            self.misses += 1
+            if '|layername=' in layer_uri:
+                # InaSAFE only reads keywords of GeoPackage layers from its
+                # database, read them from their xml file if there is one
+                metadata = read_iso19115_metadata(
+                    metadata_file_path(layer_uri))
+            else:
+                metadata = read_iso19115_metadata(layer_uri)
+            if key is not None:
+                self._put(key, metadata)
+
+        if not clean:
+            return copy_metadata(metadata)
+        cleaned = self._cleaned.get(key)
+        if cleaned is None:
+            cleaned = deepcopy(metadata)
+            clean(cleaned)
+            if key is not None:
+                self._cleaned[key] = cleaned
+        return deepcopy(cleaned)
+
+    def _put(self, key, metadata):
+        """Store metadata in the cache and evict the oldest entries.
+
+        :param key: Cache key.
+        :type key: tuple
+
+        :param metadata: Layer metadata.
+        :type metadata: dict
+        """
+        # Drop outdated versions of the same layer
+        for old_key in [k for k in self._entries if k[0] == key[0]]:
+            del self._entries[old_key]
+            self._cleaned.pop(old_key, None)
+        self._entries[key] = copy_metadata(metadata)
+        while len(self._entries) > self.max_size:
+            old_key, _ = self._entries.popitem(last=False)
+            self._cleaned.pop(old_key, None)
+        self._unsaved += 1
+        if self._unsaved >= self.save_batch_size:
+            self.save()
+
+    def clear(self):
+        """Remove all entries and reset counters."""
+        self._entries.clear()
+        self._cleaned.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load persisted cache entries, if any."""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'rb') as f:
+                entries = pickle.load(f)
+        except Exception as e:
+            LOGGER.warning('Can not load metadata cache: %s' % e)
+            return
+        for key, metadata in entries:
+            # Only keep entries which are still up to date
+            if self.key(key[0]) == key:
+                self._entries[key] = metadata
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """Persist cache entries, if a cache path is set and they changed.
+
+        Entries are written to a temporary file unique to this call, in the
+        directory of the cache file, then renamed over it. Processes sharing
+        the cache file never read a partly written cache.
+        """
+        if not self.cache_path or not self._unsaved:
+            return
+        self._unsaved = 0
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.cache_path) + '.',
+                suffix='.tmp',
+                dir=os.path.dirname(os.path.abspath(self.cache_path)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(
+                    self._entries.items(), f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, self.cache_path)
+        except Exception as e:
+            LOGGER.warning('Can not save metadata cache: %s' % e)
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def stats(self):
+        """Get cache statistics.
+
+        :return: Dictionary of size, hits and misses.
+        :rtype: dict
+        """
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+metadata_cache = MetadataCache(
+    headless_settings.METADATA_CACHE_SIZE,
+    headless_settings.METADATA_CACHE_PATH or None)
+
+
+def read_metadata(layer_uri, clean=None):
+    """Read ISO 19115 metadata of a layer through the metadata cache.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :param clean: Function cleaning the metadata in place, see
+        MetadataCache.get.
+    :type clean: function
+
+    :return: The layer metadata.
+    :rtype: dict
+
+    :raises: NoKeywordsFoundError
+    """
+    return metadata_cache.get(layer_uri, clean)
+
+
 def load_layer(full_layer_uri_string, name=None, provider=None):
     """Helper method to override InaSAFE load layer method.
 
@@ -61,7 +702,7 @@ def load_layer(full_layer_uri_string, name=None, provider=None):
             try:
                 # layer keywords read probably fails if it is a remote data
                 # source. Attempt to search for local xml file first
-                keywords = read_iso19115_metadata(full_layer_uri_string)
+                keywords = read_metadata(full_layer_uri_string)
                 layer.keywords = keywords
 
                 # if succeed, remember the keyword in QGIS Metadata for
@@ -80,3 +721,207 @@ def load_layer(full_layer_uri_string, name=None, provider=None):
     # Deal with other cases
     return inasafe_load_layer(
         full_layer_uri_string, name=name, provider=provider)
+
+
+# Vector formats which have their own spatial index.
+INDEXED_EXTENSIONS = ['.gpkg']
+
+# Input layer formats converted to GeoPackage by the ingest cache.
+INGEST_EXTENSIONS = ['.geojson', '.json', '.shp']
+
+# Sidecar files copied with the converted layer.
+INGEST_SIDECAR_EXTENSIONS = ['.xml', '.qml']
+
+# Bump it when layers are converted differently.
+INGEST_VERSION = 1
+
+
+def provider_file_path(layer):
+    """Get the path of the file a layer provider reads.
+
+    It differs from the layer source for layers loaded from the ingest
+    cache, which keep the source of the input layer.
+
+    :param layer: The layer.
+    :type layer: QgsMapLayer
+
+    :return: Path of the data source, without layer options.
+    :rtype: basestring
+    """
+    return layer.dataProvider().dataSourceUri().split('|')[0]
+
+
+def convert_to_geopackage(layer_uri, output_path):
+    """Convert a vector layer to a GeoPackage with a spatial index.
+
+    The GeoPackage and its sidecar files are written under temporary names
+    first, so readers never see a partial copy.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :param output_path: Path to the GeoPackage.
+    :type output_path: basestring
+
+    :raises: ValueError if the layer can not be converted.
+    """
+    source = ogr.Open(layer_uri)
+    if source is None:
+        raise ValueError('%s is not a vector layer.' % layer_uri)
+    base_path = os.path.splitext(output_path)[0]
+    temp_path = '%s.%d.tmp.gpkg' % (base_path, os.getpid())
+    copy = ogr.GetDriverByName('GPKG').CopyDataSource(source, temp_path)
+    if copy is None:
+        raise ValueError('Can not convert %s to GeoPackage.' % layer_uri)
+    copy = None
+    source = None
+
+    for path in layer_files(layer_uri):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in INGEST_SIDECAR_EXTENSIONS:
+            sidecar_path = base_path + extension
+            shutil.copyfile(path, '%s.%d.tmp' % (sidecar_path, os.getpid()))
+            os.rename(
+                '%s.%d.tmp' % (sidecar_path, os.getpid()), sidecar_path)
+    os.rename(temp_path, output_path)
+
+
+class IngestCache(object):
+    """GeoPackage copies of GeoJSON and shapefile input layers.
+
+    GeoJSON is parsed entirely on each load and has no spatial index. The
+    first time a version of an input layer is loaded, it is converted to a
+    GeoPackage with its keywords and style, and later loads by any worker
+    read the copy. A changed input gets a new copy and the old one is
+    deleted.
+    """
+
+    def __init__(self, directory=None):
+        """Constructor.
+
+        :param directory: Directory of the copies. If None, ingest_cache in
+            the InaSAFE user directory is used.
+        :type directory: basestring
+        """
+        self.directory = directory
+        self.hits = 0
+        self.conversions = 0
+
+    def cached_path(self, layer_uri):
+        """Get the path of the copy of the current version of a layer.
+
+        :param layer_uri: Uri to layer.
+        :type layer_uri: basestring
+
+        :return: Path to the GeoPackage, or None if the layer is not a file.
+        :rtype: basestring
+        """
+        if file_version(layer_uri) is None:
+            return None
+        directory = self.directory or os.path.join(
+            setting('defaultUserDirectory'), 'ingest_cache')
+        layer_key = hashlib.sha1(layer_uri.encode('utf-8')).hexdigest()[:16]
+        version = json.dumps([
+            INGEST_VERSION,
+            [file_version(path) for path in layer_files(layer_uri)]])
+        version_key = hashlib.sha1(version).hexdigest()[:16]
+        return os.path.join(directory, '%s_%s.gpkg' % (layer_key, version_key))
+
+    def get(self, layer_uri):
+        """Get the GeoPackage copy of a layer, convert it if needed.
+
+        :param layer_uri: Uri to layer.
+        :type layer_uri: basestring
+
+        :return: Path to the GeoPackage, or None if the layer can not be
+            converted.
+        :rtype: basestring
+        """
+        if os.path.splitext(layer_uri)[1].lower() not in INGEST_EXTENSIONS:
+            return None
+        cached_path = self.cached_path(layer_uri)
+        if cached_path is None:
+            return None
+        if os.path.exists(cached_path):
+            self.hits += 1
+            return cached_path
+
+        directory, file_name = os.path.split(cached_path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        LOGGER.debug('Convert %s to %s' % (layer_uri, cached_path))
+        try:
+            convert_to_geopackage(layer_uri, cached_path)
+        except ValueError as e:
+            LOGGER.debug(e)
+            return None
+        self.conversions += 1
+
+        # Delete copies of older versions of the same layer
+        layer_key = file_name.split('_')[0]
+        current_base = os.path.splitext(file_name)[0]
+        for name in os.listdir(directory):
+            if (name.startswith(layer_key + '_')
+                    and not name.startswith(current_base)
+                    and '.tmp' not in name):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+        return cached_path
+
+    def stats(self):
+        """Get cache statistics.
+
+        :return: Dictionary of hits and conversions.
+        :rtype: dict
+        """
+        return {
+            'hits': self.hits,
+            'conversions': self.conversions,
+        }
+
+
+ingest_cache = IngestCache(headless_settings.INGEST_CACHE_DIRECTORY or None)
+
+
+def load_input_layer(layer_uri):
+    """Load an analysis input layer, from the ingest cache if enabled.
+
+    A layer loaded from its GeoPackage copy keeps the name and source of the
+    input layer, they are used in analysis provenance.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :returns: tuple containing layer and its layer_purpose.
+    :rtype: (QgsMapLayer, str)
+    """
+    if headless_settings.INGEST_CACHE_ENABLED:
+        cached_path = ingest_cache.get(layer_uri)
+        if cached_path:
+            name = os.path.splitext(os.path.basename(layer_uri))[0]
+            layer, layer_purpose = load_layer(
+                cached_path, name=name, provider='ogr')
+            if layer and layer.isValid():
+                layer.source = lambda: layer_uri
+                layer.publicSource = lambda: layer_uri
+                return layer, layer_purpose
+    return load_layer(layer_uri)
+
+
+def load_analysis_layer(layer_uri):
+    """Load an analysis input layer and record its size for phase metrics.
+
+    :param layer_uri: Uri to layer.
+    :type layer_uri: basestring
+
+    :returns: tuple containing layer and its layer_purpose.
+    :rtype: (QgsMapLayer, str)
+    """
+    layer, layer_purpose = load_input_layer(layer_uri)
+    phase_timer.record_input(layer_uri, layer)
+    return layer, layer_purpose